@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+异步日志：日志记录只在调用线程入队，格式化和控制台输出在单独的监听线程中完成
+
+弹幕高峰时每条弹幕会产生多行 INFO 日志，同步格式化并写控制台会占用大量 CPU。启用后：
+    DeferredQueueHandler  替换根 logger 上原有的处理器，只把 LogRecord 放入队列，
+                          不在调用线程格式化（日志应使用 logger.info("%s", value) 的惰性格式）
+    SamplingFilter        按调用位置限流：同一行日志每个采样周期最多输出 burst 条，
+                          其余丢弃并在下个周期输出一条汇总；WARNING 及以上级别不限流
+    SamplingQueueListener 在后台线程中把记录交给原有的处理器（控制台等）；队列空闲时
+                          按周期结束限流窗口，弹幕高峰过去后汇总也能及时输出
+
+默认关闭，在配置 logging.async 中启用；sample_burst 为 0（默认）时只异步输出，不限流。
+停止时调用 stop_async_logging(listener)，把队列中剩余的日志写完。
+"""
+
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+
+class SamplingFilter(logging.Filter):
+    """按调用位置（logger 名称 + 文件 + 行号）限流 INFO 及以下级别的日志
+
+    被丢弃的条数在周期结束后生成汇总记录，由 DeferredQueueHandler 直接入队（不再经过本过滤器）；
+    没有新日志时由 SamplingQueueListener 调用 flush() 结束周期。
+    """
+
+    def __init__(self, interval: float = 1.0, burst: int = 5):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._window_start = time.monotonic()
+        self._counts = {}  # {调用位置: 本周期内的条数}
+        self._suppressed = {}  # {调用位置: [本周期丢弃的条数, 最后一条被丢弃的记录]}
+        self.pending_summaries = []  # 上个周期的汇总记录，等待处理器入队
+        self.suppressed_total = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or self.burst <= 0:
+            return True
+        site = (record.name, record.pathname, record.lineno)
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window_start >= self.interval:
+                self._close_window()
+                self._window_start = now
+            count = self._counts.get(site, 0) + 1
+            self._counts[site] = count
+            if count <= self.burst:
+                return True
+            entry = self._suppressed.get(site)
+            if entry is None:
+                self._suppressed[site] = [1, record]
+            else:
+                entry[0] += 1
+                entry[1] = record
+            self.suppressed_total += 1
+            return False
+
+    def _close_window(self):
+        """周期结束：为每个被限流的调用位置生成一条汇总记录（调用方需持有 _lock）"""
+        for (name, pathname, lineno), (count, last_record) in self._suppressed.items():
+            self.pending_summaries.append(logging.LogRecord(
+                name, last_record.levelno, pathname, lineno,
+                "Suppressed %d similar log lines in the last %.1fs, last one: %s",
+                (count, self.interval, last_record.getMessage()), None
+            ))
+        self._counts = {}
+        self._suppressed = {}
+
+    def flush(self, force: bool = False):
+        """周期已结束（或 force）时结束当前窗口，生成的汇总通过 take_summaries 取出"""
+        with self._lock:
+            now = time.monotonic()
+            if force or now - self._window_start >= self.interval:
+                self._close_window()
+                self._window_start = now
+
+    def take_summaries(self) -> list:
+        with self._lock:
+            summaries = self.pending_summaries
+            self.pending_summaries = []
+        return summaries
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """只入队不格式化的 QueueHandler：格式化推迟到监听线程中的处理器"""
+
+    def __init__(self, log_queue, sampler: SamplingFilter = None):
+        super().__init__(log_queue)
+        self.sampler = sampler
+        if sampler is not None:
+            self.addFilter(sampler)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def handle(self, record: logging.LogRecord):
+        result = super().handle(record)
+        if self.sampler is not None and self.sampler.pending_summaries:
+            for summary in self.sampler.take_summaries():
+                self.enqueue(summary)
+        return result
+
+
+class SamplingQueueListener(logging.handlers.QueueListener):
+    """队列空闲超过一个采样周期时结束限流窗口，直接输出汇总记录"""
+
+    def __init__(self, log_queue, *handlers, sampler: SamplingFilter, respect_handler_level=False):
+        super().__init__(log_queue, *handlers, respect_handler_level=respect_handler_level)
+        self.sampler = sampler
+
+    def dequeue(self, block):
+        if not block:
+            return self.queue.get(block)
+        while True:
+            try:
+                return self.queue.get(timeout=self.sampler.interval)
+            except queue.Empty:
+                self.sampler.flush()
+                for summary in self.sampler.take_summaries():
+                    self.handle(summary)
+
+
+def start_async_logging(sample_interval: float = 1.0, sample_burst: int = 0) -> SamplingQueueListener:
+    """把根 logger 的处理器移到后台监听线程，返回 QueueListener"""
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    log_queue = queue.SimpleQueue()
+    sampler = SamplingFilter(sample_interval, sample_burst)
+    queue_handler = DeferredQueueHandler(log_queue, sampler)
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    listener = SamplingQueueListener(log_queue, *handlers, sampler=sampler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def stop_async_logging(listener: SamplingQueueListener):
+    """输出当前窗口的限流汇总，写完队列中剩余的日志，并把处理器还给根 logger"""
+    root = logging.getLogger()
+    listener.sampler.flush(force=True)
+    for summary in listener.sampler.take_summaries():
+        listener.queue.put_nowait(summary)
+    listener.stop()
+    for handler in list(root.handlers):
+        if isinstance(handler, DeferredQueueHandler):
+            root.removeHandler(handler)
+    for handler in listener.handlers:
+        root.addHandler(handler)
+
+
+def get_sampling_stats():
+    """获取当前日志限流统计"""
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, DeferredQueueHandler) and handler.sampler is not None:
+            return {
+                'enabled': True,
+                'interval': handler.sampler.interval,
+                'burst': handler.sampler.burst,
+                'suppressed': handler.sampler.suppressed_total
+            }
+    return {'enabled': False}
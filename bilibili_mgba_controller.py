@@ -19,38 +19,56 @@ import asyncio
 import http.cookies
 import logging
 import os
-import queue
 import random
 import threading
 import time
 from datetime import datetime, timedelta
 from typing import Optional
 import json
-from collections import deque
+from collections import deque, OrderedDict
+from dataclasses import dataclass
 import csv
 import websockets
 import struct
 import zlib
 import hashlib
+import io
+import itertools
 import re
 import requests
 import qrcode
 from io import BytesIO
 import base64
+import bisect
 import subprocess
 import platform
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import aiohttp
+from aiohttp import web
 import blivedm
 import blivedm.models.web as web_models
 import blivedm.models.open_live as open_models
-import pyautogui
-import win32api
-import win32con
-import win32gui
-import win32process
+try:
+    import pyautogui
+    import win32api
+    import win32con
+    import win32gui
+    import win32process
+except ImportError:  # 非 Windows 桌面环境只能在配置中选择 socket 或 recording 按键后端
+    pyautogui = None
+    win32api = None
+    win32con = None
+    win32gui = None
+    win32process = None
 from flask import Flask, render_template, jsonify, request, Response
 
+from danmaku_archive import ArchiveReader, ArchiveWriter, DanmakuQuery, parse_timestamp
+from input_backends import TimingProfile, compile_schedule, create_input_backend
+from metrics import LatencyTracer, MetricsRegistry
+from async_logging import get_sampling_stats, start_async_logging, stop_async_logging
+
 # 配置日志
 logging.basicConfig(
     level=logging.INFO,
@@ -74,6 +92,32 @@ DOUYIN_WEBSOCKET_PORT = None
 DOUYIN_ENABLED = None
 VOTING_ENABLED = None
 BLOCKED_WORDS = []
+INGEST_QUEUE_SIZE = 2000  # 弹幕接收队列容量
+INGEST_QUEUE_POLICY = 'drop_oldest'  # 队列满时的背压策略：drop_oldest 或 coalesce
+DANMAKU_WRITE_BEHIND = False  # 弹幕CSV是否使用后台批量写盘（默认每行立即写盘）
+DANMAKU_FLUSH_ROWS = 500  # 缓冲多少行后写盘
+DANMAKU_FLUSH_INTERVAL = 1.0  # 最长多少秒写盘一次
+DANMAKU_LOG_BACKEND = 'csv'  # 弹幕保存方式：csv 每1000条一个CSV文件，archive 按天分段的压缩归档
+RUNTIME_MODE = 'threads'  # 后台任务运行方式：threads 每个任务一个线程，asyncio 单事件循环
+WEB_SERVER_MODE = 'flask'  # Web服务器：flask 每个连接一个线程，aiohttp 在主事件循环上用协程处理
+WEB_SERVER_PORT = 5000  # Web服务器端口
+INPUT_BACKEND = 'pyautogui'  # 按键注入后端：pyautogui、win32、socket（mGBA 脚本端口）或 recording（只记录不注入）
+INPUT_PYAUTOGUI_PAUSE = 0.1  # pyautogui 每次调用后的暂停时间
+INPUT_SIMULATE_TIMING = True  # recording 后端是否真实等待按键时长
+INPUT_SOCKET_HOST = '127.0.0.1'  # socket 后端：mgba_input_server.lua 所在主机
+INPUT_SOCKET_PORT = 8888  # socket 后端：mgba_input_server.lua 监听的端口
+INPUT_TIMING_PROFILES = {}  # 覆盖默认按键时序，格式同 DEFAULT_TIMING_PROFILES
+ANARCHY_COALESCE = False  # 自由模式执行期间到达的指令是否合并计票（默认与原来一样直接丢弃）
+ANARCHY_GROUP_BY = 'command'  # 合并计票方式：command 按完整指令，direction 先按方向汇总
+LATENCY_TRACING = True  # 是否记录弹幕从接收到按键松开的各阶段延迟
+LOG_ASYNC = False  # 是否在后台线程中格式化和输出日志
+LOG_SAMPLE_INTERVAL = 1.0  # 日志限流周期（秒）
+LOG_SAMPLE_BURST = 0  # 同一行 INFO 日志每个周期最多输出的条数（0 表示不限流）
+SSE_RING_SIZE = 1024  # SSE广播环形缓冲区容量（帧）
+SSE_HEARTBEAT_INTERVAL = 30  # SSE心跳间隔（秒）
+SSE_MAX_LAG = 512  # SSE客户端最多落后的帧数
+SSE_SLOW_CLIENT_POLICY = 'skip'  # 客户端落后过多时：skip 跳到最新帧，evict 断开
+SSE_STALL_TIMEOUT = 120  # SSE客户端超过多少秒没有读取则断开
 
 # 时间文件
 TIME_FILE = "start_time.txt"
@@ -116,12 +160,218 @@ KEY_TO_DISPLAY = {
     'backspace': 'Select'
 }
 
-# 设置 pyautogui 的暂停时间
-pyautogui.PAUSE = 0.1
+# 普通指令（default）和奔跑指令（run）的默认按键时序（秒）：hold 按住时长，gap 松开到下一次按下的间隔，
+# keys 按键名单独覆盖（如 "keys": {"enter": {"hold": 0.05}} 让开始键按得更快）。
+# 默认值与原来的 pyautogui 实现一致：keyDown 后停顿 PAUSE 0.1 秒再按住 0.1 秒，keyUp 后停顿 0.1 秒
+DEFAULT_TIMING_PROFILES = {
+    'default': {'hold': 0.2, 'gap': 0.1},
+    'run': {'hold': 0.2, 'gap': 0.1}
+}
+
+# 投票指令到投票类型的映射
+VOTE_COMMANDS = {
+    '自由模式': '自由',
+    '自由': '自由',
+    'anarchy': '自由',
+    'freedom': '自由',
+    'free': '自由',
+    '秩序模式': '秩序',
+    '秩序': '秩序',
+    'democracy': '秩序',
+    'order': '秩序'
+}
+
+# 奔跑指令只允许移动键 i(上), j(左), k(下), l(右)
+RUN_MOVE_COMMANDS = ('i', 'j', 'k', 'l')
+# 只能单独使用且不能带次数的指令
+SINGLE_ONLY_COMMANDS = ('start', '开始', 'select', '选择')
+MAX_SUB_COMMANDS = 3  # 组合指令最多包含的子指令数量
+MAX_REPEAT_COUNT = 3  # 子指令最大重复次数
+COMMAND_CACHE_SIZE = 4096  # 解析结果LRU缓存容量
+
+
+@dataclass(frozen=True)
+class ParsedCommand:
+    """解析后的弹幕指令（不可变），解析一次后由各执行器直接使用"""
+    raw: str  # 去除首尾空白的原始弹幕，用于CSV记录和日志
+    kind: str  # 'key' 普通指令, 'run' 奔跑指令, 'vote' 投票, 'rejected' 格式非法, 'unknown' 无法识别
+    steps: tuple = ()  # 按键序列 ((key, repeat_count), ...)
+    display: str = ''  # 前端显示文本
+    vote_type: Optional[str] = None  # 投票类型："自由" 或 "秩序"
+    reason: str = ''  # 被拒绝的原因
+
+    @property
+    def is_run(self) -> bool:
+        return self.kind == 'run'
+
+class CommandGrammar:
+    """弹幕指令语法，把原始文本一次性解析为 ParsedCommand
+
+    支持组合指令如 a3+b3+i2 或 a3 b3 i2（优先按 '+' 分割，最多3个子指令），
+    奔跑指令如 r i3 j2 / r+i3 / ri3 / run i3 / 跑 i3，以及模式投票。
+    """
+    # 奔跑前缀：run/跑 后必须跟空格或'+'，r 后可以直接跟空格、'+'、移动键或数字
+    RUN_PREFIX_PATTERN = re.compile(r'(?:run|跑)(?=[ +])|r(?=[ +0-9ijkl])')
+
+    def __init__(self, cache_size: int = COMMAND_CACHE_SIZE):
+        # 解析耗时统计，用于衡量热路径上的解析成本
+        self.parse_count = 0
+        self.parse_time_ns = 0
+        
+        # 解析结果LRU缓存：弹幕大多是少量重复的字符串（a、i3、r+l2、秩序），命中时只需一次字典查找
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache = OrderedDict()  # {去除首尾空白的弹幕: ParsedCommand}
+        self._cache_lock = threading.Lock()
+
+    def parse(self, text: str) -> ParsedCommand:
+        """解析弹幕文本，优先从LRU缓存中返回已解析的结果"""
+        started = time.perf_counter_ns()
+        cache_key = text.strip()
+        try:
+            with self._cache_lock:
+                parsed = self._cache.get(cache_key)
+                if parsed is not None:
+                    self._cache.move_to_end(cache_key)
+                    self.cache_hits += 1
+                    return parsed
+            
+            parsed = self._parse(cache_key)
+            with self._cache_lock:
+                self.cache_misses += 1
+                self._cache[cache_key] = parsed
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)  # 淘汰最久未使用的结果
+            return parsed
+        finally:
+            self.parse_count += 1
+            self.parse_time_ns += time.perf_counter_ns() - started
+
+    def get_stats(self) -> dict:
+        """获取解析和缓存统计信息"""
+        count = self.parse_count
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            'parse_count': count,
+            'parse_time_ms': round(self.parse_time_ns / 1e6, 3),
+            'avg_parse_us': round(self.parse_time_ns / count / 1e3, 3) if count else 0.0,
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+            'cache_hit_rate': round(self.cache_hits / lookups, 4) if lookups else 0.0,
+            'cache_entries': len(self._cache),
+            'cache_size': self.cache_size
+        }
+
+    @staticmethod
+    def _split_sub_commands(text: str) -> list:
+        """按 '+' 或空格切分子指令（全部切开，数量上限由调用方检查）"""
+        separator = '+' if '+' in text else ' '
+        parts = text.split(separator)
+        return [part.strip() for part in parts if part.strip()]
+
+    @staticmethod
+    def _split_repeat(sub_cmd: str):
+        """把子指令拆成 (基础指令, 重复次数)，次数超出范围时返回 None"""
+        base_command = sub_cmd.rstrip('0123456789')
+        digit_part = sub_cmd[len(base_command):]
+        if not digit_part:
+            return base_command, 1
+        repeat_count = int(digit_part)
+        if repeat_count < 1 or repeat_count > MAX_REPEAT_COUNT:
+            return base_command, None
+        return base_command, repeat_count
+
+    @staticmethod
+    def _display_step(base_command: str, repeat_count: int) -> str:
+        key = COMMAND_TO_KEY[base_command]
+        display_cmd = KEY_TO_DISPLAY.get(key, base_command)
+        if repeat_count > 1:
+            display_cmd += str(repeat_count)
+        return display_cmd
+
+    def _parse(self, text: str) -> ParsedCommand:
+        raw = text.strip()
+        command_lower = raw.lower()
+
+        if command_lower in VOTE_COMMANDS:
+            vote_type = VOTE_COMMANDS[command_lower]
+            return ParsedCommand(raw, 'vote', display=f" {vote_type}", vote_type=vote_type)
+
+        sub_commands = self._split_sub_commands(command_lower)
+        if not sub_commands:
+            return ParsedCommand(raw, 'unknown')
+
+        # 首个子指令本身是合法按键（如 right2）时不按奔跑指令处理
+        first_base = sub_commands[0].rstrip('0123456789')
+        match = self.RUN_PREFIX_PATTERN.match(command_lower)
+        if match and first_base not in COMMAND_TO_KEY:
+            run_part = command_lower[match.end():]
+            if run_part.startswith('+'):
+                run_part = run_part[1:]
+            return self._parse_run(raw, run_part.strip())
+
+        return self._parse_keys(raw, sub_commands)
+
+    def _parse_run(self, raw: str, run_part: str) -> ParsedCommand:
+        """解析奔跑指令，子指令只能包含 i,j,k,l 和数字"""
+        steps = []
+        display_commands = []
+        for sub_cmd in self._split_sub_commands(run_part):
+            base_command, repeat_count = self._split_repeat(sub_cmd)
+            if base_command not in RUN_MOVE_COMMANDS:
+                return ParsedCommand(raw, 'rejected', reason=f"Invalid run command format: {raw}. Run commands can only contain i,j,k,l and numbers.")
+            if repeat_count is None:
+                logger.warning("Run command number out of range (1-%s), ignored: %s", MAX_REPEAT_COUNT, sub_cmd)
+                continue
+            steps.append((COMMAND_TO_KEY[base_command], repeat_count))
+            display_commands.append(self._display_step(base_command, repeat_count))
+
+        if not steps:
+            return ParsedCommand(raw, 'rejected', reason=f"No valid movement commands in run command: {raw}")
+
+        # 统一使用R + 格式，+号前后加空格
+        display_command = 'R + ' + ' + '.join(display_commands)
+        return ParsedCommand(raw, 'run', steps=tuple(steps), display=display_command)
+
+    def _parse_keys(self, raw: str, sub_commands: list) -> ParsedCommand:
+        """解析普通（组合）指令，非法子指令被跳过，子指令超过 MAX_SUB_COMMANDS 个时整条拒绝"""
+        if len(sub_commands) > MAX_SUB_COMMANDS:
+            return ParsedCommand(raw, 'rejected', reason=f"Combination commands can contain at most {MAX_SUB_COMMANDS} sub-commands: {raw}")
+        steps = []
+        display_commands = []
+        for sub_cmd in sub_commands:
+            base_command, repeat_count = self._split_repeat(sub_cmd)
+            if repeat_count is None:
+                logger.warning("Command number out of range (1-%s), ignored: %s", MAX_REPEAT_COUNT, sub_cmd)
+                continue
+
+            if base_command in SINGLE_ONLY_COMMANDS:
+                if len(sub_commands) > 1:
+                    return ParsedCommand(raw, 'rejected', reason=f"Start/Select commands cannot be used in combination commands: {raw}")
+                if repeat_count > 1:
+                    return ParsedCommand(raw, 'rejected', reason=f"Start/Select commands cannot have numbers: {raw}")
+
+            if base_command in COMMAND_TO_KEY:
+                steps.append((COMMAND_TO_KEY[base_command], repeat_count))
+                display_commands.append(self._display_step(base_command, repeat_count))
+
+        if not steps:
+            return ParsedCommand(raw, 'unknown')
+
+        # 生成显示用的组合指令，在+号左右添加空格
+        return ParsedCommand(raw, 'key', steps=tuple(steps), display=' + '.join(display_commands))
+
+command_grammar = CommandGrammar()  # 全局指令语法实例
 
 class DanmakuSaver:
-    """弹幕保存管理类"""
-    def __init__(self, base_dir="danmaku"):
+    """弹幕保存管理类
+
+    默认每条弹幕写入后立即 flush；开启 write-behind 模式后，弹幕先写入内存缓冲区，
+    由后台线程在缓冲行数达到 flush_rows 或距上次写入超过 flush_interval 秒时批量写盘，
+    文件轮转和关闭时都会先把缓冲区写完。
+    """
+    def __init__(self, base_dir="danmaku", write_behind=False, flush_rows=500, flush_interval=1.0):
         self.base_dir = base_dir
         self.current_file = None
         self.current_count = 0
@@ -130,16 +380,52 @@ class DanmakuSaver:
         self.csv_writer = None
         self.csv_file_handle = None
         
+        # write-behind 模式
+        self.write_behind = write_behind
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self._buffer = []  # 待写入的行
+        self._buffer_lock = threading.Lock()  # 缓冲区锁
+        self._file_lock = threading.Lock()  # 文件句柄锁
+        self._flush_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._flusher_thread = None
+        
+        # 写入统计
+        self.rows_written = 0
+        self.bytes_written = 0
+        self.flush_count = 0
+        self.total_flush_time = 0.0
+        self.max_flush_time = 0.0
+        
         # 确保目录存在
         if not os.path.exists(self.base_dir):
             os.makedirs(self.base_dir)
             logger.info(f"Created directory: {self.base_dir}")
     
+    def configure(self, write_behind, flush_rows=500, flush_interval=1.0):
+        """设置写入模式，开启 write-behind 时启动后台写盘线程"""
+        self.flush_rows = max(1, int(flush_rows))
+        self.flush_interval = max(0.05, float(flush_interval))
+        if self.write_behind and not write_behind:
+            self.flush()
+        self.write_behind = write_behind
+        
+        if write_behind and self._flusher_thread is None:
+            self._stop_event.clear()
+            self._flusher_thread = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher_thread.start()
+            logger.info(f"Danmaku CSV write-behind enabled ({self.flush_rows} rows / {self.flush_interval}s)")
+    
     def _get_filename(self):
-        """生成文件名，格式：danmaku/20250826-1045-23.csv"""
+        """生成文件名，格式：danmaku/20250826-1045-23.csv，同一秒内轮转时追加序号"""
         now = datetime.now()
         base_name = now.strftime("%Y%m%d-%H%M-%S")
-        return os.path.join(self.base_dir, f"{base_name}.csv")
+        filename = os.path.join(self.base_dir, f"{base_name}.csv")
+        while os.path.exists(filename):
+            filename = os.path.join(self.base_dir, f"{base_name}-{self.file_counter}.csv")
+            self.file_counter += 1
+        return filename
     
     def _create_new_file(self):
         """创建新的CSV文件"""
@@ -154,25 +440,680 @@ class DanmakuSaver:
         self.current_count = 0
         logger.info(f"Created new CSV file: {self.current_file}")
     
+    def _write_rows(self, rows):
+        """写入一批弹幕并记录写盘统计"""
+        started = time.perf_counter()
+        bytes_written = self._write_batch(rows)
+        elapsed = time.perf_counter() - started
+        
+        self.rows_written += len(rows)
+        self.bytes_written += bytes_written
+        self.flush_count += 1
+        self.total_flush_time += elapsed
+        if elapsed > self.max_flush_time:
+            self.max_flush_time = elapsed
+    
+    def _write_batch(self, rows):
+        """把若干行写入CSV文件并刷新到磁盘，写满 max_count 行时轮转文件，返回写入的字节数"""
+        bytes_written = 0
+        with self._file_lock:
+            index = 0
+            while index < len(rows):
+                # 如果需要创建新文件
+                if self.current_count >= self.max_count or self.csv_writer is None:
+                    self._create_new_file()
+                
+                chunk = rows[index:index + self.max_count - self.current_count]
+                chunk_buffer = io.StringIO()
+                csv.writer(chunk_buffer).writerows(chunk)
+                text = chunk_buffer.getvalue()
+                self.csv_file_handle.write(text)
+                
+                self.current_count += len(chunk)
+                bytes_written += len(text.encode('utf-8'))
+                index += len(chunk)
+            
+            self.csv_file_handle.flush()  # 写入磁盘
+        return bytes_written
+    
     def save_danmaku(self, timestamp, username, command, executed, platform="哔哩哔哩"):
         """保存弹幕数据到CSV文件"""
-        # 如果需要创建新文件
-        if self.current_count >= self.max_count or self.csv_writer is None:
-            self._create_new_file()
-        
         # 写入数据：时间戳，用户名，指令内容，是否执行，平台
         row = [timestamp, username, command, executed, platform]
-        self.csv_writer.writerow(row)
-        self.csv_file_handle.flush()  # 立即写入磁盘
-        self.current_count += 1
         
-        logger.debug(f"Saved danmaku to CSV: {row}")
+        if self.write_behind:
+            # 只写入缓冲区，由后台线程批量写盘
+            with self._buffer_lock:
+                self._buffer.append(row)
+                pending = len(self._buffer)
+            if pending >= self.flush_rows:
+                self._flush_event.set()
+        else:
+            self._write_rows([row])  # 立即写入磁盘
+        
+        logger.debug("Saved danmaku to CSV: %s", row)
+    
+    def flush(self):
+        """把缓冲区中的所有弹幕写入磁盘"""
+        with self._buffer_lock:
+            rows = self._buffer
+            self._buffer = []
+        if rows:
+            self._write_rows(rows)
+    
+    def _flush_loop(self):
+        """后台写盘线程：缓冲行数达到阈值或超时后批量写入"""
+        while not self._stop_event.is_set():
+            self._flush_event.wait(self.flush_interval)
+            self._flush_event.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush danmaku CSV buffer: {e}")
+    
+    def get_stats(self):
+        """获取写入统计信息"""
+        with self._buffer_lock:
+            pending = len(self._buffer)
+        flushes = self.flush_count
+        return {
+            'write_behind': self.write_behind,
+            'current_file': self.current_file,
+            'pending_rows': pending,
+            'rows_written': self.rows_written,
+            'bytes_written': self.bytes_written,
+            'flush_count': flushes,
+            'avg_flush_ms': round(self.total_flush_time / flushes * 1000, 3) if flushes else 0.0,
+            'max_flush_ms': round(self.max_flush_time * 1000, 3)
+        }
     
     def close(self):
-        """关闭文件句柄"""
-        if self.csv_file_handle:
-            self.csv_file_handle.close()
-            logger.info(f"Closed CSV file: {self.current_file}")
+        """写完缓冲区并关闭文件句柄"""
+        self._stop_event.set()
+        self._flush_event.set()
+        if self._flusher_thread is not None:
+            self._flusher_thread.join(timeout=5)
+            self._flusher_thread = None
+        
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"Failed to flush danmaku CSV buffer on close: {e}")
+        
+        with self._file_lock:
+            if self.csv_file_handle:
+                self.csv_file_handle.close()
+                self.csv_file_handle = None
+                self.csv_writer = None
+                logger.info(f"Closed CSV file: {self.current_file}")
+
+class DanmakuArchiveSaver(DanmakuSaver):
+    """弹幕归档保存类：接口与 DanmakuSaver 相同，数据写入按天分段的压缩归档（见 danmaku_archive.py）
+
+    每次批量写盘生成归档中的一个压缩块，逐条写入会让压缩失效，因此总是使用 write-behind 模式。
+    """
+    def __init__(self, base_dir="danmaku", max_segment_mb=256):
+        super().__init__(base_dir, write_behind=True)
+        self.archive_writer = ArchiveWriter(os.path.join(base_dir, 'archive'),
+                                            max_segment_bytes=int(max_segment_mb * 1024 * 1024))
+    
+    def configure(self, write_behind, flush_rows=500, flush_interval=1.0):
+        super().configure(True, flush_rows, flush_interval)
+    
+    def _write_batch(self, rows):
+        """把一批弹幕写成一个压缩块，返回压缩后的字节数"""
+        compressed_before = self.archive_writer.compressed_bytes
+        self.archive_writer.write_block([[parse_timestamp(row[0])] + row for row in rows])
+        return self.archive_writer.compressed_bytes - compressed_before
+    
+    def get_stats(self):
+        stats = super().get_stats()
+        stats.update(self.archive_writer.get_stats())
+        stats['current_file'] = self.archive_writer.current_segment
+        return stats
+    
+    def close(self):
+        super().close()
+        self.archive_writer.close()
+
+class DanmakuIngestQueue:
+    """弹幕接收队列：网络协程只负责入队，由单独的消费线程调用 process_danmaku_command
+
+    队列基于 deque 的原子 append/popleft 实现，入队不加锁；队列满时按策略丢弃：
+    - drop_oldest：丢弃最早的弹幕
+    - coalesce：新弹幕与队尾弹幕来自同一平台且内容相同时直接合并丢弃，否则丢弃最早的弹幕
+    """
+    POLICIES = ('drop_oldest', 'coalesce')
+
+    def __init__(self, max_size=2000, policy='drop_oldest'):
+        self.max_size = max_size
+        self.policy = policy
+        self._queue = deque()  # 元素：(接收时间戳, 平台, 用户名, 弹幕内容, 延迟追踪)
+        self._wakeup = threading.Event()
+        self._async_wakeup = None  # asyncio 运行时使用的唤醒事件
+        self._loop = None
+        
+        # 队列统计
+        self.enqueued_count = 0
+        self.processed_count = 0
+        self.dropped_count = 0
+        self.coalesced_count = 0
+        self.max_depth = 0
+        self.total_wait_time = 0.0  # 累计排队时间（秒）
+    
+    def configure(self, max_size, policy):
+        """更新队列容量和背压策略"""
+        if policy not in self.POLICIES:
+            logger.warning(f"Unknown ingest queue policy '{policy}', using drop_oldest")
+            policy = 'drop_oldest'
+        self.max_size = max(1, int(max_size))
+        self.policy = policy
+    
+    def put(self, username, text, platform="哔哩哔哩", trace=None):
+        """接收端调用：只入队，不做任何处理"""
+        danmaku_received_counter.inc(platform)
+        if len(self._queue) >= self.max_size:
+            if self.policy == 'coalesce':
+                try:
+                    _, last_platform, _, last_text, _ = self._queue[-1]
+                    if last_platform == platform and last_text == text:
+                        self.coalesced_count += 1
+                        return
+                except IndexError:
+                    pass
+            try:
+                self._queue.popleft()
+                self.dropped_count += 1
+            except IndexError:
+                pass
+        
+        self._queue.append((time.time(), platform, username, text, trace))
+        self.enqueued_count += 1
+        depth = len(self._queue)
+        if depth > self.max_depth:
+            self.max_depth = depth
+        if self._loop is not None:
+            # 接收端可能运行在其他线程，asyncio.Event 只能在所属事件循环中设置
+            self._loop.call_soon_threadsafe(self._async_wakeup.set)
+        else:
+            self._wakeup.set()
+    
+    def _process_pending(self, max_items=None):
+        """依次取出并处理队列中的弹幕，返回处理的条数"""
+        handled = 0
+        while max_items is None or handled < max_items:
+            try:
+                received_at, platform, username, text, trace = self._queue.popleft()
+            except IndexError:
+                break
+            if trace:
+                trace.mark('ingest_wait')
+            
+            self.total_wait_time += time.time() - received_at
+            self.processed_count += 1
+            handled += 1
+            try:
+                process_danmaku_command(username, text, platform=platform, trace=trace)
+            except Exception as e:
+                logger.error("Error processing danmaku from %s: %s", platform, e)
+            # 没有交给执行器的弹幕在此结束追踪
+            if trace and not trace.handed_off:
+                trace.mark('processed')
+                latency_tracer.record(trace)
+        return handled
+    
+    def run(self):
+        """消费线程：依次取出弹幕并处理"""
+        logger.info("Danmaku ingest consumer thread started")
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            self._process_pending()
+    
+    async def run_async(self, executor: ThreadPoolExecutor):
+        """asyncio 运行时的消费任务：put 可以在任意线程调用，通过 call_soon_threadsafe 唤醒
+
+        process_danmaku_command 会等待 mode_lock 等线程锁，关闭写后缓冲时还会同步写 CSV，
+        因此每批弹幕交给单线程的 executor 处理，不在事件循环上执行，网络接收和心跳不受影响。
+        """
+        self._async_wakeup = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        # 任务启动前已经入队的弹幕只唤醒过线程事件，这里先处理一轮
+        self._async_wakeup.set()
+        logger.info("Danmaku ingest consumer task started")
+        while True:
+            await self._async_wakeup.wait()
+            self._async_wakeup.clear()
+            while await self._loop.run_in_executor(executor, self._process_pending, 50):
+                pass
+    
+    def get_stats(self):
+        """获取队列统计信息"""
+        processed = self.processed_count
+        return {
+            'depth': len(self._queue),
+            'max_depth': self.max_depth,
+            'max_size': self.max_size,
+            'policy': self.policy,
+            'enqueued': self.enqueued_count,
+            'processed': processed,
+            'dropped': self.dropped_count,
+            'coalesced': self.coalesced_count,
+            'avg_wait_ms': round(self.total_wait_time / processed * 1000, 3) if processed else 0.0
+        }
+
+WS_CHANNELS = ('danmaku', 'votes', 'democracy', 'status')  # WebSocket 可订阅的频道
+
+def _compact_mode(mode_info):
+    """模式信息压缩为 [是否秩序模式, 自由支持率]"""
+    return [1 if mode_info.get('current_mode') == '秩序' else 0, mode_info.get('freedom_support')]
+
+def compact_event(message):
+    """把广播消息转换为 WebSocket 紧凑格式（短键名），返回 (频道, 紧凑消息)
+
+    m 弹幕 {u 用户名, c 指令, ts 时间戳}；v 投票 {m 模式, w 是否切换, s 是否抖动, r 重置消息}；
+    D 投票快照 {q 序号, c 指令列表, l 剩余时间}；x 投票增量 {q, b 基线序号, c 变化, o 排名}；
+    h 心跳 {r 运行时间, g 游戏时长, m 模式, q, c, l}
+    """
+    kind = message.get('type')
+    if kind is None:
+        return 'danmaku', {'t': 'm', 'u': message.get('username'), 'c': message.get('command'), 'ts': round(message.get('timestamp', 0), 3)}
+    if kind == 'vote_update':
+        compact = {'t': 'v', 'm': _compact_mode(message['mode_info']), 'w': int(bool(message.get('mode_switched'))), 's': int(bool(message.get('should_shake')))}
+        if message.get('reset_message'):
+            compact['r'] = message['reset_message']
+        return 'votes', compact
+    if kind == 'democracy_update':
+        info = message['democracy_info']
+        return 'democracy', {'t': 'D', 'q': message.get('seq'), 'c': info.get('commands', []), 'l': round(info.get('time_left', 0), 1)}
+    if kind == 'democracy_delta':
+        compact = {'t': 'x', 'q': message['seq'], 'b': message['base'], 'c': message['changed']}
+        if 'order' in message:
+            compact['o'] = message['order']
+        return 'democracy', compact
+    if kind == 'heartbeat':
+        compact = {'t': 'h', 'r': message.get('runtime'), 'g': message.get('game_duration'), 'm': _compact_mode(message['mode_info']), 'q': message.get('democracy_seq')}
+        info = message.get('democracy_info')
+        if info:
+            compact['c'] = info.get('commands', [])
+            compact['l'] = round(info.get('time_left', 0), 1)
+        return 'status', compact
+    return 'status', message
+
+def encode_compact(compact) -> str:
+    """紧凑 JSON：无空白，中文不转义"""
+    return json.dumps(compact, ensure_ascii=False, separators=(',', ':'))
+
+class SSEBroadcaster:
+    """SSE 广播器：每条事件只序列化一次为 data 帧，写入共享环形缓冲区，各客户端按自己的游标读取
+
+    每帧带有单调递增的事件 ID（以启动时的毫秒时间戳为起点，重启后不会回退），
+    重连时按 Last-Event-ID 从环形缓冲区补发断开期间的事件。
+    发布只在追加帧时短暂持锁，客户端在锁外 yield，慢客户端不会阻塞发布方。
+    客户端落后超过 max_lag 帧时按策略处理：
+    - skip：跳过旧帧，直接读取最新的 max_lag 帧
+    - evict：断开该客户端（浏览器会自动重连）
+    超过 stall_timeout 秒没有读取的客户端（如卡住的 OBS 浏览器源）会被移出客户端表并断开。
+    """
+    POLICIES = ('skip', 'evict')
+    
+    def __init__(self, capacity=1024, max_lag=512, policy='skip', stall_timeout=120):
+        self._cond = threading.Condition()
+        self._ring = deque(maxlen=capacity)  # 元素：[序号, SSE帧, 原始消息, WebSocket紧凑帧（首次读取时生成）]
+        self._seq = int(time.time() * 1000)  # 最新一帧的序号（即事件 ID）
+        self._clients = {}  # {客户端编号: 客户端状态}
+        self._next_client_id = 1
+        self._last_sweep = time.time()
+        self._async_loop = None  # 异步 Web 服务器的事件循环
+        self._async_event = None
+        self.max_lag = max_lag
+        self.policy = policy
+        self.stall_timeout = stall_timeout
+        
+        # 广播统计
+        self.published_count = 0
+        self.published_bytes = 0
+        self.skipped_count = 0  # 慢客户端跳过的帧数
+        self.evicted_count = 0
+    
+    @property
+    def clients(self):
+        return len(self._clients)
+    
+    def configure(self, capacity, max_lag, policy, stall_timeout):
+        """更新缓冲区容量和慢客户端策略"""
+        if policy not in self.POLICIES:
+            logger.warning(f"Unknown SSE slow client policy '{policy}', using skip")
+            policy = 'skip'
+        with self._cond:
+            capacity = max(1, int(capacity))
+            self._ring = deque(self._ring, maxlen=capacity)
+            self.max_lag = max(1, min(int(max_lag), capacity))
+            self.policy = policy
+            self.stall_timeout = stall_timeout
+    
+    @staticmethod
+    def encode(message) -> bytes:
+        """把消息序列化为 SSE data 帧（不带事件 ID，用于单个客户端的快照和心跳）"""
+        return f"data: {json.dumps(message)}\n\n".encode('utf-8')
+    
+    def publish(self, message) -> int:
+        """序列化并追加一帧，唤醒所有等待的客户端，返回该帧的事件 ID"""
+        data = self.encode(message)
+        with self._cond:
+            self._seq += 1
+            frame = b'id: %d\n' % self._seq + data
+            self._ring.append([self._seq, frame, message, None])
+            self.published_count += 1
+            self.published_bytes += len(frame)
+            self._sweep_stalled()
+            self._cond.notify_all()
+            if self._async_loop is not None:
+                self._async_loop.call_soon_threadsafe(self._wake_async)
+            return self._seq
+    
+    def connect(self, remote=None, last_event_id=None) -> dict:
+        """注册客户端，返回客户端状态
+
+        last_event_id 仍在环形缓冲区范围内时从它之后续传（client['resumed'] 为 True），
+        否则只接收之后发布的帧。
+        """
+        with self._cond:
+            now = time.time()
+            cursor = self._seq
+            resumed = False
+            if last_event_id is not None and self._ring and self._ring[0][0] - 1 <= last_event_id <= self._seq:
+                cursor = last_event_id
+                resumed = True
+            client = {
+                'id': self._next_client_id,
+                'remote': remote,
+                'connected_at': now,
+                'last_read': now,
+                'cursor': cursor,
+                'resumed': resumed,
+                'delivered': 0,
+                'skipped': 0,
+                'evicted': False
+            }
+            self._next_client_id += 1
+            self._clients[client['id']] = client
+            return client
+    
+    def disconnect(self, client: dict):
+        with self._cond:
+            self._clients.pop(client['id'], None)
+    
+    def _evict(self, client: dict, reason: str):
+        """断开客户端，调用方需持有锁"""
+        client['evicted'] = True
+        self._clients.pop(client['id'], None)
+        self.evicted_count += 1
+        logger.warning("Evicted SSE client %s (%s): %s", client['id'], client['remote'], reason)
+    
+    def _sweep_stalled(self):
+        """每秒最多检查一次长时间没有读取的客户端，调用方需持有锁"""
+        now = time.time()
+        if now - self._last_sweep < 1:
+            return
+        self._last_sweep = now
+        for client in list(self._clients.values()):
+            if now - client['last_read'] > self.stall_timeout:
+                self._evict(client, f"no read for {now - client['last_read']:.0f}s")
+    
+    def _take_entries(self, client: dict):
+        """取出客户端游标之后的缓冲区元素并前移游标，没有新帧或客户端被断开时返回 None，调用方需持有锁"""
+        client['last_read'] = time.time()
+        if client['evicted'] or self._seq <= client['cursor']:
+            return None
+        
+        cursor = client['cursor']
+        lag = self._seq - cursor
+        if lag > self.max_lag:
+            if self.policy == 'evict':
+                self._evict(client, f"{lag} frames behind")
+                return None
+            skip = lag - self.max_lag
+            client['skipped'] += skip
+            self.skipped_count += skip
+            cursor += skip
+        
+        start = len(self._ring) - (self._seq - cursor)
+        entries = list(itertools.islice(self._ring, start, None))
+        client['delivered'] += len(entries)
+        client['cursor'] = self._seq
+        return entries
+    
+    def _take_frames(self, client: dict):
+        """取出客户端游标之后的SSE帧并拼接，调用方需持有锁"""
+        entries = self._take_entries(client)
+        return b''.join(entry[1] for entry in entries) if entries else None
+    
+    def _take_compact(self, client: dict, channels):
+        """取出客户端游标之后、属于订阅频道的紧凑帧，调用方需持有锁"""
+        entries = self._take_entries(client)
+        if not entries:
+            return None
+        frames = []
+        for entry in entries:
+            if entry[3] is None:
+                channel, compact = compact_event(entry[2])
+                entry[3] = (channel, encode_compact(compact))
+            if entry[3][0] in channels:
+                frames.append(entry[3][1])
+        return frames
+    
+    def read(self, client: dict, timeout: float):
+        """等待客户端游标之后的新帧并返回拼接后的帧，超时或客户端被断开时返回 None"""
+        with self._cond:
+            client['last_read'] = time.time()
+            self._cond.wait_for(lambda: self._seq > client['cursor'] or client['evicted'], timeout)
+            return self._take_frames(client)
+    
+    def attach_loop(self, loop: asyncio.AbstractEventLoop):
+        """启用协程读取：发布新帧时在该事件循环上唤醒 read_async 的等待者"""
+        self._async_loop = loop
+        self._async_event = asyncio.Event()
+    
+    def _wake_async(self):
+        # 在事件循环线程中执行：唤醒当前所有等待者，后来的等待者使用新的事件
+        self._async_event.set()
+        self._async_event = asyncio.Event()
+    
+    async def read_async(self, client: dict, timeout: float):
+        """read 的协程版本，等待时不占用线程"""
+        return await self._read_async(client, timeout, self._take_frames)
+    
+    async def read_compact_async(self, client: dict, timeout: float, channels):
+        """WebSocket 客户端读取：返回订阅频道的紧凑帧列表，超时或客户端被断开时返回 None"""
+        return await self._read_async(client, timeout, lambda client: self._take_compact(client, channels))
+    
+    async def _read_async(self, client: dict, timeout: float, take):
+        with self._cond:
+            frames = take(client)
+        if frames is not None or client['evicted']:
+            return frames
+        
+        # 取出事件和等待之间没有让出事件循环，发布方的唤醒回调只会在等待开始后执行
+        event = self._async_event
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        with self._cond:
+            return take(client)
+    
+    def get_stats(self):
+        """获取广播统计信息，包括每个客户端的延迟"""
+        with self._cond:
+            now = time.time()
+            return {
+                'clients': len(self._clients),
+                'seq': self._seq,
+                'buffered': len(self._ring),
+                'capacity': self._ring.maxlen,
+                'max_lag': self.max_lag,
+                'policy': self.policy,
+                'published': self.published_count,
+                'published_bytes': self.published_bytes,
+                'skipped': self.skipped_count,
+                'evicted': self.evicted_count,
+                'client_details': [
+                    {
+                        'id': client['id'],
+                        'remote': client['remote'],
+                        'connected_seconds': round(now - client['connected_at'], 1),
+                        'lag_frames': self._seq - client['cursor'],
+                        'idle_seconds': round(now - client['last_read'], 1),
+                        'delivered': client['delivered'],
+                        'skipped': client['skipped']
+                    }
+                    for client in self._clients.values()
+                ]
+            }
+
+class OrderTally:
+    """秩序模式增量计票：计数表加按票数分桶的索引，取前K名无需排序
+
+    每个桶按到达该票数的先后保存指令，票数相同时先到达的排在前面。
+    非空桶的票数另存为有序列表，取前K名只遍历非空桶，与最高票数无关；
+    不同票数的个数不超过 sqrt(2 * 总票数)，投票时维护有序列表的开销很小。
+    所有方法都需要调用方持有 order_lock。
+    """
+    def __init__(self):
+        self._entries = {}  # {stat_key: [count, parsed_command, display_command]}
+        self._buckets = {}  # {count: {stat_key: None}}，dict 保持插入顺序
+        self._counts = []  # 非空桶的票数，升序
+        self.total_votes = 0
+    
+    def __bool__(self):
+        return bool(self._entries)
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def add(self, stat_key: str, parsed: ParsedCommand) -> int:
+        """为指令加一票，返回新的票数"""
+        entry = self._entries.get(stat_key)
+        if entry is None:
+            entry = self._entries[stat_key] = [0, parsed, parsed.display]
+        else:
+            bucket = self._buckets[entry[0]]
+            del bucket[stat_key]
+            if not bucket:
+                del self._buckets[entry[0]]
+                del self._counts[bisect.bisect_left(self._counts, entry[0])]
+        
+        entry[0] += 1
+        self.total_votes += 1
+        bucket = self._buckets.get(entry[0])
+        if bucket is None:
+            bucket = self._buckets[entry[0]] = {}
+            bisect.insort(self._counts, entry[0])
+        bucket[stat_key] = None
+        return entry[0]
+    
+    def top(self, k: int) -> list:
+        """票数最高的前k个指令，返回 [(stat_key, count, parsed_command, display_command), ...]"""
+        result = []
+        for count in reversed(self._counts):
+            for stat_key in self._buckets[count]:
+                entry = self._entries[stat_key]
+                result.append((stat_key, entry[0], entry[1], entry[2]))
+                if len(result) >= k:
+                    return result
+        return result
+    
+    def winner(self):
+        """票数最高的指令，没有投票时返回 None"""
+        top = self.top(1)
+        return top[0] if top else None
+    
+    def clear(self):
+        self._entries.clear()
+        self._buckets.clear()
+        self._counts.clear()
+        self.total_votes = 0
+
+def command_stat_key(parsed: ParsedCommand) -> str:
+    """指令的计票key：奔跑指令和普通指令分开统计"""
+    if parsed.is_run:
+        # 奔跑指令：使用原始显示名称，但在统计中保持独立
+        return f"[RUN] {parsed.display}"
+    # 普通指令：直接使用显示名称
+    return parsed.display
+
+def command_direction_key(parsed: ParsedCommand) -> str:
+    """指令的方向分组key：第一个按键，奔跑指令单独分组"""
+    first_key = parsed.steps[0][0] if parsed.steps else parsed.display
+    return f"[RUN] {first_key}" if parsed.is_run else first_key
+
+class AnarchyCoalescer:
+    """自由模式指令合并：执行期间到达的指令计入当前窗口，执行结束后以得票最多的指令作为下一条指令
+
+    group_by 为 command 时按完整指令计票；为 direction 时先按第一个按键（方向）汇总，
+    再在得票最多的方向中选出最常见的完整指令。每条弹幕只做一次 O(1) 计票，窗口结束时才选出结果。
+    所有方法都需要调用方持有 latest_command_lock。
+    """
+    GROUP_MODES = ('command', 'direction')
+    
+    def __init__(self, group_by='command'):
+        self.group_by = group_by
+        self._tally = OrderTally()
+        self._directions = {}  # {方向分组key: 票数}
+        self._window_size = 0
+        
+        # 合并统计
+        self.window_count = 0  # 产生了合并结果的执行窗口数
+        self.coalesced_count = 0  # 被计入窗口的指令数
+        self.max_window_size = 0
+    
+    def configure(self, group_by):
+        if group_by not in self.GROUP_MODES:
+            logger.warning(f"Unknown anarchy group_by '{group_by}', using command")
+            group_by = 'command'
+        self.group_by = group_by
+        self.clear()
+    
+    def add(self, parsed: ParsedCommand):
+        """把执行期间到达的指令计入当前窗口"""
+        self._tally.add(command_stat_key(parsed), parsed)
+        if self.group_by == 'direction':
+            direction = command_direction_key(parsed)
+            self._directions[direction] = self._directions.get(direction, 0) + 1
+        self._window_size += 1
+        self.coalesced_count += 1
+    
+    def collect(self) -> Optional[ParsedCommand]:
+        """结束当前窗口，返回得票最多的指令（窗口为空时返回 None）"""
+        if not self._tally:
+            return None
+        if self.group_by == 'direction':
+            best_direction = max(self._directions, key=self._directions.get)
+            winner = next(entry for entry in self._tally.top(len(self._tally))
+                          if command_direction_key(entry[2]) == best_direction)
+        else:
+            winner = self._tally.winner()
+        logger.info("Anarchy window: %s won with %s/%s commands", winner[3], winner[1], self._window_size)
+        self.window_count += 1
+        self.max_window_size = max(self.max_window_size, self._window_size)
+        self.clear()
+        return winner[2]
+    
+    def clear(self):
+        self._tally.clear()
+        self._directions.clear()
+        self._window_size = 0
+    
+    def get_stats(self):
+        """获取合并统计信息"""
+        return {
+            'group_by': self.group_by,
+            'pending': self._window_size,
+            'windows': self.window_count,
+            'coalesced': self.coalesced_count,
+            'max_window_size': self.max_window_size
+        }
 
 session: Optional[aiohttp.ClientSession] = None
 start_time: datetime = None
@@ -181,13 +1122,30 @@ game_duration_lock = threading.Lock()  # 游戏时长锁
 game_start_time = None  # 本次程序启动时间
 danmaku_display_queue = deque(maxlen=13)  # 固定长度15的队列用于HTML显示
 danmaku_lock = threading.Lock()  # 弹幕数据锁
-sse_clients = []  # SSE客户端列表
-sse_lock = threading.Lock()  # SSE客户端锁
+sse_broadcaster = SSEBroadcaster(SSE_RING_SIZE, SSE_MAX_LAG, SSE_SLOW_CLIENT_POLICY, SSE_STALL_TIMEOUT)  # SSE广播器
+sse_lock = threading.Lock()  # SSE发布锁：保证投票快照与增量的先后顺序
 danmaku_saver = DanmakuSaver()  # 弹幕保存器实例
+danmaku_ingest_queue = DanmakuIngestQueue()  # 弹幕接收队列实例
+danmaku_query = DanmakuQuery(ArchiveReader(os.path.join('danmaku', 'archive')))  # 弹幕归档查询
+latency_tracer = LatencyTracer()  # 弹幕到按键的延迟追踪
+
+# Prometheus 指标（/metrics），热路径计数器在这里创建，其余指标在 register_metrics 中按需读取
+metrics_registry = MetricsRegistry('weplay_')
+danmaku_received_counter = metrics_registry.counter('danmaku_received_total', 'Danmaku messages received', ('platform',))
+command_counter = metrics_registry.counter('commands_total', 'Danmaku commands by outcome', ('outcome',))
+executor_busy_counter = metrics_registry.counter('executor_busy_seconds_total', 'Seconds spent executing key commands')
+order_round_counter = metrics_registry.counter('order_rounds_total', 'Finished order-mode rounds', ('result',))
+order_round_votes_counter = metrics_registry.counter('order_round_votes_total', 'Votes cast in finished order-mode rounds')
+client_reconnect_counter = metrics_registry.counter('client_reconnects_total', 'Danmaku client reconnect attempts', ('client',))
+metrics_started = time.perf_counter()  # 计算执行器繁忙比例的起点
+last_order_round = {'votes': 0, 'commands': 0}  # 最近一轮秩序模式的投票数和不同指令数
 
 # 最新指令缓存机制（无政府模式）
 latest_command = None  # 最新的指令
 latest_command_lock = threading.Lock()  # 最新指令锁
+latest_command_ready = threading.Condition(latest_command_lock)  # 有新的最新指令时唤醒执行线程
+latest_command_trace = None  # 最新指令的延迟追踪
+anarchy_coalescer = AnarchyCoalescer()  # 执行期间到达的指令合并为一条
 executing_command = False  # 是否正在执行指令
 execution_lock = threading.Lock()  # 执行锁
 
@@ -198,10 +1156,11 @@ vote_lock = threading.Lock()  # 投票锁
 freedom_support = 50  # 自由模式支持率，初始50%
 
 # 秩序模式相关
-order_commands = {}  # 秩序模式指令统计 {command: count}
+order_commands = OrderTally()  # 秩序模式指令统计
 order_start_time = None  # 秩序模式统计开始时间
 order_lock = threading.Lock()  # 秩序模式锁
 ORDER_INTERVAL = 20  # 秩序模式统计间隔（秒）
+DEMOCRACY_PUSH_RATE = 5  # 秩序模式投票更新每秒最多推送次数
 
 # 自动输入机制
 last_command_time = time.time()  # 最后一次接收指令的时间
@@ -210,8 +1169,17 @@ AUTO_INPUT_TIMEOUT = 120  # 120秒无操作自动输入
 AUTO_INPUT_INTERVAL = 10  # 无人值守状态每10秒输入一次
 auto_mode = False  # 是否处于自动模式
 
+# 其他定时任务间隔
+AUTO_SAVE_INTERVAL = 120  # 自动存档间隔（秒）
+CONFIG_RELOAD_INTERVAL = 120  # 配置热更新间隔（秒）
+ORDER_MODE_TIMEOUT = 180  # 秩序模式最长维持时间（秒）
+
+# 单事件循环运行时（runtime 配置为 asyncio 时启用）
+async_runtime = None
+
 app = Flask(__name__)
 window_lock = threading.Lock()  # 线程锁
+input_backend = None  # 按键注入后端（main 中按配置创建）
 
 def load_config():
     """加载配置文件"""
@@ -253,6 +1221,7 @@ def load_config():
         logger.info(f"Douyin Enabled: {DOUYIN_ENABLED}")
         if DOUYIN_ENABLED:
             logger.info(f"Douyin WebSocket Port: {DOUYIN_WEBSOCKET_PORT}")
+        load_tuning_config(config)
         
     except FileNotFoundError:
         logger.error(f"Configuration file {CONFIG_FILE} not found. Using default values.")
@@ -268,6 +1237,7 @@ def load_config():
         DOUYIN_ENABLED = False
         VOTING_ENABLED = True
         BLOCKED_WORDS = []
+        load_tuning_config({})
     except json.JSONDecodeError as e:
         logger.error(f"Error parsing configuration file {CONFIG_FILE}: {e}")
         logger.error("Using default values.")
@@ -283,6 +1253,7 @@ def load_config():
         DOUYIN_ENABLED = False
         VOTING_ENABLED = True
         BLOCKED_WORDS = []
+        load_tuning_config({})
     except Exception as e:
         logger.error(f"Unexpected error loading configuration: {e}")
         logger.error("Using default values.")
@@ -298,6 +1269,79 @@ def load_config():
         DOUYIN_ENABLED = False
         VOTING_ENABLED = True
         BLOCKED_WORDS = []
+        load_tuning_config({})
+
+def load_tuning_config(config: dict):
+    """读取性能相关的配置块（队列、写入、运行时、推送、按键、日志等）
+
+    默认值只在这里定义；配置文件缺失或无法解析时传入空字典，全部使用默认值。
+    """
+    global INGEST_QUEUE_SIZE, INGEST_QUEUE_POLICY
+    global DANMAKU_WRITE_BEHIND, DANMAKU_FLUSH_ROWS, DANMAKU_FLUSH_INTERVAL, DANMAKU_LOG_BACKEND, RUNTIME_MODE
+    global SSE_RING_SIZE, SSE_MAX_LAG, SSE_SLOW_CLIENT_POLICY, SSE_STALL_TIMEOUT, WEB_SERVER_MODE, WEB_SERVER_PORT
+    global INPUT_BACKEND, INPUT_PYAUTOGUI_PAUSE, INPUT_SIMULATE_TIMING, INPUT_SOCKET_HOST, INPUT_SOCKET_PORT, INPUT_TIMING_PROFILES
+    global ANARCHY_COALESCE, ANARCHY_GROUP_BY, LATENCY_TRACING, LOG_ASYNC, LOG_SAMPLE_INTERVAL, LOG_SAMPLE_BURST
+    
+    # 弹幕接收队列配置
+    ingest_config = config.get('ingest_queue', {})
+    INGEST_QUEUE_SIZE = ingest_config.get('max_size', 2000)
+    INGEST_QUEUE_POLICY = ingest_config.get('policy', 'drop_oldest')
+    
+    # 弹幕CSV写入配置
+    danmaku_log_config = config.get('danmaku_log', {})
+    DANMAKU_WRITE_BEHIND = danmaku_log_config.get('write_behind', False)
+    DANMAKU_FLUSH_ROWS = danmaku_log_config.get('flush_rows', 500)
+    DANMAKU_FLUSH_INTERVAL = danmaku_log_config.get('flush_interval', 1.0)
+    DANMAKU_LOG_BACKEND = danmaku_log_config.get('backend', 'csv')
+    
+    # 后台任务运行方式
+    RUNTIME_MODE = config.get('runtime', 'threads')
+    
+    # Web服务器配置
+    web_server_config = config.get('web_server', {})
+    WEB_SERVER_MODE = web_server_config.get('mode', 'flask')
+    WEB_SERVER_PORT = web_server_config.get('port', 5000)
+    
+    # SSE推送配置
+    sse_config = config.get('sse', {})
+    SSE_RING_SIZE = sse_config.get('ring_size', 1024)
+    SSE_MAX_LAG = sse_config.get('max_lag', 512)
+    SSE_SLOW_CLIENT_POLICY = sse_config.get('slow_client_policy', 'skip')
+    SSE_STALL_TIMEOUT = sse_config.get('stall_timeout', 120)
+    
+    # 按键注入配置
+    input_config = config.get('input', {})
+    INPUT_BACKEND = input_config.get('backend', 'pyautogui')
+    INPUT_PYAUTOGUI_PAUSE = input_config.get('pyautogui_pause', 0.1)
+    INPUT_SIMULATE_TIMING = input_config.get('simulate_timing', True)
+    INPUT_SOCKET_HOST = input_config.get('socket_host', '127.0.0.1')
+    INPUT_SOCKET_PORT = input_config.get('socket_port', 8888)
+    INPUT_TIMING_PROFILES = input_config.get('timing_profiles', {})
+    
+    # 自由模式指令合并配置
+    anarchy_config = config.get('anarchy', {})
+    ANARCHY_COALESCE = anarchy_config.get('coalesce', False)
+    ANARCHY_GROUP_BY = anarchy_config.get('group_by', 'command')
+    
+    # 延迟追踪配置
+    tracing_config = config.get('tracing', {})
+    LATENCY_TRACING = tracing_config.get('enabled', True)
+    
+    # 日志配置
+    logging_config = config.get('logging', {})
+    LOG_ASYNC = logging_config.get('async', False)
+    LOG_SAMPLE_INTERVAL = logging_config.get('sample_interval', 1.0)
+    LOG_SAMPLE_BURST = logging_config.get('sample_burst', 0)
+    
+    logger.info(f"Ingest Queue: max_size={INGEST_QUEUE_SIZE}, policy={INGEST_QUEUE_POLICY}")
+    logger.info(f"Danmaku Log Backend: {DANMAKU_LOG_BACKEND}, Write-behind: {DANMAKU_WRITE_BEHIND}")
+    logger.info(f"Runtime Mode: {RUNTIME_MODE}")
+    logger.info(f"Web Server: {WEB_SERVER_MODE} (port {WEB_SERVER_PORT})")
+    logger.info(f"SSE: ring_size={SSE_RING_SIZE}, max_lag={SSE_MAX_LAG}, slow_client_policy={SSE_SLOW_CLIENT_POLICY}")
+    logger.info(f"Input Backend: {INPUT_BACKEND}")
+    logger.info(f"Anarchy Coalescing: {ANARCHY_COALESCE} (group by {ANARCHY_GROUP_BY})")
+    logger.info(f"Latency Tracing: {LATENCY_TRACING}")
+    logger.info(f"Logging: async={LOG_ASYNC}, sample_interval={LOG_SAMPLE_INTERVAL}s, sample_burst={LOG_SAMPLE_BURST}")
 
 def filter_username(username: str) -> str:
     """
@@ -400,6 +1444,22 @@ def get_game_duration():
         else:
             return format_game_duration(game_duration_seconds)
 
+def save_total_game_duration():
+    """把 历史累计时长 + 本次会话时长 保存到文件"""
+    with game_duration_lock:
+        current_time = time.time()
+        if game_start_time:
+            # 计算本次会话时长
+            session_duration = int(current_time - game_start_time)
+            # 更新总时长 = 历史累计时长 + 本次会话时长
+            total_duration = game_duration_seconds + session_duration
+            
+            try:
+                with open(GAME_DURATION_FILE, 'w', encoding='utf-8') as f:
+                    f.write(str(total_duration))
+            except Exception as e:
+                logger.error(f"Error saving game duration: {e}")
+
 def game_duration_thread():
     """游戏时长更新线程，每秒更新一次"""
     global game_duration_seconds, game_start_time
@@ -412,20 +1472,8 @@ def game_duration_thread():
         try:
             time.sleep(1)  # 每秒更新一次
             
-            with game_duration_lock:
-                current_time = time.time()
-                if game_start_time:
-                    # 计算本次会话时长
-                    session_duration = int(current_time - game_start_time)
-                    # 更新总时长 = 历史累计时长 + 本次会话时长
-                    total_duration = game_duration_seconds + session_duration
-                    
-                    # 每秒保存一次到文件
-                    try:
-                        with open(GAME_DURATION_FILE, 'w', encoding='utf-8') as f:
-                            f.write(str(total_duration))
-                    except Exception as e:
-                        logger.error(f"Error saving game duration: {e}")
+            # 每秒保存一次到文件
+            save_total_game_duration()
                         
         except Exception as e:
             logger.error(f"Error in game duration thread: {e}")
@@ -433,161 +1481,273 @@ def game_duration_thread():
 
 def broadcast_danmaku(danmaku_data):
     """向所有SSE客户端广播弹幕数据"""
-    with sse_lock:
-        disconnected_clients = []
-        for client_queue in sse_clients:
-            try:
-                client_queue.put(danmaku_data)
-            except:
-                disconnected_clients.append(client_queue)
-        
-        # 移除断开连接的客户端
-        for client in disconnected_clients:
-            sse_clients.remove(client)
-        
-        logger.info(f"Broadcasted danmaku to {len(sse_clients)} clients")
+    sse_broadcaster.publish(danmaku_data)
+    logger.info("Broadcasted danmaku to %s clients", sse_broadcaster.clients)
 
-def activate_mgba_window(search_text: str = MGBA_WINDOW_TITLE):
-    """查找并激活 mGBA 窗口（改进版本）"""
-    def enum_windows(hwnd, results):
-        if win32gui.IsWindowVisible(hwnd):
-            title = win32gui.GetWindowText(hwnd)
-            if search_text in title:
-                results.append(hwnd)
+class MGBAWindowTracker:
+    """mGBA 窗口跟踪器：缓存窗口句柄并跟踪焦点状态
+
+    窗口句柄只在首次使用或失效时通过 EnumWindows 查找，之后每次只用 IsWindow 和标题检查验证；
+    如果 mGBA 仍是前台窗口（焦点没有被抢走），直接跳过激活流程。
+    """
     
-    hwnd_list = []
-    win32gui.EnumWindows(enum_windows, hwnd_list)
+    def __init__(self, search_text: str = MGBA_WINDOW_TITLE):
+        self.search_text = search_text
+        self._hwnd = None  # 缓存的窗口句柄
+        self._focused = False  # 上次检查时 mGBA 是否为前台窗口
+        
+        # 统计
+        self.resolve_count = 0  # EnumWindows 查找次数
+        self.skip_count = 0  # 焦点未变、跳过激活的次数
+        self.activate_count = 0  # 实际执行激活流程的次数
+        self.focus_lost_count = 0  # 检测到焦点被其他窗口抢走的次数
+        self.failure_count = 0
     
-    if not hwnd_list:
-        logger.error(f"No window found with '{search_text}' in title")
-        return False
+    def _find_window(self):
+        """遍历顶层窗口查找 mGBA（开销较大，只在缓存失效时调用）"""
+        def enum_windows(hwnd, results):
+            if win32gui.IsWindowVisible(hwnd):
+                title = win32gui.GetWindowText(hwnd)
+                if self.search_text in title:
+                    results.append(hwnd)
+        
+        hwnd_list = []
+        win32gui.EnumWindows(enum_windows, hwnd_list)
+        self.resolve_count += 1
+        return hwnd_list[0] if hwnd_list else None
     
-    hwnd = hwnd_list[0]
-    with window_lock:  # 线程安全
+    def _is_valid(self, hwnd) -> bool:
+        """廉价验证缓存的句柄：窗口仍存在且标题仍匹配（防止句柄被其他窗口复用）"""
         try:
-            # 检查窗口是否已经是前台窗口
-            current_foreground = win32gui.GetForegroundWindow()
-            if current_foreground == hwnd:
-                logger.info(f"mGBA window is already active: {win32gui.GetWindowText(hwnd)}")
-                return True
-            
-            # 强制显示窗口（处理最小化和被覆盖的情况）
-            win32gui.ShowWindow(hwnd, win32con.SW_RESTORE)
-            win32gui.ShowWindow(hwnd, win32con.SW_SHOW)
-            time.sleep(0.05)
-            
-            # 尝试多种方法激活窗口
-            success = False
+            return bool(win32gui.IsWindow(hwnd)) and self.search_text in win32gui.GetWindowText(hwnd)
+        except Exception:
+            return False
+    
+    def get_hwnd(self):
+        """获取 mGBA 窗口句柄，缓存失效时重新查找"""
+        if self._hwnd is None or not self._is_valid(self._hwnd):
+            if self._hwnd is not None:
+                logger.info("Cached mGBA window handle is no longer valid, searching again")
+            self._hwnd = self._find_window()
+            self._focused = False
+        return self._hwnd
+    
+    def invalidate(self):
+        """丢弃缓存的句柄，下次使用时重新查找"""
+        self._hwnd = None
+        self._focused = False
+    
+    def activate(self) -> bool:
+        """确保 mGBA 是前台窗口，焦点未变时不做任何激活操作"""
+        with window_lock:  # 线程安全
+            hwnd = self.get_hwnd()
+            if hwnd is None:
+                logger.error("No window found with '%s' in title", self.search_text)
+                self.failure_count += 1
+                return False
             
-            # 方法1: 直接设置前台窗口
             try:
-                if win32gui.SetForegroundWindow(hwnd):
-                    time.sleep(0.05)  # 短暂等待窗口响应
-                    if win32gui.GetForegroundWindow() == hwnd:
-                        success = True
-                        logger.info(f"Method 1 success: Activated mGBA window: {win32gui.GetWindowText(hwnd)}")
+                if win32gui.GetForegroundWindow() == hwnd:
+                    self._focused = True
+                    self.skip_count += 1
+                    return True
             except Exception as e:
-                logger.debug(f"Method 1 failed: {e}")
+                logger.debug("GetForegroundWindow failed: %s", e)
             
-            # 方法2: 强制置顶 + 线程输入附加
-            if not success:
-                try:
-                    # 先强制置顶
-                    win32gui.SetWindowPos(hwnd, win32con.HWND_TOPMOST, 0, 0, 0, 0, 
-                                        win32con.SWP_NOMOVE | win32con.SWP_NOSIZE | win32con.SWP_SHOWWINDOW)
-                    time.sleep(0.05)
-                    
-                    current_thread = win32process.GetCurrentThreadId()
-                    target_thread = win32process.GetWindowThreadProcessId(hwnd)[0]
-                    
-                    if current_thread != target_thread:
-                        win32process.AttachThreadInput(current_thread, target_thread, True)
-                        try:
-                            win32gui.SetForegroundWindow(hwnd)
-                            win32gui.BringWindowToTop(hwnd)
-                            time.sleep(0.05)
-                            if win32gui.GetForegroundWindow() == hwnd:
-                                success = True
-                                logger.info(f"Method 2 success: Activated mGBA window: {win32gui.GetWindowText(hwnd)}")
-                        finally:
-                            win32process.AttachThreadInput(current_thread, target_thread, False)
-                    else:
+            if self._focused:
+                self.focus_lost_count += 1
+                logger.info("mGBA window lost focus, re-activating")
+            self._focused = False
+            self.activate_count += 1
+            
+            if force_foreground_window(hwnd):
+                self._focused = True
+                return True
+            
+            # 激活失败时丢弃缓存，下次重新查找窗口
+            self.failure_count += 1
+            self.invalidate()
+            return False
+    
+    def get_stats(self):
+        """获取窗口跟踪统计信息"""
+        return {
+            'cached': self._hwnd is not None,
+            'focused': self._focused,
+            'resolves': self.resolve_count,
+            'skipped_activations': self.skip_count,
+            'activations': self.activate_count,
+            'focus_lost': self.focus_lost_count,
+            'failures': self.failure_count
+        }
+
+def force_foreground_window(hwnd) -> bool:
+    """依次尝试多种方法把窗口切换到前台（改进版本）"""
+    try:
+        # 强制显示窗口（处理最小化和被覆盖的情况）
+        win32gui.ShowWindow(hwnd, win32con.SW_RESTORE)
+        win32gui.ShowWindow(hwnd, win32con.SW_SHOW)
+        time.sleep(0.05)
+        
+        # 尝试多种方法激活窗口
+        success = False
+        
+        # 方法1: 直接设置前台窗口
+        try:
+            if win32gui.SetForegroundWindow(hwnd):
+                time.sleep(0.05)  # 短暂等待窗口响应
+                if win32gui.GetForegroundWindow() == hwnd:
+                    success = True
+                    logger.info("Method 1 success: Activated mGBA window: %s", win32gui.GetWindowText(hwnd))
+        except Exception as e:
+            logger.debug("Method 1 failed: %s", e)
+        
+        # 方法2: 强制置顶 + 线程输入附加
+        if not success:
+            try:
+                # 先强制置顶
+                win32gui.SetWindowPos(hwnd, win32con.HWND_TOPMOST, 0, 0, 0, 0, 
+                                    win32con.SWP_NOMOVE | win32con.SWP_NOSIZE | win32con.SWP_SHOWWINDOW)
+                time.sleep(0.05)
+                
+                current_thread = win32process.GetCurrentThreadId()
+                target_thread = win32process.GetWindowThreadProcessId(hwnd)[0]
+                
+                if current_thread != target_thread:
+                    win32process.AttachThreadInput(current_thread, target_thread, True)
+                    try:
                         win32gui.SetForegroundWindow(hwnd)
                         win32gui.BringWindowToTop(hwnd)
                         time.sleep(0.05)
                         if win32gui.GetForegroundWindow() == hwnd:
                             success = True
-                            logger.info(f"Method 2 (same thread) success: Activated mGBA window: {win32gui.GetWindowText(hwnd)}")
-                    
-                    # 取消置顶状态，让窗口正常显示
-                    win32gui.SetWindowPos(hwnd, win32con.HWND_NOTOPMOST, 0, 0, 0, 0, 
-                                        win32con.SWP_NOMOVE | win32con.SWP_NOSIZE | win32con.SWP_SHOWWINDOW)
-                except Exception as e:
-                    logger.debug(f"Method 2 failed: {e}")
-            
-            # 方法3: 温和激活（不影响其他窗口）
-            if not success:
-                try:
-                    # 只激活目标窗口，不影响其他窗口
-                    win32gui.ShowWindow(hwnd, win32con.SW_RESTORE)
-                    win32gui.BringWindowToTop(hwnd)
-                    win32gui.SetForegroundWindow(hwnd)
-                    time.sleep(0.05)
-                    
-                    # 检查是否激活成功
-                    if win32gui.GetForegroundWindow() == hwnd:
-                        success = True
-                        logger.info(f"Method 3 success: Activated mGBA window: {win32gui.GetWindowText(hwnd)}")
-                except Exception as e:
-                    logger.debug(f"Method 3 failed: {e}")
-            
-            # 方法4: 强制激活（最后手段）
-            if not success:
-                try:
-                    # 发送 Alt 键来解除系统的前台锁定
-                    pyautogui.keyDown('alt')
-                    time.sleep(0.05)
-                    pyautogui.keyUp('alt')
-                    
-                    # 再次尝试激活
-                    win32gui.SetWindowPos(hwnd, win32con.HWND_TOP, 0, 0, 0, 0, 
-                                        win32con.SWP_NOMOVE | win32con.SWP_NOSIZE | win32con.SWP_SHOWWINDOW)
+                            logger.info("Method 2 success: Activated mGBA window: %s", win32gui.GetWindowText(hwnd))
+                    finally:
+                        win32process.AttachThreadInput(current_thread, target_thread, False)
+                else:
                     win32gui.SetForegroundWindow(hwnd)
+                    win32gui.BringWindowToTop(hwnd)
                     time.sleep(0.05)
-                    
-                    # 检查是否激活成功
                     if win32gui.GetForegroundWindow() == hwnd:
                         success = True
-                        logger.info(f"Method 4 success: Activated mGBA window: {win32gui.GetWindowText(hwnd)}")
-                except Exception as e:
-                    logger.debug(f"Method 4 failed: {e}")
-            
-            # 验证激活是否成功
-            if success:
-                time.sleep(0.1)  # 等待窗口响应
-                current_foreground = win32gui.GetForegroundWindow()
-                if current_foreground == hwnd:
-                    return True
-                else:
-                    logger.warning(f"Window activation may have failed - current foreground: {win32gui.GetWindowText(current_foreground) if current_foreground else 'None'}")
-                    return False
-            else:
-                logger.warning(f"All activation methods failed for: {win32gui.GetWindowText(hwnd)}")
-                return False
+                        logger.info("Method 2 (same thread) success: Activated mGBA window: %s", win32gui.GetWindowText(hwnd))
                 
-        except Exception as e:
-            logger.error(f"Error activating mGBA window: {e}")
+                # 取消置顶状态，让窗口正常显示
+                win32gui.SetWindowPos(hwnd, win32con.HWND_NOTOPMOST, 0, 0, 0, 0, 
+                                    win32con.SWP_NOMOVE | win32con.SWP_NOSIZE | win32con.SWP_SHOWWINDOW)
+            except Exception as e:
+                logger.debug("Method 2 failed: %s", e)
+        
+        # 方法3: 温和激活（不影响其他窗口）
+        if not success:
+            try:
+                # 只激活目标窗口，不影响其他窗口
+                win32gui.ShowWindow(hwnd, win32con.SW_RESTORE)
+                win32gui.BringWindowToTop(hwnd)
+                win32gui.SetForegroundWindow(hwnd)
+                time.sleep(0.05)
+                
+                # 检查是否激活成功
+                if win32gui.GetForegroundWindow() == hwnd:
+                    success = True
+                    logger.info("Method 3 success: Activated mGBA window: %s", win32gui.GetWindowText(hwnd))
+            except Exception as e:
+                logger.debug("Method 3 failed: %s", e)
+        
+        # 方法4: 强制激活（最后手段）
+        if not success:
+            try:
+                # 发送 Alt 键来解除系统的前台锁定
+                pyautogui.keyDown('alt')
+                time.sleep(0.05)
+                pyautogui.keyUp('alt')
+                
+                # 再次尝试激活
+                win32gui.SetWindowPos(hwnd, win32con.HWND_TOP, 0, 0, 0, 0, 
+                                    win32con.SWP_NOMOVE | win32con.SWP_NOSIZE | win32con.SWP_SHOWWINDOW)
+                win32gui.SetForegroundWindow(hwnd)
+                time.sleep(0.05)
+                
+                # 检查是否激活成功
+                if win32gui.GetForegroundWindow() == hwnd:
+                    success = True
+                    logger.info("Method 4 success: Activated mGBA window: %s", win32gui.GetWindowText(hwnd))
+            except Exception as e:
+                logger.debug("Method 4 failed: %s", e)
+        
+        # 验证激活是否成功
+        if success:
+            time.sleep(0.1)  # 等待窗口响应
+            current_foreground = win32gui.GetForegroundWindow()
+            if current_foreground == hwnd:
+                return True
+            else:
+                logger.warning("Window activation may have failed - current foreground: %s", win32gui.GetWindowText(current_foreground) if current_foreground else 'None')
+                return False
+        else:
+            logger.warning("All activation methods failed for: %s", win32gui.GetWindowText(hwnd))
             return False
+            
+    except Exception as e:
+        logger.error("Error activating mGBA window: %s", e)
+        return False
+
+mgba_window = MGBAWindowTracker()  # mGBA 窗口跟踪器实例
+
+def activate_mgba_window():
+    """查找并激活 mGBA 窗口（使用缓存的窗口句柄）"""
+    if win32gui is None:
+        logger.error("win32gui is not available, cannot activate mGBA window")
+        return False
+    return mgba_window.activate()
+
+def notify_latest_command():
+    """新的最新指令已写入，唤醒等待中的执行器（调用方需持有 latest_command_lock）"""
+    if async_runtime:
+        async_runtime.notify_latest_command()
+    else:
+        latest_command_ready.notify()
+
+def notify_mode_changed():
+    """模式已切换，唤醒等待模式变化的任务"""
+    if async_runtime:
+        async_runtime.notify_mode_changed()
+    democracy_publisher.mark_dirty()  # 离开秩序模式时清空前端投票列表
 
-def press_key(key: str, duration: float = 0.1):
-    """模拟按下并释放按键"""
+def dispatch_input(func, *args):
+    """在后台执行按键注入函数：asyncio 运行时交给按键执行器，否则启动新线程"""
+    if async_runtime:
+        async_runtime.input_executor.submit(func, *args)
+    else:
+        threading.Thread(target=func, args=args, daemon=True).start()
+
+def build_timing_profiles(overrides: dict) -> dict:
+    """用配置覆盖默认的按键时序，返回 {场景: TimingProfile}"""
+    profiles = {}
+    for context, defaults in DEFAULT_TIMING_PROFILES.items():
+        profiles[context] = TimingProfile.from_config(overrides.get(context, {}), TimingProfile.from_config(defaults))
+    return profiles
+
+timing_profiles = build_timing_profiles({})  # 按场景的按键时序（main 中按配置重建）
+
+def command_context(parsed: ParsedCommand) -> str:
+    """指令使用的按键时序：奔跑指令为 run，其余为 default"""
+    return 'run' if parsed.is_run else 'default'
+
+def run_key_schedule(parsed: ParsedCommand, hold_key: str = None, trace=None):
+    """把指令编译成按键时间表并一次性执行"""
+    context = command_context(parsed)
+    schedule = compile_schedule(parsed.steps, timing_profiles[context], hold_key)
     try:
-        pyautogui.keyDown(key)
-        pyautogui.sleep(duration)
-        pyautogui.keyUp(key)
-        logger.info(f"Pressed key: {key} (duration: {duration}s)")
+        if trace:
+            trace.mark('key_down')
+        released_ns = input_backend.run_schedule(schedule)
+        if trace:
+            # 以最后一个键实际松开的时间为准，不含时间表末尾的间隔
+            trace.mark('key_up', released_ns)
+        logger.info("Executed %d key presses in %.2fs (%s timing)", schedule.presses, schedule.duration, context)
     except Exception as e:
-        logger.error(f"Failed to press key {key}: {e}")
+        logger.error("Failed to execute key schedule for %s: %s", parsed.raw, e)
 
 # def hold_key(key: str, duration: float = 1.0):
 #     """长按按键指定时间"""
@@ -600,93 +1760,29 @@ def press_key(key: str, duration: float = 0.1):
 #     except Exception as e:
 #         logger.error(f"Failed to hold key {key}: {e}")
 
-def control_mgba_run(command: str):
+def control_mgba_run(parsed: ParsedCommand, trace=None):
     """奔跑模式控制 mGBA（长按B键的同时执行移动指令）"""
     global executing_command
     
-    command = command.strip().lower()
-    
-    # 移除开头的奔跑关键词，支持r/R/run/跑
-    if command.startswith('r'):
-        if len(command) > 1 and command[1] == '+':
-            command = command[2:].strip()  # 移除r+
-        else:
-            command = command[1:].strip()  # 移除r
-    elif command.startswith('run'):
-        if len(command) > 3 and command[3] == '+':
-            command = command[4:].strip()  # 移除run+
-        else:
-            command = command[3:].strip()  # 移除run
-    elif command.startswith('跑'):
-        if len(command) > 1 and command[1] == '+':
-            command = command[2:].strip()  # 移除跑+
-        else:
-            command = command[1:].strip()  # 移除跑
-    
-    # 支持两种分隔符：'+' 和空格，优先使用 '+' 分割
-    if '+' in command:
-        # 按 '+' 分割组合指令，最多3个子指令
-        sub_commands = command.split('+', 2)
-    else:
-        # 按空格分割组合指令，最多3个子指令
-        sub_commands = command.split(' ', 2)
-    
-    valid_sub_commands = []
-    
-    # 解析每个子指令，只允许ijkl和数字的组合
-    for sub_cmd in sub_commands:
-        sub_cmd = sub_cmd.strip()
-        if not sub_cmd:
-            continue
-        
-        # 检查是否是按键+数字格式
-        repeat_count = 1
-        base_command = sub_cmd
-        
-        if sub_cmd and sub_cmd[-1].isdigit():
-            digit = sub_cmd[-1]
-            base_command = sub_cmd[:-1]
-            repeat_count = int(digit)
-            if repeat_count < 1 or repeat_count > 3:
-                logger.warning(f"Run command number out of range (1-3), ignored: {sub_cmd}")
-                continue  # 跳过这个无效的子指令
-        
-        # 只允许移动指令 i(上), j(左), k(下), l(右)
-        if base_command in ['i', 'j', 'k', 'l']:
-            valid_sub_commands.append((base_command, repeat_count))
-        else:
-            logger.warning(f"Run command only supports i,j,k,l movement keys, ignored: {base_command}")
-    
     # 如果有合法子指令，执行奔跑模式
-    if valid_sub_commands:
+    if parsed.steps:
         with execution_lock:
             executing_command = True
+            execution_started = time.perf_counter()
             try:
-                if not activate_mgba_window():
+                if not input_backend.activate():
                     logger.warning("mGBA window not found or activation failed, skipping run command")
                 else:
-                    # 开始长按B键
-                    pyautogui.keyDown('z')  # B键对应z
-                    logger.info("Started running mode (B key held down)")
-                    
-                    try:
-                        for base_command, repeat_count in valid_sub_commands:
-                            key = COMMAND_TO_KEY[base_command]
-                            for i in range(repeat_count):
-                                press_key(key)  # 按键持续时间保持0.1秒
-                                # if i < repeat_count - 1:  # 不是最后一次按键
-                                    # time.sleep(0.01)  # 奔跑模式按键间隔0.01秒
-                            # time.sleep(0.01)  # 指令之间的间隔也是0.01秒
-                    finally:
-                        # 释放B键
-                        pyautogui.keyUp('z')
-                        logger.info("Stopped running mode (B key released)")
-                    
-                    logger.info(f"Executed run command: r {command}")
+                    if trace:
+                        trace.mark('window_activate')
+                    # 整个序列期间长按B键（z）
+                    run_key_schedule(parsed, hold_key='z', trace=trace)
+                    logger.info("Executed run command: %s", parsed.raw)
             finally:
                 executing_command = False
+                executor_busy_counter.inc(amount=time.perf_counter() - execution_started)
     else:
-        logger.warning(f"No valid movement commands in run command: r {command}")
+        logger.warning("No valid movement commands in run command: %s", parsed.raw)
 
 # def control_mgba_hold(command: str):
 #     """长按指令控制 mGBA（支持组合长按指令如 ii2 ll3 表示长按i键2秒，再长按l键3秒）"""
@@ -790,7 +1886,7 @@ def add_vote(vote_type):
             # 检测是否需要触发抖动：当前已经是最高值且还要继续增加
             if freedom_support >= 99.0:
                 should_shake = True
-                logger.info(f"Vote bar shake triggered: freedom_support at maximum ({freedom_support:.1f}%) and freedom vote received")
+                logger.info("Vote bar shake triggered: freedom_support at maximum (%.1f%%) and freedom vote received", freedom_support)
             
             if current_mode == "自由":
                 # 当前是自由模式，接收自由票+2
@@ -807,7 +1903,7 @@ def add_vote(vote_type):
             # 检测是否需要触发抖动：当前已经是最小值且还要继续减少
             if freedom_support <= 1.0:
                 should_shake = True
-                logger.info(f"Vote bar shake triggered: freedom_support at minimum ({freedom_support:.1f}%) and order vote received")
+                logger.info("Vote bar shake triggered: freedom_support at minimum (%.1f%%) and order vote received", freedom_support)
             
             if current_mode == "秩序":
                 # 当前是秩序模式，接收秩序票只+1（对freedom_support来说是-1）
@@ -824,7 +1920,7 @@ def add_vote(vote_type):
         freedom_support = max(1.0, min(99.0, freedom_support))
         
         order_support = 100.0 - freedom_support
-        logger.info(f"Added weighted vote: {vote_type} (weight: {used_weight:.1f}, mode: {current_mode}). Current support - 自由: {freedom_support:.1f}%, 秩序: {order_support:.1f}%")
+        logger.info("Added weighted vote: %s (weight: %.1f, mode: %s). Current support - 自由: %.1f%%, 秩序: %.1f%%", vote_type, used_weight, current_mode, freedom_support, order_support)
         
         return should_shake
 
@@ -839,51 +1935,43 @@ def check_mode_switch():
             # 秩序模式时，自由支持率需要超过50%才能切换到自由模式
             if freedom_support > 50.0:
                 current_mode = "自由"
-                logger.info(f"Mode switched to 自由 (freedom support: {freedom_support:.1f}%, order support: {order_support:.1f}%)")
+                logger.info("Mode switched to 自由 (freedom support: %.1f%%, order support: %.1f%%)", freedom_support, order_support)
                 # 重置秩序模式统计
                 with order_lock:
                     global order_commands, order_start_time
                     order_commands.clear()
                     order_start_time = None
+                order_round_scheduler.cancel()
+                notify_mode_changed()
                 return True
         elif current_mode == "自由":
             # 自由模式时，自由支持率需要低于25%（即秩序支持率超过75%）才能切换到秩序模式
             if freedom_support < 25.0:
                 current_mode = "秩序"
-                logger.info(f"Mode switched to 秩序 (freedom support: {freedom_support:.1f}%, order support: {order_support:.1f}%)")
+                logger.info("Mode switched to 秩序 (freedom support: %.1f%%, order support: %.1f%%)", freedom_support, order_support)
                 # 初始化秩序模式统计
                 with order_lock:
                     order_commands.clear()
                     order_start_time = time.time()
+                    order_round_scheduler.arm(order_start_time + ORDER_INTERVAL)
+                notify_mode_changed()
                 return True
     return False
 
-def add_order_command(display_command, original_command):
+def add_order_command(parsed: ParsedCommand):
     """在秩序模式下添加指令到统计，奔跑指令和普通指令分开统计"""
     global order_start_time
     
     with order_lock:
         if order_start_time is None:
             order_start_time = time.time()
+            order_round_scheduler.arm(order_start_time + ORDER_INTERVAL)
         
-        # 判断是否为奔跑指令，如果是则在显示名称前加上标识
-        is_run_command = original_command.startswith('run:')
-        
-        # 为奔跑指令和普通指令创建不同的统计key
-        if is_run_command:
-            # 奔跑指令：使用原始显示名称，但在统计中保持独立
-            stat_key = f"[RUN] {display_command}"
-        else:
-            # 普通指令：直接使用显示名称
-            stat_key = display_command
-        
-        # 添加指令到统计，存储格式：{stat_key: [count, original_command, display_command]}
-        if stat_key in order_commands:
-            order_commands[stat_key][0] += 1
-        else:
-            order_commands[stat_key] = [1, original_command, display_command]
+        # 添加指令到统计（奔跑指令和普通指令分开统计）
+        stat_key = command_stat_key(parsed)
+        votes = order_commands.add(stat_key, parsed)
         
-        logger.info(f"Order command added: {stat_key}. Current stats: {order_commands}")
+        logger.info("Order command added: %s (%s votes, %s distinct commands)", stat_key, votes, len(order_commands))
 
 def execute_order_command():
     """执行秩序模式下票数最高的指令"""
@@ -891,21 +1979,15 @@ def execute_order_command():
         return
     
     # 找到票数最高的指令
-    sorted_commands = sorted(order_commands.items(), key=lambda x: x[1][0], reverse=True)
-    winning_display_command = sorted_commands[0][0]
-    winning_votes = sorted_commands[0][1][0]
-    winning_original_command = sorted_commands[0][1][1]
+    winning_display_command, winning_votes, winning_parsed_command, _ = order_commands.winner()
     
-    logger.info(f"Executing order winner: {winning_display_command} with {winning_votes} votes")
+    logger.info("Executing order winner: %s with %s votes", winning_display_command, winning_votes)
     
     # 执行指令
-    with execution_lock:
-        global executing_command
-        executing_command = True
-        try:
-            control_mgba(winning_original_command)
-        finally:
-            executing_command = False
+    if winning_parsed_command.is_run:
+        control_mgba_run(winning_parsed_command)
+    else:
+        control_mgba(winning_parsed_command)
 
 def trigger_vote_reset(runtime_hours=None):
     """手动触发投票重置（用于测试）"""
@@ -946,21 +2028,38 @@ def trigger_vote_reset(runtime_hours=None):
         }
     
     # 广播投票更新给所有SSE客户端
-    with sse_lock:
-        disconnected_clients = []
-        for client_queue in sse_clients:
-            try:
-                client_queue.put(vote_update)
-            except:
-                disconnected_clients.append(client_queue)
-        
-        # 清理断开的客户端
-        for client in disconnected_clients:
-            sse_clients.remove(client)
+    sse_broadcaster.publish(vote_update)
+
+def force_freedom_mode():
+    """秩序模式维持3分钟后强制切换为自由模式"""
+    global freedom_support
+    
+    with vote_lock:
+        old_freedom_support = freedom_support
+        freedom_support = 75.0  # 设置为75%确保切换到自由模式
+    
+    logger.info(f"Order mode timeout: 3 minutes reached. Forcing switch to freedom mode. Reset freedom_support from {old_freedom_support:.1f}% to 75.0%")
+    check_mode_switch()
+    
+    # 发送模式切换消息给前端
+    with mode_lock:
+        vote_update = {
+            'type': 'vote_update',
+            'mode_info': {
+                'current_mode': '自由',
+                'freedom_support': 75.0,
+                'order_support': 25.0
+            },
+            'mode_switched': True,
+            'should_shake': False,
+            'reset_message': '3分钟结束      切换自由'
+        }
+    
+    # 广播投票更新给所有SSE客户端
+    sse_broadcaster.publish(vote_update)
 
 def order_mode_timeout_thread():
     """秩序模式超时线程 - 秩序模式维持3分钟后强制切换为自由模式"""
-    global freedom_support, current_mode
     logger.info("Order mode timeout thread started")
     
     order_mode_start_time = None  # 记录秩序模式开始时间
@@ -985,40 +2084,8 @@ def order_mode_timeout_thread():
                     current_time = time.time()
                     order_duration = current_time - order_mode_start_time
                     
-                    if order_duration >= 180:  # 3分钟 = 180秒
-                        # 强制切换为自由模式
-                        with vote_lock:
-                            old_freedom_support = freedom_support
-                            freedom_support = 75.0  # 设置为75%确保切换到自由模式
-                        
-                        logger.info(f"Order mode timeout: 3 minutes reached. Forcing switch to freedom mode. Reset freedom_support from {old_freedom_support:.1f}% to 75.0%")
-                        
-                        # 发送模式切换消息给前端
-                        with mode_lock:
-                            vote_update = {
-                                'type': 'vote_update',
-                                'mode_info': {
-                                    'current_mode': '自由',
-                                    'freedom_support': 75.0,
-                                    'order_support': 25.0
-                                },
-                                'mode_switched': True,
-                                'should_shake': False,
-                                'reset_message': '3分钟结束      切换自由'
-                            }
-                        
-                        # 广播投票更新给所有SSE客户端
-                        with sse_lock:
-                            disconnected_clients = []
-                            for client_queue in sse_clients:
-                                try:
-                                    client_queue.put(vote_update)
-                                except:
-                                    disconnected_clients.append(client_queue)
-                            
-                            # 清理断开的客户端
-                            for client in disconnected_clients:
-                                sse_clients.remove(client)
+                    if order_duration >= ORDER_MODE_TIMEOUT:
+                        force_freedom_mode()
                         
                         # 重置计时器
                         order_mode_start_time = None
@@ -1034,128 +2101,301 @@ def order_mode_timeout_thread():
             logger.error(f"Order mode timeout thread error: {e}")
             time.sleep(10)  # 出错时等待10秒后继续
 
+def reload_hot_config():
+    """从配置文件中读取最新的ORDER_INTERVAL和屏蔽词"""
+    global ORDER_INTERVAL, BLOCKED_WORDS
+    
+    try:
+        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        
+        new_order_interval = config.get('ORDER_INTERVAL', 20)
+        new_blocked_words = config.get('blocked_words', [])
+        
+        # 如果ORDER_INTERVAL值发生变化，更新并记录日志
+        if new_order_interval != ORDER_INTERVAL:
+            old_value = ORDER_INTERVAL
+            ORDER_INTERVAL = new_order_interval
+            logger.info(f"ORDER_INTERVAL hot reloaded: {old_value} -> {ORDER_INTERVAL} seconds")
+            # 按新的间隔重新设置本轮截止时间
+            with order_lock:
+                if order_start_time is not None:
+                    order_round_scheduler.arm(order_start_time + ORDER_INTERVAL)
+        else:
+            logger.debug(f"ORDER_INTERVAL unchanged: {ORDER_INTERVAL} seconds")
+        
+        # 如果屏蔽词发生变化，更新并记录日志
+        if new_blocked_words != BLOCKED_WORDS:
+            old_blocked_words = BLOCKED_WORDS.copy()
+            BLOCKED_WORDS = new_blocked_words
+            logger.info(f"Blocked words hot reloaded: {old_blocked_words} -> {BLOCKED_WORDS}")
+        else:
+            logger.debug(f"Blocked words unchanged: {BLOCKED_WORDS}")
+            
+    except FileNotFoundError:
+        logger.warning(f"Configuration file {CONFIG_FILE} not found during hot reload")
+    except json.JSONDecodeError as e:
+        logger.error(f"JSON decode error during hot reload: {e}")
+    except Exception as e:
+        logger.error(f"Error during config hot reload: {e}")
+
 def config_hot_reload_thread():
     """配置热更新线程，每120秒从配置文件中读取最新的ORDER_INTERVAL和屏蔽词"""
-    global ORDER_INTERVAL, BLOCKED_WORDS
     logger.info("Config hot reload thread started")
     
     while True:
         try:
-            time.sleep(120)  # 等待120秒
-            
-            # 读取配置文件中的ORDER_INTERVAL和屏蔽词
-            try:
-                with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                    config = json.load(f)
-                
-                new_order_interval = config.get('ORDER_INTERVAL', 20)
-                new_blocked_words = config.get('blocked_words', [])
-                
-                # 如果ORDER_INTERVAL值发生变化，更新并记录日志
-                if new_order_interval != ORDER_INTERVAL:
-                    old_value = ORDER_INTERVAL
-                    ORDER_INTERVAL = new_order_interval
-                    logger.info(f"ORDER_INTERVAL hot reloaded: {old_value} -> {ORDER_INTERVAL} seconds")
-                else:
-                    logger.debug(f"ORDER_INTERVAL unchanged: {ORDER_INTERVAL} seconds")
-                
-                # 如果屏蔽词发生变化，更新并记录日志
-                if new_blocked_words != BLOCKED_WORDS:
-                    old_blocked_words = BLOCKED_WORDS.copy()
-                    BLOCKED_WORDS = new_blocked_words
-                    logger.info(f"Blocked words hot reloaded: {old_blocked_words} -> {BLOCKED_WORDS}")
-                else:
-                    logger.debug(f"Blocked words unchanged: {BLOCKED_WORDS}")
-                    
-            except FileNotFoundError:
-                logger.warning(f"Configuration file {CONFIG_FILE} not found during hot reload")
-            except json.JSONDecodeError as e:
-                logger.error(f"JSON decode error during hot reload: {e}")
-            except Exception as e:
-                logger.error(f"Error during config hot reload: {e}")
-                
+            time.sleep(CONFIG_RELOAD_INTERVAL)  # 等待120秒
+            reload_hot_config()
         except Exception as e:
             logger.error(f"Config hot reload thread error: {e}")
             time.sleep(10)  # 出错时短暂等待后继续
 
-def order_execution_thread():
-    """秩序模式执行线程"""
+def order_round_time_left():
+    """秩序模式本轮剩余时间（秒），不在秩序模式时返回 None"""
     global order_start_time
-    logger.info("Order execution thread started")
-    while True:
-        should_execute = False
-        winning_command = None
-        winning_display_command = None
-        
-        with mode_lock:
-            if current_mode == "秩序":
-                with order_lock:
-                    # 确保秩序模式下有计时器
-                    if order_start_time is None:
-                        order_start_time = time.time()
-                        logger.info("Order mode timer started")
-                    
-                    current_time = time.time()
-                    time_elapsed = current_time - order_start_time
+    
+    with mode_lock:
+        if current_mode != "秩序":
+            return None
+        with order_lock:
+            # 确保秩序模式下有计时器
+            if order_start_time is None:
+                order_start_time = time.time()
+                logger.info("Order mode timer started")
+            return ORDER_INTERVAL - (time.time() - order_start_time)
+
+def collect_order_winner():
+    """本轮计时到期时取出票数最高的指令并重置统计，返回 (解析后的指令, 显示指令)，没有可执行指令时返回 (None, None)"""
+    global order_start_time
+    winning_command = None
+    winning_display_command = None
+    
+    with mode_lock:
+        if current_mode == "秩序":
+            with order_lock:
+                # 确保秩序模式下有计时器
+                if order_start_time is None:
+                    order_start_time = time.time()
+                    logger.info("Order mode timer started")
+                
+                current_time = time.time()
+                
+                if current_time - order_start_time >= ORDER_INTERVAL:
+                    # 记录本轮规模，然后准备执行票数最高的指令
+                    last_order_round['votes'] = order_commands.total_votes
+                    last_order_round['commands'] = len(order_commands)
+                    order_round_counter.inc('winner' if order_commands else 'empty')
+                    order_round_votes_counter.inc(amount=order_commands.total_votes)
+                    if order_commands:
+                        winning_stat_key, winning_votes, winning_command, winning_display_command = order_commands.winner()
+                        logger.info("Order execution timer: Winner is %s with %s votes", winning_stat_key, winning_votes)
+                    else:
+                        logger.info("Order execution timer: No commands to execute")
                     
-                    if current_time - order_start_time >= ORDER_INTERVAL:
-                        # 准备执行票数最高的指令
-                        if order_commands:
-                            sorted_commands = sorted(order_commands.items(), key=lambda x: x[1][0], reverse=True)
-                            winning_stat_key = sorted_commands[0][0]
-                            winning_command = sorted_commands[0][1][1]  # 获取原始指令
-                            winning_display_command = sorted_commands[0][1][2] if len(sorted_commands[0][1]) > 2 else winning_stat_key  # 获取显示指令
-                            winning_votes = sorted_commands[0][1][0]
-                            should_execute = True
-                            logger.info(f"Order execution timer: Winner is {winning_stat_key} with {winning_votes} votes")
-                        else:
-                            logger.info("Order execution timer: No commands to execute")
-                        
-                        # 重置统计
-                        order_commands.clear()
-                        order_start_time = current_time
-        
-        # 在锁外执行指令，避免死锁
-        if should_execute and winning_command:
-            logger.info(f"Executing order winner: {winning_display_command}")
-            # 检查是否是奔跑指令
-            if winning_command.startswith('run:'):
-                # 奔跑指令：移除run:前缀并调用奔跑控制函数
-                actual_command = winning_command[4:]  # 移除"run:"前缀
-                control_mgba_run(actual_command)
-            # elif winning_command.startswith('hold:'):
-            #     # 长按指令：移除hold:前缀并调用长按控制函数
-            #     actual_command = winning_command[5:]  # 移除"hold:"前缀
-            #     control_mgba_hold(actual_command)
-            else:
-                # 普通指令：直接调用control_mgba
-                control_mgba(winning_command)
+                    # 重置统计
+                    order_commands.clear()
+                    order_start_time = current_time
+                
+                # 设置下一次截止时间（未到期时保持当前截止时间）
+                order_round_scheduler.arm(order_start_time + ORDER_INTERVAL)
+    
+    return winning_command, winning_display_command
+
+def execute_order_winner(winning_command: ParsedCommand, winning_display_command: str):
+    """执行秩序模式本轮胜出的指令，并通知前端清空投票列表"""
+    logger.info("Executing order winner: %s", winning_display_command)
+    # 检查是否是奔跑指令
+    if winning_command.is_run:
+        control_mgba_run(winning_command)
+    else:
+        # 普通指令：直接调用control_mgba
+        control_mgba(winning_command)
+    
+    # 执行完毕后，发送清空的democracy_info更新到前端
+    democracy_publisher.reset()
+    
+    logger.info("Sent democracy clear update to frontend after execution")
+
+class OrderRoundScheduler:
+    """秩序模式轮次调度器：只在本轮截止时间唤醒一次，模式切换时取消
+
+    进入秩序模式或一轮结束重置时由 arm() 设置截止时间，切回自由模式时 cancel()。
+    调度线程在截止时间之前一直阻塞，不再周期性地获取 mode_lock / order_lock。
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._deadline = None  # 本轮截止时间（time.time()），None 表示未设置
+    
+    def arm(self, deadline: float):
+        """设置本轮截止时间"""
+        with self._cond:
+            self._deadline = deadline
+            self._cond.notify()
+    
+    def cancel(self):
+        """取消截止时间（离开秩序模式）"""
+        with self._cond:
+            self._deadline = None
+            self._cond.notify()
+    
+    def _wait_for_deadline(self):
+        """阻塞到截止时间到达"""
+        with self._cond:
+            while True:
+                if self._deadline is None:
+                    self._cond.wait()
+                    continue
+                remaining = self._deadline - time.time()
+                if remaining <= 0:
+                    self._deadline = None  # 下一轮由 collect_order_winner 重新设置
+                    return
+                self._cond.wait(remaining)
+    
+    def run(self):
+        """调度线程主循环"""
+        logger.info("Order execution thread started")
+        while True:
+            self._wait_for_deadline()
+            winning_command, winning_display_command = collect_order_winner()
             
-            # 执行完毕后，发送清空的democracy_info更新到前端
-            democracy_update = {
+            # 在锁外执行指令，避免死锁
+            if winning_command:
+                execute_order_winner(winning_command, winning_display_command)
+
+order_round_scheduler = OrderRoundScheduler()  # 秩序模式轮次调度器
+
+class DemocracyPublisher:
+    """秩序模式投票更新的合并推送器
+
+    投票只标记有变化，推送线程每 interval 秒最多推送一次，且只发送与上次推送相比的变化：
+    {'type': 'democracy_delta', 'seq': n, 'base': n - 1, 'changed': {指令: 票数}, 'order': [指令, ...]}
+    order 只在排名顺序变化时发送。新连接的客户端先收到一次完整快照，之后按 seq 依次应用增量，
+    每轮结束时发送完整的清空快照。客户端收到 base 与本地 seq 不一致的增量时（如被跳帧或移除后重连），
+    通过 /api/democracy/snapshot 重新获取完整快照。
+    """
+    def __init__(self, rate=DEMOCRACY_PUSH_RATE, top_k=5):
+        self.interval = 1.0 / rate
+        self.top_k = top_k
+        self._wakeup = threading.Event()
+        self._async_wakeup = None  # asyncio 运行时使用的唤醒事件
+        self._loop = None
+        self._seq = 0
+        self._last_commands = []  # 上次推送的 [(指令, 票数), ...]，受 sse_lock 保护
+        
+        # 推送统计
+        self.marked_count = 0
+        self.delta_count = 0
+        self.snapshot_count = 0
+        self.resync_count = 0  # 客户端主动请求完整快照的次数
+    
+    def mark_dirty(self):
+        """计票或模式变化后调用，唤醒推送线程"""
+        self.marked_count += 1
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._async_wakeup.set)
+        else:
+            self._wakeup.set()
+    
+    def snapshot_message(self):
+        """上次推送内容的完整快照，调用方需持有 sse_lock"""
+        round_start = order_start_time  # 只读取一次，不在 sse_lock 内获取 order_lock
+        time_left = max(0, ORDER_INTERVAL - (time.time() - round_start)) if round_start else ORDER_INTERVAL
+        return {
+            'type': 'democracy_update',
+            'seq': self._seq,
+            'democracy_info': {
+                'commands': list(self._last_commands),
+                'time_left': time_left
+            }
+        }
+    
+    def resync_snapshot(self):
+        """客户端基线不一致时请求的完整快照"""
+        with sse_lock:
+            self.resync_count += 1
+            return self.snapshot_message()
+    
+    def reset(self):
+        """一轮结束：向所有客户端发送清空的完整快照"""
+        with sse_lock:
+            self._seq += 1
+            self._last_commands = []
+            self.snapshot_count += 1
+            sse_broadcaster.publish({
                 'type': 'democracy_update',
+                'seq': self._seq,
                 'democracy_info': {
                     'commands': [],  # 清空指令列表
                     'time_left': ORDER_INTERVAL  # 重置时间
                 }
-            }
+            })
+    
+    def publish(self):
+        """对比当前前K名与上次推送的内容，有变化时推送增量"""
+        with mode_lock:
+            in_order_mode = current_mode == "秩序"
+        commands = []
+        if in_order_mode:
+            with order_lock:
+                commands = [(display, votes) for _, votes, _, display in order_commands.top(self.top_k)]
+        
+        with sse_lock:
+            if commands == self._last_commands:
+                return
             
-            # 发送到所有SSE客户端
-            with sse_lock:
-                disconnected_clients = []
-                for client_queue in sse_clients:
-                    try:
-                        client_queue.put(democracy_update)
-                    except:
-                        disconnected_clients.append(client_queue)
-                
-                # 清理断开的客户端
-                for client in disconnected_clients:
-                    sse_clients.remove(client)
+            last_votes = dict(self._last_commands)
+            delta = {
+                'type': 'democracy_delta',
+                'seq': self._seq + 1,
+                'base': self._seq,
+                'changed': {display: votes for display, votes in commands if last_votes.get(display) != votes}
+            }
+            order = [display for display, _ in commands]
+            if order != [display for display, _ in self._last_commands]:
+                delta['order'] = order
             
-            logger.info("Sent democracy clear update to frontend after execution")
-        
-        time.sleep(0.5)  # 每0.5秒检查一次，提高响应性
+            self._seq += 1
+            self._last_commands = commands
+            self.delta_count += 1
+            sse_broadcaster.publish(delta)
+    
+    def run(self):
+        """推送线程：每 interval 秒最多推送一次"""
+        logger.info("Democracy publisher thread started")
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            self.publish()
+            time.sleep(self.interval)
+    
+    async def run_async(self):
+        """asyncio 运行时的推送任务"""
+        self._async_wakeup = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        logger.info("Democracy publisher task started")
+        while True:
+            await self._async_wakeup.wait()
+            self._async_wakeup.clear()
+            self.publish()
+            await asyncio.sleep(self.interval)
+    
+    def get_stats(self):
+        """获取推送统计信息"""
+        return {
+            'seq': self._seq,
+            'votes_marked': self.marked_count,
+            'deltas_sent': self.delta_count,
+            'snapshots_sent': self.snapshot_count,
+            'resyncs': self.resync_count,
+            'max_rate': round(1.0 / self.interval, 2)
+        }
+
+democracy_publisher = DemocracyPublisher()  # 秩序模式投票更新推送器
+
+def order_execution_thread():
+    """秩序模式执行线程"""
+    order_round_scheduler.run()
 
 def generate_random_command():
     """生成随机指令，从l0-9+i0-9+j0-9+i0-9中随机选择1-3个"""
@@ -1177,46 +2417,76 @@ def generate_random_command():
     
     # 用+连接指令
     command = '+'.join(selected_commands)
-    logger.info(f"Generated random command: {command}")
+    logger.info("Generated random command: %s", command)
     return command
 
+def perform_auto_save(save_slot: int) -> bool:
+    """向mGBA发送Shift+F{save_slot}存档，成功返回True"""
+    # 激活mGBA窗口
+    if input_backend.activate():
+        # 发送Shift+F键组合
+        key_combination = f"shift+f{save_slot}"
+        logger.info("Auto-save: Sending %s", key_combination)
+        
+        # 按下Shift+F键
+        input_backend.save_state(save_slot)
+        
+        logger.info("Auto-save: Executed %s", key_combination)
+        return True
+    
+    logger.warning("Auto-save: mGBA window not found, skipping save")
+    return False
+
 def auto_save_daemon():
-    """自动存档守护线程，每10秒循环发送Shift+F1~Shift+F9"""
+    """自动存档守护线程，每120秒循环发送Shift+F1~Shift+F9"""
     save_slot = 1  # 当前存档位，从F1开始
     logger.info("Auto-save daemon thread started")
     
     while True:
         try:
             # 等待120秒
-            time.sleep(120)
+            time.sleep(AUTO_SAVE_INTERVAL)
             
-            # 激活mGBA窗口
-            if activate_mgba_window():
-                # 发送Shift+F键组合
-                key_combination = f"shift+f{save_slot}"
-                logger.info(f"Auto-save: Sending {key_combination}")
-                
-                # 按下Shift+F键
-                pyautogui.keyDown('shift')
-                time.sleep(0.05)
-                pyautogui.press(f'f{save_slot}')
-                time.sleep(0.05)
-                pyautogui.keyUp('shift')
-                
-                logger.info(f"Auto-save: Executed {key_combination}")
-                
+            if perform_auto_save(save_slot):
                 # 循环到下一个存档位 (F1~F9)
                 save_slot = save_slot % 9 + 1
-            else:
-                logger.warning("Auto-save: mGBA window not found, skipping save")
                 
         except Exception as e:
             logger.error(f"Auto-save daemon error: {e}")
             time.sleep(1)  # 出错时短暂等待
 
+def emit_auto_input():
+    """生成一条随机指令作为最新指令，并显示在前端"""
+    global latest_command, latest_command_trace
+    
+    # 生成随机指令
+    random_command = generate_random_command()
+    
+    # 设置为最新指令并执行
+    with latest_command_lock:
+        if not executing_command:
+            latest_command = command_grammar.parse(random_command)
+            latest_command_trace = None
+            notify_latest_command()
+            logger.info("Auto-generated command: %s", random_command)
+            
+            # 创建自动生成的弹幕数据用于显示
+            danmaku_data = {
+                'username': filter_username('Ninot-Quyi'),
+                'command': random_command.replace('+', ' + '),  # 添加空格显示
+                'timestamp': time.time()
+            }
+            
+            # 添加到显示队列
+            with danmaku_lock:
+                danmaku_display_queue.append(danmaku_data)
+            
+            # 广播给前端
+            broadcast_danmaku(danmaku_data)
+
 def auto_input_thread():
     """自动输入线程函数"""
-    global last_command_time, auto_mode, latest_command
+    global auto_mode
     
     while True:
         current_time = time.time()
@@ -1234,89 +2504,33 @@ def auto_input_thread():
                 # 检查是否到了下一次自动输入的时间
                 time_in_auto_mode = time_since_last - AUTO_INPUT_TIMEOUT
                 if time_in_auto_mode % AUTO_INPUT_INTERVAL < 1:  # 允许1秒的误差
-                    # 生成随机指令
-                    random_command = generate_random_command()
-                    
-                    # 设置为最新指令并执行
-                    with latest_command_lock:
-                        if not executing_command:
-                            latest_command = random_command
-                            logger.info(f"Auto-generated command: {random_command}")
-                            
-                            # 创建自动生成的弹幕数据用于显示
-                            danmaku_data = {
-                                'username': filter_username('Ninot-Quyi'),
-                                'command': random_command.replace('+', ' + '),  # 添加空格显示
-                                'timestamp': time.time()
-                            }
-                            
-                            # 添加到显示队列
-                            with danmaku_lock:
-                                danmaku_display_queue.append(danmaku_data)
-                            
-                            # 广播给前端
-                            broadcast_danmaku(danmaku_data)
+                    emit_auto_input()
         
         time.sleep(1)  # 每秒检查一次
 
 
-def control_mgba(command: str):
-    """根据弹幕命令控制 mGBA（支持组合指令如 a3+b3+i2 或 a3 b3 i2）"""
+def control_mgba(parsed: ParsedCommand, trace=None):
+    """根据解析后的弹幕指令控制 mGBA（支持组合指令如 a3+b3+i2 或 a3 b3 i2）"""
     global executing_command
     
-    command = command.strip().lower()
-    
-    # 支持两种分隔符：'+' 和空格，优先使用 '+' 分割
-    if '+' in command:
-        # 按 '+' 分割组合指令，最多3个子指令
-        sub_commands = command.split('+', 2)
-    else:
-        # 按空格分割组合指令，最多3个子指令
-        sub_commands = command.split(' ', 2)
-    
-    valid_sub_commands = []
-    
-    # 解析每个子指令
-    for sub_cmd in sub_commands:
-        sub_cmd = sub_cmd.strip()
-        if not sub_cmd:
-            continue
-        
-        # 检查是否是按键+数字格式
-        repeat_count = 1
-        base_command = sub_cmd
-        
-        if sub_cmd and sub_cmd[-1].isdigit():
-            digit = sub_cmd[-1]
-            base_command = sub_cmd[:-1]
-            repeat_count = int(digit)
-            if repeat_count < 1 or repeat_count > 3:
-                logger.warning(f"Combined command number out of range (1-3), ignored: {sub_cmd}")
-                continue  # 跳过这个无效的子指令
-        
-        if base_command in COMMAND_TO_KEY:
-            valid_sub_commands.append((base_command, repeat_count))
-    
     # 如果有合法子指令，依次执行
-    if valid_sub_commands:
+    if parsed.steps:
         with execution_lock:
             executing_command = True
+            execution_started = time.perf_counter()
             try:
-                if not activate_mgba_window():
+                if not input_backend.activate():
                     logger.warning("mGBA window not found or activation failed, skipping key press")
                 else:
-                    for base_command, repeat_count in valid_sub_commands:
-                        key = COMMAND_TO_KEY[base_command]
-                        for i in range(repeat_count):
-                            press_key(key)
-                            # if i < repeat_count - 1:  # 不是最后一次按键
-                                # time.sleep(0.2)  # 按键间隔0.5秒
-                        # time.sleep(0.2)  # 指令之间的间隔
-                    logger.info(f"Executed combined command: {command}")
+                    if trace:
+                        trace.mark('window_activate')
+                    run_key_schedule(parsed, trace=trace)
+                    logger.info("Executed combined command: %s", parsed.raw)
             finally:
                 executing_command = False
+                executor_busy_counter.inc(amount=time.perf_counter() - execution_started)
     else:
-        logger.warning(f"No valid commands in: {command}")
+        logger.warning("No valid commands in: %s", parsed.raw)
 
 
 class BilibiliWebSocketClient:
@@ -1647,8 +2861,8 @@ class BilibiliWebSocketClient:
         packet = self._make_packet(b'[object Object]', 2)  # OP_HEARTBEAT
         return packet
     
-    def _parse_packet(self, data: bytes):
-        """解析数据包"""
+    def _parse_packet(self, data: bytes, received_ns: int = None, decompressed_ns: int = None):
+        """解析数据包（received_ns 为收到网络帧的时间，用于延迟追踪）"""
         offset = 0
         while offset < len(data):
             if offset + 16 > len(data):
@@ -1670,25 +2884,30 @@ class BilibiliWebSocketClient:
                     
             elif operation == 3:  # 心跳回复
                 popularity = struct.unpack('>I', body)[0]
-                logger.debug(f"当前人气值: {popularity}")
+                logger.debug("当前人气值: %s", popularity)
                 
             elif operation == 5:  # 普通消息
                 if proto_ver == 2:  # zlib压缩
                     try:
                         body = zlib.decompress(body)
-                        self._parse_packet(body)
+                        self._parse_packet(body, received_ns, time.perf_counter_ns())
                     except:
                         logger.error("zlib解压失败")
                 elif proto_ver == 0:  # 未压缩
                     try:
                         msg = json.loads(body.decode())
-                        self._handle_message(msg)
+                        trace = latency_tracer.start('哔哩哔哩', received_ns)
+                        if trace:
+                            if decompressed_ns:
+                                trace.mark('decompress', decompressed_ns)
+                            trace.mark('json_parse')
+                        self._handle_message(msg, trace)
                     except:
-                        logger.error(f"解析消息失败: {body}")
+                        logger.error("解析消息失败: %s", body)
             
             offset += pack_len
     
-    def _handle_message(self, msg: dict):
+    def _handle_message(self, msg: dict, trace=None):
         """处理消息"""
         cmd = msg.get('cmd', '')
         
@@ -1699,8 +2918,8 @@ class BilibiliWebSocketClient:
             username = user_info[1]  # 完整用户名
             uid = user_info[0]  # 用户ID
             
-            logger.info(f"[哔哩哔哩] {username}: {content}")
-            process_danmaku_command(username, content, self.room_id)
+            logger.info("[哔哩哔哩] %s: %s", username, content)
+            danmaku_ingest_queue.put(username, content, trace=trace)
                 
         elif cmd == 'SEND_GIFT':  # 礼物消息
             data = msg['data']
@@ -1708,13 +2927,13 @@ class BilibiliWebSocketClient:
             gift_name = data['giftName']
             num = data['num']
             
-            logger.info(f"[礼物] {username} 送出 {gift_name} x{num}")
+            logger.info("[礼物] %s 送出 %s x%s", username, gift_name, num)
                 
         elif cmd == 'INTERACT_WORD':  # 进入直播间
             data = msg['data']
             username = data['uname']
             
-            logger.info(f"[进入] {username} 进入直播间")
+            logger.info("[进入] %s 进入直播间", username)
     
     async def connect_websocket(self):
         """连接WebSocket"""
@@ -1767,7 +2986,7 @@ class BilibiliWebSocketClient:
             
             # 接收消息
             async for message in self.websocket:
-                self._parse_packet(message)
+                self._parse_packet(message, time.perf_counter_ns())
                 
         except Exception as e:
             logger.error(f"WebSocket连接失败: {e}")
@@ -1815,6 +3034,12 @@ async def run_bilibili_openlive_client():
     handler = OpenLiveHandler()
     client.set_handler(handler)
     
+    def reconnect_policy(retry_count, total_retry_count):
+        # 与 blivedm 默认策略相同（固定间隔1秒），同时统计重连次数
+        client_reconnect_counter.inc('openlive')
+        return 1
+    client.set_reconnect_policy(reconnect_policy)
+    
     client.start()
     logger.info(f"Started Bilibili OpenLive client")
     
@@ -1833,24 +3058,46 @@ async def run_bilibili_client():
     else:
         await run_bilibili_wss_client()
 
+def execute_freedom_command(parsed: ParsedCommand, trace=None):
+    """执行自由模式的最新指令（奔跑指令和普通指令），完成后记录延迟追踪"""
+    if trace:
+        trace.mark('executor_wait')
+    if parsed.is_run:
+        control_mgba_run(parsed, trace)
+    else:
+        control_mgba(parsed, trace)
+    latency_tracer.record(trace)
+
+def promote_coalesced_command():
+    """执行结束后，把执行期间合并窗口中得票最多的指令设为下一条最新指令
+
+    执行结束到这里之间如果已经有新弹幕成为最新指令，保留新指令，丢弃窗口结果。
+    """
+    global latest_command, latest_command_trace
+    with mode_lock:
+        with latest_command_lock:
+            winner = anarchy_coalescer.collect()
+            if winner is not None and latest_command is None and current_mode == "自由":
+                latest_command = winner
+                latest_command_trace = None
+                notify_latest_command()
+
 def execute_latest_command():
-    """执行最新的指令（在单独线程中运行）"""
-    global latest_command, executing_command
+    """执行最新的指令（在单独线程中运行，有新指令时才被唤醒）"""
+    global latest_command, latest_command_trace
     
     while True:
-        command_to_execute = None
+        # 等待最新指令（只有在不执行时才会写入，见 process_danmaku_command）
+        with latest_command_ready:
+            latest_command_ready.wait_for(lambda: latest_command is not None)
+            command_to_execute = latest_command
+            command_trace = latest_command_trace
+            latest_command = None  # 清空最新指令
+            latest_command_trace = None
         
-        # 获取最新指令
-        with latest_command_lock:
-            if latest_command and not executing_command:
-                command_to_execute = latest_command
-                latest_command = None  # 清空最新指令
-        
-        if command_to_execute:
-            logger.info(f"Executing latest command: {command_to_execute}")
-            control_mgba(command_to_execute)
-        
-        time.sleep(0.1)  # 检查间隔
+        logger.info("Executing latest command: %s", command_to_execute.raw)
+        execute_freedom_command(command_to_execute, command_trace)
+        promote_coalesced_command()
 
 # 抖音弹幕WebSocket服务器
 douyin_websocket_server = None
@@ -1859,15 +3106,17 @@ douyin_clients = set()  # 存储连接的抖音客户端
 async def handle_douyin_websocket(websocket):
     """处理抖音弹幕WebSocket连接"""
     douyin_clients.add(websocket)
-    logger.info(f"Douyin WebSocket client connected. Total clients: {len(douyin_clients)}")
+    logger.info("Douyin WebSocket client connected. Total clients: %s", len(douyin_clients))
     
     try:
         async for message in websocket:
+            received_ns = time.perf_counter_ns()
             try:
                 # 解析抖音弹幕数据
                 data = json.loads(message)
-                logger.debug(f"Received Douyin WebSocket message: {message}")
-                logger.debug(f"Parsed Douyin data: {data}")
+                parsed_ns = time.perf_counter_ns()
+                logger.debug("Received Douyin WebSocket message: %s", message)
+                logger.debug("Parsed Douyin data: %s", data)
                 
                 # dycast-main发送的是消息数组，需要遍历处理
                 if isinstance(data, list):
@@ -1895,13 +3144,16 @@ async def handle_douyin_websocket(websocket):
                                 
                                 # 如果有有效的弹幕内容，处理它
                                 if content.strip():
-                                    logger.info(f"[抖音] {username}: {content}")
-                                    # 使用现有的弹幕处理函数，不添加前缀，但传递平台信息
-                                    process_danmaku_command(username, content, "douyin", "抖音")
+                                    logger.info("[抖音] %s: %s", username, content)
+                                    # 放入弹幕接收队列，不添加前缀，但传递平台信息
+                                    trace = latency_tracer.start("抖音", received_ns)
+                                    if trace:
+                                        trace.mark('json_parse', parsed_ns)
+                                    danmaku_ingest_queue.put(username, content, "抖音", trace)
                                 else:
-                                    logger.debug(f"Empty content in Douyin message: {msg}")
+                                    logger.debug("Empty content in Douyin message: %s", msg)
                             else:
-                                logger.debug(f"Non-chat message type: {method}")
+                                logger.debug("Non-chat message type: %s", method)
                 elif isinstance(data, dict):
                     # 兼容单个消息对象的情况
                     method = data.get('method')
@@ -1921,15 +3173,18 @@ async def handle_douyin_websocket(websocket):
                             content = ''.join(content_parts)
                         
                         if content.strip():
-                            logger.info(f"[抖音] {username}: {content}")
-                            process_danmaku_command(username, content, "douyin", "抖音")
+                            logger.info("[抖音] %s: %s", username, content)
+                            trace = latency_tracer.start("抖音", received_ns)
+                            if trace:
+                                trace.mark('json_parse', parsed_ns)
+                            danmaku_ingest_queue.put(username, content, "抖音", trace)
                 else:
-                    logger.warning(f"Unexpected data format from Douyin: {type(data)}")
+                    logger.warning("Unexpected data format from Douyin: %s", type(data))
                 
             except json.JSONDecodeError:
-                logger.warning(f"Invalid JSON received from Douyin WebSocket: {message}")
+                logger.warning("Invalid JSON received from Douyin WebSocket: %s", message)
             except Exception as e:
-                logger.error(f"Error processing Douyin message: {e}")
+                logger.error("Error processing Douyin message: %s", e)
                 
     except websockets.exceptions.ConnectionClosed:
         logger.info("Douyin WebSocket client disconnected")
@@ -1937,7 +3192,7 @@ async def handle_douyin_websocket(websocket):
         logger.error(f"Douyin WebSocket error: {e}")
     finally:
         douyin_clients.discard(websocket)
-        logger.info(f"Douyin WebSocket client removed. Remaining clients: {len(douyin_clients)}")
+        logger.info("Douyin WebSocket client removed. Remaining clients: %s", len(douyin_clients))
 
 async def start_douyin_websocket_server():
     """启动抖音弹幕WebSocket服务器"""
@@ -1958,9 +3213,9 @@ async def start_douyin_websocket_server():
     except Exception as e:
         logger.error(f"Failed to start Douyin WebSocket server: {e}")
 
-def process_danmaku_command(username: str, command: str, room_id: str = None, platform: str = "哔哩哔哩"):
+def process_danmaku_command(username: str, command: str, room_id: str = None, platform: str = "哔哩哔哩", trace=None):
     """处理弹幕指令的通用函数，支持组合指令如 a3+b3+i2 或 a3 b3 i2，奔跑指令如 r i3 j2，以及模式投票"""
-    global latest_command, last_command_time, auto_mode
+    global latest_command, latest_command_trace, last_command_time, auto_mode
     
     # 更新最后指令时间并退出自动模式
     with auto_input_lock:
@@ -1969,159 +3224,79 @@ def process_danmaku_command(username: str, command: str, room_id: str = None, pl
             auto_mode = False
             logger.info("Exiting auto mode - received new danmaku command")
     
-    command = command.strip()
-    original_command = command  # 保存原始指令用于CSV记录
-    command_lower = command.lower()
-    
-    # 检查是否是奔跑指令 (r/R/run/跑 开头)
-    is_run_command = False
-    run_part = ""
+    # 一次性解析弹幕，后续显示、投票和执行都直接使用解析结果
+    parsed = command_grammar.parse(command)
+    if trace:
+        trace.mark('command_parse')
+    original_command = parsed.raw  # 保存原始指令用于CSV记录
     
-    if command_lower.startswith('r') and len(command_lower) > 1 and (command_lower[1] == ' ' or command_lower[1] == '+' or command_lower[1] in 'ijkl0123456789'):
-        # r或R开头的奔跑指令
-        is_run_command = True
-        if command_lower[1] == '+':
-            run_part = command_lower[2:].strip()  # 移除r+
-        else:
-            run_part = command_lower[1:].strip()  # 移除r
-    elif command_lower.startswith('run') and len(command_lower) > 3 and (command_lower[3] == ' ' or command_lower[3] == '+'):
-        # run开头的奔跑指令
-        is_run_command = True
-        if command_lower[3] == '+':
-            run_part = command_lower[4:].strip()  # 移除run+
-        else:
-            run_part = command_lower[3:].strip()  # 移除run
-    elif command_lower.startswith('跑') and len(command_lower) > 1 and (command_lower[1] == ' ' or command_lower[1] == '+'):
-        # 跑开头的奔跑指令
-        is_run_command = True
-        if command_lower[1] == '+':
-            run_part = command_lower[2:].strip()  # 移除跑+
-        else:
-            run_part = command_lower[1:].strip()  # 移除跑
+    if parsed.kind == 'rejected':
+        logger.warning(parsed.reason)
+        command_counter.inc('rejected')
+        return  # 非法格式的指令直接返回，不继续处理
     
-    if is_run_command:
+    if parsed.is_run:
+        # 获取当前时间戳
+        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        display_command = parsed.display
         
-        # 检查奔跑指令的合法性
-        valid_run_command = True
-        if '+' in run_part:
-            sub_commands = run_part.split('+')
-        else:
-            sub_commands = run_part.split(' ')
+        # 根据当前模式处理奔跑指令
+        executed = 0
+        with mode_lock:
+            if current_mode == "自由":
+                # 自由模式：直接执行奔跑指令
+                with latest_command_lock:
+                    if not executing_command:
+                        # 与普通指令一样交给最新指令执行器，执行期间到达的指令可以一起合并
+                        latest_command = parsed
+                        latest_command_trace = trace
+                        if trace:
+                            trace.hand_off()
+                        notify_latest_command()
+                        executed = 1
+                        command_counter.inc('executed')
+                        logger.info("Freedom mode - Updated latest command (run): %s", original_command)
+                    elif ANARCHY_COALESCE:
+                        anarchy_coalescer.add(parsed)
+                        executed = 0  # 只计入合并窗口，是否执行取决于窗口结果
+                        command_counter.inc('coalesced')
+                        logger.debug("Freedom mode - Run command coalesced (executing): %s", original_command)
+                    else:
+                        executed = 0
+                        command_counter.inc('ignored')
+                        logger.info("Freedom mode - Run command ignored (executing): %s", original_command)
+            elif current_mode == "秩序":
+                # 秩序模式：添加到投票统计，奔跑指令单独统计
+                add_order_command(parsed)
+                executed = 1
+                command_counter.inc('voted')
+                logger.info("Order mode - Added run command to voting: %s", display_command)
         
-        for sub_cmd in sub_commands:
-            sub_cmd = sub_cmd.strip()
-            if not sub_cmd:
-                continue
-            
-            # 检查每个子指令是否只包含ijkl和数字
-            base_cmd = sub_cmd.rstrip('0123456789')
-            if base_cmd not in ['i', 'j', 'k', 'l']:
-                valid_run_command = False
-                break
+        # 创建结构化的弹幕数据
+        danmaku_data = {
+            'username': filter_username(username),
+            'command': display_command,
+            'timestamp': time.time()
+        }
         
-        if valid_run_command:
-            # 获取当前时间戳
-            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            
-            # 生成显示用的指令
-            display_commands = []
-            for sub_cmd in sub_commands:
-                sub_cmd = sub_cmd.strip()
-                if not sub_cmd:
-                    continue
-                
-                repeat_count = 1
-                base_command = sub_cmd.rstrip('0123456789')
-                if sub_cmd != base_command:
-                    digit_part = sub_cmd[len(base_command):]
-                    if digit_part.isdigit():
-                        repeat_count = int(digit_part)
-                        if repeat_count < 1 or repeat_count > 3:
-                            logger.warning(f"Display command number out of range (1-3), ignored: {sub_cmd}")
-                            continue  # 跳过这个无效的子指令
-                
-                key = COMMAND_TO_KEY.get(base_command, base_command)
-                display_cmd = KEY_TO_DISPLAY.get(key, base_command)
-                if repeat_count > 1:
-                    display_cmd += str(repeat_count)
-                display_commands.append(display_cmd)
-            
-            # 根据原始指令格式决定显示格式
-            if '+' in original_command or original_command.lower().startswith(('r+', 'run+', '跑+')):
-                display_command = 'R + ' + ' + '.join(display_commands)  # 使用R + 连接，+号前后加空格
-            else:
-                display_command = 'R + ' + ' + '.join(display_commands)  # 统一使用R + 格式，+号前后加空格
-            
-            # 根据当前模式处理奔跑指令
-            executed = 0
-            with mode_lock:
-                if current_mode == "自由":
-                    # 自由模式：直接执行奔跑指令
-                    with latest_command_lock:
-                        if not executing_command:
-                            # 直接执行奔跑指令，不通过latest_command队列
-                            threading.Thread(target=control_mgba_run, args=(command,), daemon=True).start()
-                            executed = 1
-                            logger.info(f"Freedom mode - Executing run command: {command}")
-                        else:
-                            executed = 0
-                            logger.info(f"Freedom mode - Run command ignored (executing): {command}")
-                elif current_mode == "秩序":
-                    # 秩序模式：添加到投票统计，加上run:前缀标识奔跑指令
-                    add_order_command(display_command, f"run:{command}")
-                    executed = 1
-                    logger.info(f"Order mode - Added run command to voting: {display_command}")
-            
-            # 创建结构化的弹幕数据
-            danmaku_data = {
-                'username': filter_username(username),
-                'command': display_command,
-                'timestamp': time.time()
-            }
-            
-            # 添加到显示队列
-            with danmaku_lock:
-                danmaku_display_queue.append(danmaku_data)
-            
-            # 广播给前端
-            broadcast_danmaku(danmaku_data)
-            
-            # 保存到CSV
-            try:
-                danmaku_saver.save_danmaku(current_time, username, original_command, executed, platform)
-            except Exception as e:
-                logger.error(f"Failed to save run command to CSV: {e}")
-            
-            # 如果是秩序模式，发送democracy更新
-            if current_mode == "秩序":
-                with order_lock:
-                    if order_commands:
-                        sorted_commands = sorted(order_commands.items(), key=lambda x: x[1][0], reverse=True)
-                        # 使用显示名称而不是统计key
-                        formatted_commands = [(votes[2] if len(votes) > 2 else cmd, votes[0]) for cmd, votes in sorted_commands]
-                        democracy_update = {
-                            'type': 'democracy_update',
-                            'democracy_info': {
-                                'commands': formatted_commands[:5],
-                                'time_left': max(0, ORDER_INTERVAL - (time.time() - order_start_time)) if order_start_time else ORDER_INTERVAL
-                            }
-                        }
-                        
-                        with sse_lock:
-                            disconnected_clients = []
-                            for client_queue in sse_clients:
-                                try:
-                                    client_queue.put(democracy_update)
-                                except:
-                                    disconnected_clients.append(client_queue)
-                            
-                            for client in disconnected_clients:
-                                sse_clients.remove(client)
-            
-            return  # 奔跑指令处理完毕，直接返回
-        else:
-            logger.warning(f"Invalid run command format: {command}. Run commands can only contain i,j,k,l and numbers.")
-            return  # 无效的奔跑指令，直接返回，不继续处理为普通指令
+        # 添加到显示队列
+        with danmaku_lock:
+            danmaku_display_queue.append(danmaku_data)
+        
+        # 广播给前端
+        broadcast_danmaku(danmaku_data)
+        
+        # 保存到CSV
+        try:
+            danmaku_saver.save_danmaku(current_time, username, original_command, executed, platform)
+        except Exception as e:
+            logger.error("Failed to save run command to CSV: %s", e)
+        
+        # 如果是秩序模式，标记democracy更新（由推送线程合并后发送）
+        if current_mode == "秩序":
+            democracy_publisher.mark_dirty()
+        
+        return  # 奔跑指令处理完毕，直接返回
     
     # # 检查是否是长按指令（如ii、ii2、jj3等）
     # is_hold_command = False
@@ -2262,132 +3437,62 @@ def process_danmaku_command(username: str, command: str, room_id: str = None, pl
     current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     
     # 检查是否是投票指令（仅在启用投票功能时处理）
-    if VOTING_ENABLED:
-        vote_commands = {
-            '自由模式': '自由',
-            '自由': '自由', 
-            'anarchy': '自由',
-            'freedom': '自由',
-            'free': '自由',
-            '秩序模式': '秩序',
-            '秩序': '秩序',
-            'democracy': '秩序',
-            'order': '秩序'
+    if VOTING_ENABLED and parsed.kind == 'vote':
+        vote_type = parsed.vote_type
+        should_shake = add_vote(vote_type)
+        command_counter.inc('mode_vote')
+        
+        # 检查是否需要切换模式
+        mode_switched = check_mode_switch()
+        
+        # 保存投票到CSV
+        try:
+            danmaku_saver.save_danmaku(current_time, username, original_command, 1 if mode_switched else 0, platform)
+        except Exception as e:
+            logger.error("Failed to save vote to CSV: %s", e)
+        
+        # 创建投票显示数据
+        vote_display = parsed.display
+        # if mode_switched:
+        #     vote_display = f" -> 切换到{current_mode}模式!"
+        
+        danmaku_data = {
+            'username': filter_username(username),
+            'command': vote_display,
+            'timestamp': time.time()
         }
         
-        if command_lower in vote_commands:
-            vote_type = vote_commands[command_lower]
-            should_shake = add_vote(vote_type)
-            
-            # 检查是否需要切换模式
-            mode_switched = check_mode_switch()
-            
-            # 保存投票到CSV
-            try:
-                danmaku_saver.save_danmaku(current_time, username, original_command, 1 if mode_switched else 0, platform)
-            except Exception as e:
-                logger.error(f"Failed to save vote to CSV: {e}")
-            
-            # 创建投票显示数据
-            vote_display = f" {vote_type}"
-            # if mode_switched:
-            #     vote_display = f" -> 切换到{current_mode}模式!"
-            
-            danmaku_data = {
-                'username': filter_username(username),
-                'command': vote_display,
-                'timestamp': time.time()
+        # 添加到显示队列
+        with danmaku_lock:
+            danmaku_display_queue.append(danmaku_data)
+        
+        # 广播给前端
+        broadcast_danmaku(danmaku_data)
+        
+        # 立即发送投票更新信息
+        with mode_lock:
+            vote_update = {
+                'type': 'vote_update',
+                'mode_info': {
+                    'current_mode': current_mode,
+                    'freedom_support': round(freedom_support, 1),
+                    'order_support': round(100.0 - freedom_support, 1)
+                },
+                'mode_switched': mode_switched,
+                'should_shake': should_shake
             }
-            
-            # 添加到显示队列
-            with danmaku_lock:
-                danmaku_display_queue.append(danmaku_data)
-            
-            # 广播给前端
-            broadcast_danmaku(danmaku_data)
-            
-            # 立即发送投票更新信息
-            with mode_lock:
-                vote_update = {
-                    'type': 'vote_update',
-                    'mode_info': {
-                        'current_mode': current_mode,
-                        'freedom_support': round(freedom_support, 1),
-                        'order_support': round(100.0 - freedom_support, 1)
-                    },
-                    'mode_switched': mode_switched,
-                    'should_shake': should_shake if 'should_shake' in locals() else False
-                }
-            
-            # 发送投票更新到所有SSE客户端
-            disconnected_clients = []
-            for client_queue in sse_clients:
-                try:
-                    client_queue.put(vote_update)
-                except:
-                    disconnected_clients.append(client_queue)
-            
-            # 清理断开的客户端
-            for client in disconnected_clients:
-                sse_clients.remove(client)
-            
-            return  # 投票指令处理完毕，直接返回
-    
-    # 支持两种分隔符：'+' 和空格，优先使用 '+' 分割
-    if '+' in command:
-        # 按 '+' 分割组合指令，最多允许3个子指令
-        sub_commands = command_lower.split('+', 2)
-    else:
-        # 按空格分割组合指令，最多允许3个子指令
-        sub_commands = command_lower.split(' ', 2)
-    
-    valid_sub_commands = []
-    display_commands = []
-    
-    # 处理每个子指令
-    for sub_cmd in sub_commands:
-        sub_cmd = sub_cmd.strip()
-        if not sub_cmd:
-            continue
-        
-        # 检查是否是按键+数字格式
-        repeat_count = 1
-        base_command = sub_cmd
-        
-        if sub_cmd and sub_cmd[-1].isdigit():
-            digit = sub_cmd[-1]
-            base_command = sub_cmd[:-1]
-            repeat_count = int(digit)
-            if repeat_count < 1 or repeat_count > 3:
-                logger.warning(f"Command number out of range (1-3), ignored: {sub_cmd}")
-                continue  # 跳过这个无效的子指令
-        
-        # 检查是否是start或select命令，如果是组合指令且包含这些命令，则拒绝
-        if len(sub_commands) > 1 and base_command in ['start', '开始', 'select', '选择']:
-            logger.warning(f"Start/Select commands cannot be used in combination commands: {original_command}")
-            return  # 直接返回，不处理包含start/select的组合指令
-        
-        # 检查start和select命令是否带有数字，如果带有则拒绝
-        if base_command in ['start', '开始', 'select', '选择'] and repeat_count > 1:
-            logger.warning(f"Start/Select commands cannot have numbers: {original_command}")
-            return  # 直接返回，不处理带数字的start/select指令
-        
-        # 验证基础命令是否合法
-        if base_command in COMMAND_TO_KEY:
-            valid_sub_commands.append((base_command, repeat_count))
-            key = COMMAND_TO_KEY[base_command]
-            display_cmd = KEY_TO_DISPLAY.get(key, base_command)
-            if repeat_count > 1:
-                display_cmd += str(repeat_count)
-            display_commands.append(display_cmd)
+        
+        # 发送投票更新到所有SSE客户端
+        sse_broadcaster.publish(vote_update)
+        
+        return  # 投票指令处理完毕，直接返回
     
     # 初始化executed变量
     executed = 0  # 默认为未执行
     
     # 如果有合法子指令
-    if valid_sub_commands:
-        # 生成显示用的组合指令，在+号左右添加空格
-        display_command = ' + '.join(display_commands)
+    if parsed.kind == 'key':
+        display_command = parsed.display
         
         # 根据当前模式处理指令
         with mode_lock:
@@ -2395,18 +3500,29 @@ def process_danmaku_command(username: str, command: str, room_id: str = None, pl
                 # 自由模式：直接更新最新指令
                 with latest_command_lock:
                     if not executing_command:  # 只有在不执行时才更新
-                        latest_command = command
+                        latest_command = parsed
+                        latest_command_trace = trace
+                        if trace:
+                            trace.hand_off()
+                        notify_latest_command()
                         executed = 1  # 标记为将要执行
-                        logger.info(f"Freedom mode - Updated latest command: {command}")
+                        command_counter.inc('executed')
+                        logger.info("Freedom mode - Updated latest command: %s", original_command)
+                    elif ANARCHY_COALESCE:
+                        anarchy_coalescer.add(parsed)
+                        executed = 0  # 只计入合并窗口，是否执行取决于窗口结果，记为未执行
+                        command_counter.inc('coalesced')
+                        logger.debug("Freedom mode - Command coalesced (executing): %s", original_command)
                     else:
                         executed = 0  # 标记为被忽略
-                        logger.info(f"Freedom mode - Command ignored (executing): {command}")
+                        command_counter.inc('ignored')
+                        logger.info("Freedom mode - Command ignored (executing): %s", original_command)
             elif current_mode == "秩序":
                 # 秩序模式：添加到投票统计
-                # 普通指令直接添加到统计
-                add_order_command(display_command, command)
+                add_order_command(parsed)
                 executed = 1  # 标记为已处理（加入投票）
-                logger.info(f"Order mode - Added command to voting: {display_command}")
+                command_counter.inc('voted')
+                logger.info("Order mode - Added command to voting: %s", display_command)
         
         # 创建结构化的弹幕数据
         danmaku_data = {
@@ -2418,85 +3534,63 @@ def process_danmaku_command(username: str, command: str, room_id: str = None, pl
         # 添加到固定长度的显示队列
         with danmaku_lock:
             danmaku_display_queue.append(danmaku_data)
-            logger.info(f"Added danmaku to queue: {danmaku_data}")
+            logger.info("Added danmaku to queue: %s", danmaku_data)
         
         # 实时推送给所有SSE客户端
         broadcast_danmaku(danmaku_data)
         
-    # 如果是秩序模式，立即发送democracy_info更新（在mode_lock外执行）
-    if current_mode == "秩序":
-        with order_lock:
-            democracy_update = {}
-            if order_commands:
-                sorted_commands = sorted(order_commands.items(), key=lambda x: x[1][0], reverse=True)
-                formatted_commands = [(cmd, votes[0]) for cmd, votes in sorted_commands]
-                democracy_update = {
-                    'type': 'democracy_update',
-                    'democracy_info': {
-                        'commands': formatted_commands[:5],
-                        'time_left': max(0, ORDER_INTERVAL - (time.time() - order_start_time)) if order_start_time else ORDER_INTERVAL
-                    }
-                }
-                
-                # 发送到所有SSE客户端
-                with sse_lock:
-                    disconnected_clients = []
-                    for client_queue in sse_clients:
-                        try:
-                            client_queue.put(democracy_update)
-                        except:
-                            disconnected_clients.append(client_queue)
-                    
-                    # 清理断开的客户端
-                    for client in disconnected_clients:
-                        sse_clients.remove(client)
+        # 如果是秩序模式，标记democracy更新（由推送线程合并后发送，在mode_lock外执行）
+        if current_mode == "秩序":
+            democracy_publisher.mark_dirty()
     else:
-        logger.info(f"Unknown command ignored: {command}")
+        logger.info("Unknown command ignored: %s", original_command)
+        command_counter.inc('unknown')
         executed = 0  # 标记为未执行
     
     # 保存原始指令到CSV文件
     try:
         danmaku_saver.save_danmaku(current_time, username, original_command, executed, platform)
     except Exception as e:
-        logger.error(f"Failed to save danmaku to CSV: {e}")
+        logger.error("Failed to save danmaku to CSV: %s", e)
 
 # 原有的DanmakuHandler类已被移除，现在使用BilibiliWebSocketClient直接处理弹幕
 
 class OpenLiveHandler(blivedm.BaseHandler):
     """处理 Bilibili OpenLive 模式直播间消息"""
     def _on_heartbeat(self, client: blivedm.BLiveClient, message: web_models.HeartbeatMessage):
-        logger.debug(f"[OpenLive] Heartbeat")
+        logger.debug("[OpenLive] Heartbeat")
 
     def _on_open_live_danmaku(self, client: blivedm.OpenLiveClient, message: open_models.DanmakuMessage):
-        logger.info(f"[哔哩哔哩] {message.uname}: {message.msg}")
-        process_danmaku_command(message.uname, message.msg, str(message.room_id))
+        logger.info("[哔哩哔哩] %s: %s", message.uname, message.msg)
+        # blivedm 已完成解压和解析，追踪从回调开始
+        danmaku_ingest_queue.put(message.uname, message.msg, trace=latency_tracer.start('哔哩哔哩'))
 
     def _on_open_live_gift(self, client: blivedm.OpenLiveClient, message: open_models.GiftMessage):
         coin_type = '金瓜子' if message.paid else '银瓜子'
         total_coin = message.price * message.gift_num
-        logger.info(f"[哔哩哔哩] {message.uname} 赠送{message.gift_name}x{message.gift_num}"
-                   f" （{coin_type}x{total_coin}）")
+        logger.info("[哔哩哔哩] %s 赠送%sx%s （%sx%s）", message.uname, message.gift_name, message.gift_num,
+                    coin_type, total_coin)
 
     def _on_open_live_buy_guard(self, client: blivedm.OpenLiveClient, message: open_models.GuardBuyMessage):
-        logger.info(f"[哔哩哔哩] {message.user_info.uname} 购买 大航海等级={message.guard_level}")
+        logger.info("[哔哩哔哩] %s 购买 大航海等级=%s", message.user_info.uname, message.guard_level)
 
     def _on_open_live_super_chat(self, client: blivedm.OpenLiveClient, message: open_models.SuperChatMessage):
-        logger.info(f"[哔哩哔哩] 醒目留言 ¥{message.rmb} {message.uname}: {message.message}")
+        logger.info("[哔哩哔哩] 醒目留言 ¥%s %s: %s", message.rmb, message.uname, message.message)
 
     def _on_open_live_super_chat_delete(self, client: blivedm.OpenLiveClient, message: open_models.SuperChatDeleteMessage):
-        logger.info(f"[哔哩哔哩] 删除醒目留言 message_ids={message.message_ids}")
+        logger.info("[哔哩哔哩] 删除醒目留言 message_ids=%s", message.message_ids)
 
     def _on_open_live_like(self, client: blivedm.OpenLiveClient, message: open_models.LikeMessage):
-        logger.info(f"[哔哩哔哩] {message.uname} 点赞")
+        logger.info("[哔哩哔哩] %s 点赞", message.uname)
 
     def _on_open_live_enter_room(self, client: blivedm.OpenLiveClient, message: open_models.RoomEnterMessage):
-        logger.info(f"[哔哩哔哩] {message.uname} 进入房间")
+        logger.info("[哔哩哔哩] %s 进入房间", message.uname)
 
     def _on_open_live_start_live(self, client: blivedm.OpenLiveClient, message: open_models.LiveStartMessage):
-        logger.info(f"[哔哩哔哩] 开始直播")
+        logger.info("[哔哩哔哩] 开始直播")
 
     def _on_open_live_end_live(self, client: blivedm.OpenLiveClient, message: open_models.LiveEndMessage):
-        logger.info(f"[哔哩哔哩] 结束直播")
+        logger.info("[哔哩哔哩] 结束直播")
 
 @app.route('/')
 def index():
@@ -2520,10 +3614,10 @@ def index():
         }
         
         if order_commands and current_mode == "秩序":
-            sorted_commands = sorted(order_commands.items(), key=lambda x: x[1][0], reverse=True)
-            formatted_commands = [(cmd, votes[0]) for cmd, votes in sorted_commands]
+            # 与 DemocracyPublisher 的快照/增量一致，显示指令文本而不是统计键
+            formatted_commands = [(display, votes) for _, votes, _, display in order_commands.top(5)]
             democracy_info = {
-                'commands': formatted_commands[:5],
+                'commands': formatted_commands,
                 'time_left': max(0, ORDER_INTERVAL - (time.time() - order_start_time)) if order_start_time else ORDER_INTERVAL
             }
     
@@ -2549,70 +3643,278 @@ def test_reset_vote():
         logger.error(f"Test vote reset failed: {e}")
         return {'success': False, 'message': f'投票重置测试失败: {str(e)}'}
 
+@app.route('/api/stats/commands')
+def command_stats():
+    """统计API：指令解析耗时和解析缓存命中率"""
+    return jsonify(command_grammar.get_stats())
+
+@app.route('/api/stats/ingest')
+def ingest_stats():
+    """统计API：弹幕接收队列深度、丢弃数和排队时间"""
+    return jsonify(danmaku_ingest_queue.get_stats())
+
+@app.route('/api/stats/sse')
+def sse_stats():
+    """统计API：SSE广播帧数、字节数和慢客户端跳过的帧数"""
+    return jsonify(sse_broadcaster.get_stats())
+
+@app.route('/api/stats/input')
+def input_stats():
+    """统计API：按键注入后端名称、按键次数和平均按键耗时"""
+    if input_backend is None:
+        return jsonify({'backend': None})
+    stats = input_backend.get_stats()
+    stats['timing_profiles'] = {context: profile.to_dict() for context, profile in timing_profiles.items()}
+    return jsonify(stats)
+
+@app.route('/api/stats/window')
+def window_stats():
+    """统计API：mGBA 窗口句柄查找次数、跳过的激活次数和焦点丢失次数"""
+    return jsonify(mgba_window.get_stats())
+
+@app.route('/api/stats/anarchy')
+def anarchy_stats():
+    """统计API：自由模式执行期间合并的指令数和合并窗口数"""
+    with latest_command_lock:
+        return jsonify(anarchy_coalescer.get_stats())
+
+@app.route('/api/stats/latency')
+def latency_stats():
+    """统计API：弹幕从接收到按键松开各阶段的延迟分位数"""
+    return jsonify(latency_tracer.get_stats())
+
+@app.route('/api/stats/logging')
+def logging_stats():
+    """统计API：日志限流丢弃的条数"""
+    return jsonify(get_sampling_stats())
+
+def sse_client_lags():
+    """各 SSE 客户端落后的帧数"""
+    return [client['lag_frames'] for client in sse_broadcaster.get_stats()['client_details']]
+
+def register_metrics():
+    """注册抓取 /metrics 时才读取的指标，这些数值来自各组件已有的统计，不增加热路径开销"""
+    registry = metrics_registry
+    registry.register_callback('ingest_queue_depth', 'gauge', 'Danmaku waiting in the ingest queue',
+                               lambda: danmaku_ingest_queue.get_stats()['depth'])
+    registry.register_callback('ingest_dropped_total', 'counter', 'Danmaku dropped because the ingest queue was full',
+                               lambda: danmaku_ingest_queue.dropped_count)
+    registry.register_callback('sse_clients', 'gauge', 'Connected SSE and WebSocket clients',
+                               lambda: sse_broadcaster.clients)
+    registry.register_callback('sse_client_lag_frames_max', 'gauge', 'Largest number of frames any SSE client is behind',
+                               lambda: max(sse_client_lags(), default=0))
+    registry.register_callback('sse_published_total', 'counter', 'Frames published to SSE clients',
+                               lambda: sse_broadcaster.published_count)
+    registry.register_callback('sse_skipped_total', 'counter', 'Frames skipped for slow SSE clients',
+                               lambda: sse_broadcaster.skipped_count)
+    registry.register_callback('sse_evicted_total', 'counter', 'Slow or stalled SSE clients disconnected',
+                               lambda: sse_broadcaster.evicted_count)
+    registry.register_callback('danmaku_rows_written_total', 'counter', 'Danmaku rows written to CSV or archive',
+                               lambda: danmaku_saver.get_stats().get('rows_written', 0))
+    registry.register_callback('executor_busy_ratio', 'gauge', 'Fraction of time spent executing key commands since start',
+                               lambda: round(executor_busy_counter.value() / (time.perf_counter() - metrics_started), 6))
+    registry.register_callback('executing', 'gauge', 'Whether a key command is executing right now',
+                               lambda: 1 if executing_command else 0)
+    registry.register_callback('vote_support_percent', 'gauge', 'Mode vote support',
+                               lambda: [({'mode': 'freedom'}, round(freedom_support, 1)),
+                                        ({'mode': 'order'}, round(100.0 - freedom_support, 1))])
+    registry.register_callback('order_mode', 'gauge', 'Whether order mode is active',
+                               lambda: 1 if current_mode == "秩序" else 0)
+    registry.register_callback('order_round_last_votes', 'gauge', 'Votes cast in the last finished order-mode round',
+                               lambda: last_order_round['votes'])
+    registry.register_callback('order_round_last_commands', 'gauge', 'Distinct commands in the last finished order-mode round',
+                               lambda: last_order_round['commands'])
+    registry.register_callback('anarchy_coalesced_total', 'counter', 'Commands merged into anarchy coalescing windows',
+                               lambda: anarchy_coalescer.coalesced_count)
+    registry.register_callback('douyin_clients', 'gauge', 'Connected Douyin forwarder clients',
+                               lambda: len(douyin_clients))
+    registry.register_callback('command_cache_hit_ratio', 'gauge', 'Command parse LRU cache hit ratio',
+                               lambda: command_grammar.get_stats()['cache_hit_rate'])
+    registry.register_latency('danmaku_latency_seconds', 'Danmaku latency per stage, from frame receipt to key release',
+                              latency_tracer)
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus 指标（文本格式）"""
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/stats/democracy')
+def democracy_stats():
+    """统计API：秩序模式投票更新的标记次数和实际推送次数"""
+    return jsonify(democracy_publisher.get_stats())
+
+@app.route('/api/democracy/snapshot')
+def democracy_snapshot():
+    """秩序模式投票的完整快照（与 democracy_update 消息格式相同），客户端增量基线不一致时调用"""
+    return jsonify(democracy_publisher.resync_snapshot())
+
+@app.route('/api/stats/csv')
+def csv_stats():
+    """统计API：弹幕CSV写入行数、字节数和写盘耗时"""
+    return jsonify(danmaku_saver.get_stats())
+
+def parse_query_time(value, default=None):
+    """解析查询参数中的时间：支持秒级时间戳或 '2025-08-26 10:45:23' 格式"""
+    if value is None or value == '':
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+def parse_query_range():
+    """从请求参数中解析时间范围，未指定 start 时默认查询最近 last 秒（默认1小时）"""
+    end = parse_query_time(request.args.get('end'), time.time())
+    start = parse_query_time(request.args.get('start'))
+    if start is None:
+        start = end - float(request.args.get('last', 3600))
+    return start, end
+
+def archive_inactive_response():
+    """弹幕没有写入归档（danmaku_log.backend 不是 archive）时返回 409 错误，否则返回 None"""
+    if DANMAKU_LOG_BACKEND == 'archive':
+        return None
+    return {'success': False,
+            'message': f'历史弹幕查询需要将 danmaku_log.backend 设置为 archive（当前为 {DANMAKU_LOG_BACKEND}）'}, 409
+
+@app.route('/api/danmaku/history')
+def danmaku_history():
+    """历史弹幕API：按时间范围/用户/平台/指令筛选归档中的弹幕，以NDJSON流式返回"""
+    inactive = archive_inactive_response()
+    if inactive:
+        return inactive
+    try:
+        start, end = parse_query_range()
+        limit = min(int(request.args.get('limit', 1000)), 100000)
+    except ValueError as e:
+        return {'success': False, 'message': f'参数错误: {str(e)}'}, 400
+    
+    username = request.args.get('user')
+    platform_name = request.args.get('platform')
+    command = request.args.get('command')
+    
+    def generate():
+        for message in danmaku_query.iter_messages(start, end, username, platform_name, command, limit):
+            yield json.dumps(message, ensure_ascii=False) + '\n'
+    
+    return Response(generate(), mimetype='application/x-ndjson')
+
+@app.route('/api/danmaku/stats')
+def danmaku_history_stats():
+    """历史弹幕统计API：按指令/用户/平台统计时间范围内的弹幕数量，如最近一小时的热门指令"""
+    inactive = archive_inactive_response()
+    if inactive:
+        return inactive
+    try:
+        start, end = parse_query_range()
+        top = min(int(request.args.get('top', 10)), 1000)
+        result = danmaku_query.aggregate(request.args.get('group_by', 'command'), start, end,
+                                         request.args.get('user'), request.args.get('platform'), top)
+    except ValueError as e:
+        return {'success': False, 'message': f'参数错误: {str(e)}'}, 400
+    return jsonify(result)
+
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'Connection': 'keep-alive',
+    'Access-Control-Allow-Origin': '*'
+}
+
+def parse_last_event_id(value):
+    """解析 Last-Event-ID，无效时返回 None"""
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+def open_sse_client(remote, last_event_id=None):
+    """注册SSE/WebSocket客户端，返回 (客户端状态, 初始消息列表)"""
+    # 注册客户端，同时取投票快照，之后的增量都基于它
+    with sse_lock:
+        client = sse_broadcaster.connect(remote, last_event_id)
+        democracy_snapshot = democracy_publisher.snapshot_message()
+    if client['resumed']:
+        logger.info("SSE client resumed from event %s. Total clients: %s", last_event_id, sse_broadcaster.clients)
+        # 续传时断开期间的事件会从环形缓冲区补发，不需要再发送初始状态
+        return client, []
+    logger.info("New SSE client connected. Total clients: %s", sse_broadcaster.clients)
+    
+    # 投票快照和当前队列中的所有弹幕
+    with danmaku_lock:
+        initial_danmaku = list(danmaku_display_queue)
+    return client, [democracy_snapshot] + initial_danmaku
+
+def close_sse_client(client):
+    """移除SSE客户端"""
+    sse_broadcaster.disconnect(client)
+    logger.info("SSE client disconnected. Remaining clients: %s", sse_broadcaster.clients)
+
+def publish_sse_heartbeat():
+    """计算一次心跳包（运行时间和模式信息）并广播给所有SSE客户端"""
+    if not sse_broadcaster.clients:
+        return  # 没有客户端时不计算
+    
+    with mode_lock:
+        mode_info = {
+            'current_mode': current_mode,
+            'freedom_support': round(freedom_support, 1),
+            'order_support': round(100.0 - freedom_support, 1)
+        }
+    
+    # 使用推送器最近一次推送的快照，与增量保持同一基线
+    with sse_lock:
+        snapshot = democracy_publisher.snapshot_message()
+        democracy_info = {}
+        if mode_info['current_mode'] == "秩序" and snapshot['democracy_info']['commands']:
+            democracy_info = snapshot['democracy_info']
+        
+        heartbeat_data = {
+            'type': 'heartbeat', 
+            'runtime': get_runtime(),
+            'game_duration': get_game_duration(),
+            'mode_info': mode_info,
+            'democracy_info': democracy_info,
+            'democracy_seq': snapshot['seq']
+        }
+        # 在 sse_lock 内发布，保证心跳中的快照序号与前后的增量一致
+        sse_broadcaster.publish(heartbeat_data)
+
+def sse_heartbeat_thread():
+    """SSE心跳线程：每 SSE_HEARTBEAT_INTERVAL 秒广播一次同一份心跳包"""
+    logger.info("SSE heartbeat thread started")
+    while True:
+        time.sleep(SSE_HEARTBEAT_INTERVAL)
+        try:
+            publish_sse_heartbeat()
+        except Exception as e:
+            logger.error("Error publishing SSE heartbeat: %s", e)
+
 @app.route('/api/danmaku/stream')
 def danmaku_stream():
     """SSE端点：实时推送弹幕数据"""
+    remote = request.remote_addr
+    # 浏览器自动重连时带 Last-Event-ID 头，页面脚本手动重连时用 last_event_id 参数
+    last_event_id = parse_last_event_id(request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+    
     def event_stream():
-        client_queue = queue.Queue()
-        
-        # 添加客户端到列表
-        with sse_lock:
-            sse_clients.append(client_queue)
-            logger.info(f"New SSE client connected. Total clients: {len(sse_clients)}")
-        
+        client, initial_messages = open_sse_client(remote, last_event_id)
         try:
-            # 首先发送当前队列中的所有弹幕
-            with danmaku_lock:
-                for danmaku in danmaku_display_queue:
-                    yield f"data: {json.dumps(danmaku)}\n\n"
+            if initial_messages:
+                yield b''.join(SSEBroadcaster.encode(message) for message in initial_messages)
             
-            # 持续监听新的弹幕
+            # 持续读取广播帧
             while True:
-                try:
-                    danmaku = client_queue.get(timeout=30)  # 30秒超时
-                    yield f"data: {json.dumps(danmaku)}\n\n"
-                except queue.Empty:
-                    # 发送心跳包保持连接，包含模式信息
-                    with mode_lock:
-                        mode_info = {
-                            'current_mode': current_mode,
-                            'freedom_support': round(freedom_support, 1),
-                            'order_support': round(100.0 - freedom_support, 1)
-                        }
-                    
-                    democracy_info = {}
-                    if current_mode == "秩序":
-                        with order_lock:
-                            if order_commands:
-                                sorted_commands = sorted(order_commands.items(), key=lambda x: x[1][0], reverse=True)
-                                # 转换为前端需要的格式：[display_command, vote_count]
-                                formatted_commands = [(votes[2] if len(votes) > 2 else cmd, votes[0]) for cmd, votes in sorted_commands]
-                                democracy_info = {
-                                    'commands': formatted_commands[:5],
-                                    'time_left': max(0, ORDER_INTERVAL - (time.time() - order_start_time)) if order_start_time else ORDER_INTERVAL
-                                }
-                    
-                    heartbeat_data = {
-                        'type': 'heartbeat', 
-                        'runtime': get_runtime(),
-                        'game_duration': get_game_duration(),
-                        'mode_info': mode_info,
-                        'democracy_info': democracy_info
-                    }
-                    yield f"data: {json.dumps(heartbeat_data)}\n\n"
+                frames = sse_broadcaster.read(client, timeout=SSE_HEARTBEAT_INTERVAL)
+                if client['evicted']:
+                    break  # 落后过多或长时间未读取，断开后由浏览器重连
+                if frames:
+                    yield frames  # 心跳包由心跳线程统一广播
         except GeneratorExit:
             pass
         finally:
-            # 移除客户端
-            with sse_lock:
-                if client_queue in sse_clients:
-                    sse_clients.remove(client_queue)
-                    logger.info(f"SSE client disconnected. Remaining clients: {len(sse_clients)}")
+            close_sse_client(client)
     
-    return Response(event_stream(), mimetype='text/event-stream',
-                   headers={'Cache-Control': 'no-cache',
-                           'Connection': 'keep-alive',
-                           'Access-Control-Allow-Origin': '*'})
+    return Response(event_stream(), mimetype='text/event-stream', headers=SSE_HEADERS)
 
 def run_web_server():
     """运行 Flask Web 服务器"""
@@ -2623,58 +3925,479 @@ def run_web_server():
     
     logger.info("=" * 50)
     logger.info("Flask Web Server Starting...")
-    logger.info("Frontend URL: http://localhost:5000")
-    logger.info("SSE Stream: http://localhost:5000/api/danmaku/stream")
+    logger.info(f"Frontend URL: http://localhost:{WEB_SERVER_PORT}")
+    logger.info(f"SSE Stream: http://localhost:{WEB_SERVER_PORT}/api/danmaku/stream")
     logger.info("=" * 50)
     
-    app.run(host='0.0.0.0', port=5000, debug=False, use_reloader=False)
+    app.run(host='0.0.0.0', port=WEB_SERVER_PORT, debug=False, use_reloader=False)
+
+async def aiohttp_danmaku_stream(request: web.Request):
+    """异步Web服务器的SSE端点：每个客户端是一个协程，不占用线程"""
+    last_event_id = parse_last_event_id(request.headers.get('Last-Event-ID') or request.query.get('last_event_id'))
+    response = web.StreamResponse(headers=dict(SSE_HEADERS, **{'Content-Type': 'text/event-stream'}))
+    await response.prepare(request)
+    
+    client, initial_messages = open_sse_client(request.remote, last_event_id)
+    try:
+        if initial_messages:
+            await response.write(b''.join(SSEBroadcaster.encode(message) for message in initial_messages))
+        
+        # 持续读取广播帧
+        while True:
+            frames = await sse_broadcaster.read_async(client, timeout=SSE_HEARTBEAT_INTERVAL)
+            if client['evicted']:
+                break  # 落后过多或长时间未读取，断开后由浏览器重连
+            if frames:
+                await response.write(frames)  # 心跳包由心跳线程统一广播
+    except ConnectionResetError:
+        pass  # 客户端已断开
+    finally:
+        close_sse_client(client)
+    return response
+
+def parse_ws_channels(value):
+    """解析订阅频道（逗号分隔的字符串或列表），无效频道被忽略，为空时订阅全部"""
+    if isinstance(value, str):
+        value = value.split(',')
+    channels = {channel.strip() for channel in value or () if isinstance(channel, str)} & set(WS_CHANNELS)
+    return channels or set(WS_CHANNELS)
+
+async def aiohttp_danmaku_ws(request: web.Request):
+    """WebSocket推送端点：紧凑格式，permessage-deflate 压缩，支持按频道订阅
+
+    连接参数 ?channels=danmaku,votes 或连接后发送 {"subscribe": ["danmaku", "votes"]} 设置订阅频道。
+    每条 WebSocket 消息是一批紧凑消息组成的 JSON 数组。
+    """
+    ws = web.WebSocketResponse(compress=True, heartbeat=SSE_HEARTBEAT_INTERVAL)
+    await ws.prepare(request)
+    
+    channels = parse_ws_channels(request.query.get('channels'))  # 原地更新，等待中的读取也会使用新的订阅
+    client, initial_messages = open_sse_client(request.remote)
+    
+    async def push():
+        compact_messages = [compact_event(message) for message in initial_messages]
+        frames = [encode_compact(compact) for channel, compact in compact_messages if channel in channels]
+        while not ws.closed:
+            if frames:
+                await ws.send_str('[' + ','.join(frames) + ']')
+            frames = await sse_broadcaster.read_compact_async(client, SSE_HEARTBEAT_INTERVAL, channels)
+            if client['evicted']:
+                await ws.close()
+                break
+    
+    push_task = asyncio.create_task(push())
+    try:
+        # 接收客户端的订阅请求，连接关闭时结束
+        async for msg in ws:
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                continue
+            try:
+                request_data = json.loads(msg.data)
+            except ValueError:
+                continue
+            if isinstance(request_data, dict) and 'subscribe' in request_data:
+                new_channels = parse_ws_channels(request_data['subscribe'])
+                channels.clear()
+                channels.update(new_channels)
+                logger.info("WebSocket client %s subscribed to %s", client['id'], sorted(channels))
+    finally:
+        # 先移除客户端：连接断开时处理协程可能在下面的 await 处被取消
+        close_sse_client(client)
+        push_task.cancel()
+        await asyncio.gather(push_task, return_exceptions=True)
+    return ws
+
+def call_flask_app(method, path, query_string, headers, body, remote):
+    """以 WSGI 方式调用 Flask 应用，返回 (状态码, 响应头, 响应体可迭代对象)
+
+    响应体可能是流式生成器（如 /api/danmaku/history），由调用方逐块读取并在结束后调用 close()。
+    """
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': query_string,
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': str(WEB_SERVER_PORT),
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'REMOTE_ADDR': remote or '',
+        'CONTENT_TYPE': headers.get('Content-Type', ''),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    for name, value in headers.items():
+        key = 'HTTP_' + name.upper().replace('-', '_')
+        if key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+            environ[key] = value
+    
+    response_start = []
+    def start_response(status, response_headers, exc_info=None):
+        response_start[:] = [status, response_headers]
+    
+    result = app.wsgi_app(environ, start_response)
+    status, response_headers = response_start
+    return int(status.split(' ', 1)[0]), response_headers, result
+
+def close_wsgi_result(result):
+    """WSGI 规范要求响应体读取结束（包括客户端中途断开）后调用 close()"""
+    if hasattr(result, 'close'):
+        result.close()
+
+async def aiohttp_flask_bridge(request: web.Request):
+    """异步Web服务器的其余路由（页面、测试和统计API、静态文件）交给 Flask 在线程池中处理
+
+    响应体逐块转发：流式响应（如导出弹幕历史）不会整体缓存在内存中，
+    生成器可能阻塞（读文件、查询），每一块都在线程池中取出。
+    客户端断开时处理协程被取消，线程池中的 next() 可能还在执行，关闭响应体前需要等它返回。
+    """
+    loop = asyncio.get_running_loop()
+    body = await request.read()
+    status, headers, result = await loop.run_in_executor(
+        None, call_flask_app, request.method, request.path, request.query_string,
+        request.headers, body, request.remote)
+    result_lock = threading.Lock()  # 同一时刻只能有一个线程读取或关闭响应体
+    
+    def next_chunk(chunks):
+        with result_lock:
+            return next(chunks, None)
+    
+    def close_result():
+        with result_lock:
+            close_wsgi_result(result)
+    
+    try:
+        response = web.StreamResponse(status=status)
+        for name, value in headers:
+            if name.lower() not in ('connection', 'transfer-encoding'):
+                response.headers.add(name, value)
+        await response.prepare(request)
+        chunks = iter(result)
+        while True:
+            chunk = await loop.run_in_executor(None, next_chunk, chunks)
+            if chunk is None:
+                break
+            if chunk:
+                await response.write(chunk)
+        await response.write_eof()
+        return response
+    finally:
+        await loop.run_in_executor(None, close_result)
+
+def create_aiohttp_app():
+    """异步Web服务器的路由：SSE 和 WebSocket 由协程处理，其余交给 Flask"""
+    web_app = web.Application()
+    web_app.router.add_get('/api/danmaku/stream', aiohttp_danmaku_stream)
+    web_app.router.add_get('/api/danmaku/ws', aiohttp_danmaku_ws)
+    web_app.router.add_route('*', '/{tail:.*}', aiohttp_flask_bridge)
+    return web_app
+
+async def start_aiohttp_web_server():
+    """在当前事件循环上启动异步Web服务器，返回 AppRunner（关闭时调用 cleanup）"""
+    sse_broadcaster.attach_loop(asyncio.get_running_loop())
+    
+    # 客户端断开时取消处理协程，SSE客户端能立即移除
+    runner = web.AppRunner(create_aiohttp_app(), access_log=None, handler_cancellation=True)
+    await runner.setup()
+    site = web.TCPSite(runner, '0.0.0.0', WEB_SERVER_PORT)
+    await site.start()
+    
+    logger.info("=" * 50)
+    logger.info("Async Web Server Started (aiohttp)")
+    logger.info(f"Frontend URL: http://localhost:{WEB_SERVER_PORT}")
+    logger.info(f"SSE Stream: http://localhost:{WEB_SERVER_PORT}/api/danmaku/stream")
+    logger.info(f"WebSocket: ws://localhost:{WEB_SERVER_PORT}/api/danmaku/ws")
+    logger.info("=" * 50)
+    return runner
+
+class AsyncRuntime:
+    """单事件循环运行时：原来各自轮询的后台线程改为与弹幕客户端同一事件循环上的 asyncio 任务
+
+    定时任务按截止时间休眠，执行器和秩序模式任务由事件唤醒；阻塞的按键注入（pyautogui/win32）
+    全部交给单线程执行器串行执行；弹幕处理（process_danmaku_command）在另一个单线程执行器中执行。Web 服务器在 flask 模式下仍运行在自己的线程中，aiohttp 模式下也在该事件循环上。
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.input_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='mgba-input')
+        self.ingest_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='danmaku-ingest')  # 弹幕处理，与按键注入分开
+        self.latest_command_event = asyncio.Event()
+        self._mode_events = []  # 每个等待模式变化的任务各有一个事件
+        self.tasks = []
+    
+    def notify_latest_command(self):
+        self.loop.call_soon_threadsafe(self.latest_command_event.set)
+    
+    def notify_mode_changed(self):
+        for event in self._mode_events:
+            self.loop.call_soon_threadsafe(event.set)
+    
+    def _new_mode_event(self):
+        event = asyncio.Event()
+        self._mode_events.append(event)
+        return event
+    
+    def run_input(self, func, *args):
+        """在按键执行器中运行阻塞的按键注入函数"""
+        return self.loop.run_in_executor(self.input_executor, func, *args)
+    
+    def start(self):
+        """创建所有后台任务"""
+        global game_start_time
+        game_start_time = time.time()  # 设置本次启动时间
+        
+        coroutines = [
+            danmaku_ingest_queue.run_async(self.ingest_executor),
+            democracy_publisher.run_async(),
+            self._anarchy_executor(),
+            self._order_rounds(),
+            self._auto_input(),
+            self._auto_save(),
+            self._config_hot_reload(),
+            self._game_duration(),
+            self._sse_heartbeat()
+        ]
+        if VOTING_ENABLED:
+            coroutines.append(self._order_mode_timeout())
+        
+        for coroutine in coroutines:
+            self.tasks.append(asyncio.create_task(self._guard(coroutine)))
+        logger.info("Async runtime started with %s tasks", len(self.tasks))
+    
+    async def stop(self):
+        """取消所有后台任务并关闭按键执行器和弹幕处理执行器"""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.input_executor.shutdown(wait=False)
+        self.ingest_executor.shutdown(wait=False)
+    
+    @staticmethod
+    async def _guard(coroutine):
+        """任务异常退出时记录日志，避免静默停止"""
+        try:
+            await coroutine
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Async runtime task %s crashed: %s", coroutine.__qualname__, e)
+    
+    async def _anarchy_executor(self):
+        """自由模式执行器：有新的最新指令时才唤醒"""
+        global latest_command, latest_command_trace
+        logger.info("Anarchy executor task started")
+        while True:
+            await self.latest_command_event.wait()
+            self.latest_command_event.clear()
+            
+            with latest_command_lock:
+                command_to_execute = latest_command
+                command_trace = latest_command_trace
+                latest_command = None  # 清空最新指令
+                latest_command_trace = None
+            
+            if command_to_execute:
+                logger.info("Executing latest command: %s", command_to_execute.raw)
+                await self.run_input(execute_freedom_command, command_to_execute, command_trace)
+                promote_coalesced_command()
+    
+    async def _order_rounds(self):
+        """秩序模式执行任务：休眠到本轮截止时间，不在秩序模式时等待模式切换"""
+        mode_event = self._new_mode_event()
+        logger.info("Order round task started")
+        while True:
+            mode_event.clear()
+            time_left = order_round_time_left()
+            if time_left is None:
+                await mode_event.wait()
+                continue
+            if time_left > 0:
+                await asyncio.sleep(time_left)
+                continue
+            
+            winning_command, winning_display_command = collect_order_winner()
+            if winning_command:
+                await self.run_input(execute_order_winner, winning_command, winning_display_command)
+    
+    async def _order_mode_timeout(self):
+        """秩序模式维持 ORDER_MODE_TIMEOUT 秒后强制切换为自由模式"""
+        mode_event = self._new_mode_event()
+        logger.info("Order mode timeout task started")
+        while True:
+            mode_event.clear()
+            with mode_lock:
+                in_order_mode = current_mode == "秩序"
+            if not in_order_mode:
+                await mode_event.wait()
+                continue
+            
+            logger.info("Order mode started, 3-minute timeout timer activated")
+            try:
+                # 超时前离开秩序模式会被模式切换事件唤醒
+                await asyncio.wait_for(mode_event.wait(), timeout=ORDER_MODE_TIMEOUT)
+                logger.info("Switched out of order mode, timeout timer reset")
+            except asyncio.TimeoutError:
+                await self.loop.run_in_executor(None, force_freedom_mode)
+    
+    async def _auto_input(self):
+        """无人值守时自动输入：休眠到超时时间点，而不是每秒检查"""
+        global auto_mode
+        while True:
+            with auto_input_lock:
+                wait_time = last_command_time + AUTO_INPUT_TIMEOUT - time.time()
+                if wait_time <= 0 and not auto_mode:
+                    auto_mode = True
+                    logger.info("Entering auto mode - no commands received for 120 seconds")
+            
+            if wait_time > 0:
+                await asyncio.sleep(wait_time)
+                continue
+            
+            emit_auto_input()
+            await asyncio.sleep(AUTO_INPUT_INTERVAL)
+    
+    async def _auto_save(self):
+        """每 AUTO_SAVE_INTERVAL 秒循环发送 Shift+F1~Shift+F9"""
+        save_slot = 1  # 当前存档位，从F1开始
+        logger.info("Auto-save task started")
+        while True:
+            await asyncio.sleep(AUTO_SAVE_INTERVAL)
+            try:
+                if await self.run_input(perform_auto_save, save_slot):
+                    # 循环到下一个存档位 (F1~F9)
+                    save_slot = save_slot % 9 + 1
+            except Exception as e:
+                logger.error("Auto-save error: %s", e)
+    
+    async def _config_hot_reload(self):
+        """每 CONFIG_RELOAD_INTERVAL 秒热更新配置"""
+        while True:
+            await asyncio.sleep(CONFIG_RELOAD_INTERVAL)
+            await self.loop.run_in_executor(None, reload_hot_config)
+    
+    async def _sse_heartbeat(self):
+        """每 SSE_HEARTBEAT_INTERVAL 秒广播一次心跳包"""
+        while True:
+            await asyncio.sleep(SSE_HEARTBEAT_INTERVAL)
+            try:
+                publish_sse_heartbeat()
+            except Exception as e:
+                logger.error("Error publishing SSE heartbeat: %s", e)
+    
+    async def _game_duration(self):
+        """每秒保存一次游戏时长"""
+        while True:
+            await asyncio.sleep(1)
+            await self.loop.run_in_executor(None, save_total_game_duration)
 
 async def main():
     """主函数"""
     load_config()  # 首先加载配置
+    # 日志改为在后台线程输出，并按调用位置限流
+    log_listener = start_async_logging(LOG_SAMPLE_INTERVAL, LOG_SAMPLE_BURST) if LOG_ASYNC else None
     init_session()
     load_or_set_start_time()
     load_game_duration()  # 加载游戏时长
     
-    # 启动Web服务器线程
-    web_thread = threading.Thread(target=run_web_server, daemon=True)
-    web_thread.start()
-    
-    # 启动指令执行线程（无政府模式）
-    command_thread = threading.Thread(target=execute_latest_command, daemon=True)
-    command_thread.start()
-    logger.info("Started command execution thread (anarchy mode)")
-    
-    # 启动秩序模式执行线程
-    order_thread = threading.Thread(target=order_execution_thread, daemon=True)
-    order_thread.start()
-    logger.info("Started order execution thread")
-    
-    # 启动自动输入线程
-    auto_thread = threading.Thread(target=auto_input_thread, daemon=True)
-    auto_thread.start()
-    logger.info("Started auto input thread")
-    
-    # 启动自动存档守护线程
-    auto_save_thread = threading.Thread(target=auto_save_daemon, daemon=True)
-    auto_save_thread.start()
-    logger.info("Started auto-save daemon thread")
-    
-    # 启动配置热更新线程
-    config_reload_thread = threading.Thread(target=config_hot_reload_thread, daemon=True)
-    config_reload_thread.start()
-    logger.info("Started config hot reload thread")
-    
-    # 启动秩序模式超时线程
-    if VOTING_ENABLED:
-        order_timeout_thread = threading.Thread(target=order_mode_timeout_thread, daemon=True)
-        order_timeout_thread.start()
-        logger.info("Started order mode timeout thread")
-    
-    # 启动游戏时长更新线程
-    duration_thread = threading.Thread(target=game_duration_thread, daemon=True)
-    duration_thread.start()
-    logger.info("Started game duration thread")
+    # 启动Web服务器：异步模式在当前事件循环上运行，否则使用 Flask 线程
+    web_runner = None
+    if WEB_SERVER_MODE == 'aiohttp':
+        web_runner = await start_aiohttp_web_server()
+    else:
+        web_thread = threading.Thread(target=run_web_server, daemon=True)
+        web_thread.start()
+    
+    # 选择弹幕保存方式并设置写入模式
+    global danmaku_saver
+    if DANMAKU_LOG_BACKEND == 'archive':
+        danmaku_saver = DanmakuArchiveSaver()
+        logger.info("Danmaku will be saved to compressed archive segments")
+    danmaku_saver.configure(DANMAKU_WRITE_BEHIND, DANMAKU_FLUSH_ROWS, DANMAKU_FLUSH_INTERVAL)
+    
+    danmaku_ingest_queue.configure(INGEST_QUEUE_SIZE, INGEST_QUEUE_POLICY)
+    register_metrics()
+    sse_broadcaster.configure(SSE_RING_SIZE, SSE_MAX_LAG, SSE_SLOW_CLIENT_POLICY, SSE_STALL_TIMEOUT)
+    with latest_command_lock:
+        anarchy_coalescer.configure(ANARCHY_GROUP_BY)
+    latency_tracer.enabled = LATENCY_TRACING
+    
+    # 按配置选择按键注入后端
+    global input_backend
+    if INPUT_BACKEND == 'pyautogui':
+        input_options = {'pause': INPUT_PYAUTOGUI_PAUSE}
+    elif INPUT_BACKEND == 'socket':
+        input_options = {'host': INPUT_SOCKET_HOST, 'port': INPUT_SOCKET_PORT}
+    elif INPUT_BACKEND == 'recording':
+        input_options = {'simulate_timing': INPUT_SIMULATE_TIMING}
+    else:
+        input_options = {}
+    if INPUT_BACKEND in ('pyautogui', 'win32') and win32gui is None:
+        raise RuntimeError(f"Input backend '{INPUT_BACKEND}' needs pywin32 to focus the mGBA window")
+    input_backend = create_input_backend(INPUT_BACKEND, activate_mgba_window, **input_options)
+    logger.info(f"Using input backend: {input_backend.name}")
+    global timing_profiles
+    timing_profiles = build_timing_profiles(INPUT_TIMING_PROFILES)
+    
+    global async_runtime
+    if RUNTIME_MODE == 'asyncio':
+        # 所有后台任务运行在当前事件循环上，按键注入交给单线程执行器
+        async_runtime = AsyncRuntime(asyncio.get_running_loop())
+        async_runtime.start()
+    else:
+        # 启动弹幕接收队列消费线程
+        ingest_thread = threading.Thread(target=danmaku_ingest_queue.run, daemon=True)
+        ingest_thread.start()
+        logger.info("Started danmaku ingest consumer thread")
+        
+        # 启动指令执行线程（无政府模式）
+        command_thread = threading.Thread(target=execute_latest_command, daemon=True)
+        command_thread.start()
+        logger.info("Started command execution thread (anarchy mode)")
+        
+        # 启动秩序模式投票更新推送线程
+        democracy_thread = threading.Thread(target=democracy_publisher.run, daemon=True)
+        democracy_thread.start()
+        logger.info("Started democracy publisher thread")
+        
+        # 启动秩序模式执行线程
+        order_thread = threading.Thread(target=order_execution_thread, daemon=True)
+        order_thread.start()
+        logger.info("Started order execution thread")
+        
+        # 启动自动输入线程
+        auto_thread = threading.Thread(target=auto_input_thread, daemon=True)
+        auto_thread.start()
+        logger.info("Started auto input thread")
+        
+        # 启动自动存档守护线程
+        auto_save_thread = threading.Thread(target=auto_save_daemon, daemon=True)
+        auto_save_thread.start()
+        logger.info("Started auto-save daemon thread")
+        
+        # 启动配置热更新线程
+        config_reload_thread = threading.Thread(target=config_hot_reload_thread, daemon=True)
+        config_reload_thread.start()
+        logger.info("Started config hot reload thread")
+        
+        # 启动秩序模式超时线程
+        if VOTING_ENABLED:
+            order_timeout_thread = threading.Thread(target=order_mode_timeout_thread, daemon=True)
+            order_timeout_thread.start()
+            logger.info("Started order mode timeout thread")
+        
+        # 启动SSE心跳线程
+        heartbeat_thread = threading.Thread(target=sse_heartbeat_thread, daemon=True)
+        heartbeat_thread.start()
+        logger.info("Started SSE heartbeat thread")
+        
+        # 启动游戏时长更新线程
+        duration_thread = threading.Thread(target=game_duration_thread, daemon=True)
+        duration_thread.start()
+        logger.info("Started game duration thread")
     
     # 启动抖音WebSocket服务器
     if DOUYIN_ENABLED:
@@ -2694,13 +4417,26 @@ async def main():
         if session:
             await session.close()
             logger.info("HTTP session closed")
+        # 关闭异步Web服务器
+        if web_runner:
+            await web_runner.cleanup()
+            logger.info("Async web server closed")
+        # 停止事件循环运行时的后台任务
+        if async_runtime:
+            await async_runtime.stop()
         # 关闭弹幕保存器
         danmaku_saver.close()
+        # 关闭按键注入后端
+        if input_backend:
+            input_backend.close()
         # 关闭抖音WebSocket服务器
         if douyin_websocket_server:
             douyin_websocket_server.close()
             await douyin_websocket_server.wait_closed()
             logger.info("Douyin WebSocket server closed")
+        # 最后停止异步日志，写完队列中剩余的日志
+        if log_listener:
+            stop_async_logging(log_listener)
 
 if __name__ == "__main__":
     asyncio.run(main())
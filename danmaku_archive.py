@@ -0,0 +1,523 @@
+# -*- coding: utf-8 -*-
+"""
+弹幕归档：追加写入的压缩分段文件 + 时间索引
+
+相比每1000条轮转一个CSV，归档把一天的弹幕写进一个（超过大小上限时为少数几个）分段文件，
+按时间范围查询时只需读取索引定位到相关的块，不必扫描所有文件。
+
+目录结构：
+    danmaku/archive/20250826.dmz     分段文件，由多个 gzip 块首尾相接组成，每块是一批 CSV 行
+    danmaku/archive/20250826.idx     索引文件，每行一个 JSON，对应分段文件中的一个块
+    danmaku/archive/20250826-1.dmz   当天的分段超过大小上限后继续写入的分段
+
+每个块可以单独解压，整个分段文件也可以直接用 gzip 工具解压成 CSV。
+块内每行的列见 ARCHIVE_COLUMNS，索引行格式：
+    {"offset": 0, "length": 1234, "rows": 500, "first": 1756176300.0, "last": 1756176301.0,
+     "executed": 480, "platforms": {"哔哩哔哩": 500}, "commands": {"a": 300, ...}, "commands_complete": true,
+     "users": "<布隆过滤器>", "users_bits": 4000}
+
+索引中的块汇总（平台、指令计数和用户布隆过滤器）让 DanmakuQuery 在统计时可以跳过完全落在
+时间范围内的块的解压，按用户查询时可以跳过肯定不包含该用户的块。
+"""
+
+import base64
+import bisect
+import csv
+import io
+import json
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+from datetime import datetime
+from collections import Counter
+from typing import Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+# 块内CSV列：第一列是便于查询的秒级时间戳，其余与弹幕CSV相同
+ARCHIVE_COLUMNS = ['时间(秒)', '时间戳', '用户名', '指令内容', '是否执行', '平台']
+
+SEGMENT_SUFFIX = '.dmz'
+INDEX_SUFFIX = '.idx'
+SEGMENT_NAME_PATTERN = re.compile(r'^(\d{8})(?:-(\d+))?\.dmz$')
+
+SUMMARY_MAX_COMMANDS = 64  # 每个块索引中最多记录的不同指令数，超出时统计需要解压该块
+USER_BLOOM_BITS_PER_ROW = 8  # 用户布隆过滤器每行弹幕分配的位数（3个哈希，误判率约3%）
+USER_BLOOM_HASHES = 3
+
+
+def _day_key(epoch: float) -> str:
+    return datetime.fromtimestamp(epoch).strftime('%Y%m%d')
+
+
+def _compress_block(text: str, level: int) -> bytes:
+    """把一批CSV文本压缩成一个独立的 gzip 块"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31 输出gzip格式
+    return compressor.compress(text.encode('utf-8')) + compressor.flush()
+
+
+def _decompress_block(data: bytes) -> str:
+    return zlib.decompress(data, 31).decode('utf-8')
+
+
+def normalize_command(command: str) -> str:
+    """统计指令时使用的归一化形式"""
+    return command.strip().lower()
+
+
+def _bloom_positions(value: str, bits: int) -> list:
+    data = value.encode('utf-8')
+    h1 = zlib.crc32(data)
+    h2 = zlib.adler32(data) | 1
+    return [(h1 + i * h2) % bits for i in range(USER_BLOOM_HASHES)]
+
+
+def _build_user_bloom(usernames) -> tuple:
+    """为一个块中的用户名构建布隆过滤器，返回 (base64编码, 位数)"""
+    usernames = set(usernames)
+    bits = max(64, len(usernames) * USER_BLOOM_BITS_PER_ROW)
+    bits = (bits + 7) // 8 * 8
+    bloom = bytearray(bits // 8)
+    for username in usernames:
+        for position in _bloom_positions(username, bits):
+            bloom[position >> 3] |= 1 << (position & 7)
+    return base64.b64encode(bytes(bloom)).decode('ascii'), bits
+
+
+def block_may_contain_user(entry: dict, username: str) -> bool:
+    """根据块索引中的布隆过滤器判断块是否可能包含该用户（没有过滤器时返回 True）"""
+    if 'users' not in entry:
+        return True
+    bloom = entry.get('_users_bytes')
+    if bloom is None:
+        bloom = entry['_users_bytes'] = base64.b64decode(entry['users'])
+    bits = entry['users_bits']
+    return all(bloom[position >> 3] & (1 << (position & 7)) for position in _bloom_positions(username, bits))
+
+
+def summarize_block(rows: list, offset: int, length: int) -> dict:
+    """生成块的索引项：位置、时间范围以及平台/指令计数和用户布隆过滤器"""
+    epochs = [float(row[0]) for row in rows]
+    commands = Counter(normalize_command(row[3]) for row in rows)
+    users, users_bits = _build_user_bloom(row[2] for row in rows)
+    return {
+        'offset': offset,
+        'length': length,
+        'rows': len(rows),
+        'first': min(epochs),
+        'last': max(epochs),
+        'executed': sum(1 for row in rows if str(row[4]) == '1'),
+        'platforms': dict(Counter(row[5] for row in rows)),
+        'commands': dict(commands.most_common(SUMMARY_MAX_COMMANDS)),
+        'commands_complete': len(commands) <= SUMMARY_MAX_COMMANDS,
+        'users': users,
+        'users_bits': users_bits
+    }
+
+
+class ArchiveWriter:
+    """归档写入器：每次写入一批弹幕生成一个压缩块，并在索引中追加一行"""
+
+    def __init__(self, base_dir: str, max_segment_bytes: int = 256 * 1024 * 1024, compress_level: int = 6):
+        self.base_dir = base_dir
+        self.max_segment_bytes = max_segment_bytes
+        self.compress_level = compress_level
+        self.current_day = None
+        self.current_part = 0
+        self.segment_handle = None
+        self.index_handle = None
+        self._lock = threading.Lock()
+
+        # 写入统计
+        self.blocks_written = 0
+        self.rows_written = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+
+        if not os.path.exists(self.base_dir):
+            os.makedirs(self.base_dir)
+            logger.info("Created directory: %s", self.base_dir)
+
+    @property
+    def current_segment(self) -> Optional[str]:
+        return self.segment_handle.name if self.segment_handle else None
+
+    def _segment_path(self, day: str, part: int) -> str:
+        name = day if part == 0 else f"{day}-{part}"
+        return os.path.join(self.base_dir, name + SEGMENT_SUFFIX)
+
+    def _close_segment(self):
+        if self.segment_handle:
+            self.segment_handle.close()
+            self.index_handle.close()
+            self.segment_handle = None
+            self.index_handle = None
+
+    def _open_segment(self, day: str):
+        """打开当天最新的分段，超过大小上限时换到下一个分段"""
+        self._close_segment()
+
+        part = 0
+        while os.path.exists(self._segment_path(day, part + 1)):
+            part += 1
+        segment_path = self._segment_path(day, part)
+        if os.path.exists(segment_path) and os.path.getsize(segment_path) >= self.max_segment_bytes:
+            part += 1
+            segment_path = self._segment_path(day, part)
+
+        index_path = segment_path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+        self._recover_tail(segment_path, index_path)
+
+        self.segment_handle = open(segment_path, 'ab')
+        self.index_handle = open(index_path, 'a', encoding='utf-8')
+        self.current_day = day
+        self.current_part = part
+        logger.info("Opened danmaku archive segment: %s", segment_path)
+
+    def _recover_tail(self, segment_path: str, index_path: str):
+        """进程异常退出时分段可能比索引多出若干块，为这些块补写索引
+
+        索引最后一行可能只写了一半：读到第一行无法解析的索引就停止，
+        并把索引文件截断到最后一个完整行的末尾，之后补写或追加的索引才能从新行开始。
+        """
+        indexed_end = 0
+        if os.path.exists(index_path):
+            valid_end = 0
+            with open(index_path, 'rb') as f:
+                data = f.read()
+            for line in data.splitlines(keepends=True):
+                if not line.endswith(b'\n'):
+                    break
+                if line.strip():
+                    try:
+                        entry = json.loads(line)
+                        end = entry['offset'] + entry['length']
+                    except (ValueError, KeyError, TypeError):
+                        break
+                    indexed_end = end
+                valid_end += len(line)
+            if valid_end < len(data):
+                with open(index_path, 'r+b') as f:
+                    f.truncate(valid_end)
+                logger.warning("Truncated %s bytes of incomplete index from %s", len(data) - valid_end, index_path)
+
+        if not os.path.exists(segment_path):
+            return
+
+        segment_size = os.path.getsize(segment_path)
+        if segment_size <= indexed_end:
+            return
+
+        logger.warning("Rebuilding archive index for %s unindexed bytes in %s", segment_size - indexed_end, segment_path)
+        with open(segment_path, 'rb') as f:
+            f.seek(indexed_end)
+            data = f.read()
+
+        recovered = []
+        offset = indexed_end
+        while data:
+            decompressor = zlib.decompressobj(31)
+            try:
+                text = decompressor.decompress(data).decode('utf-8')
+            except (zlib.error, UnicodeDecodeError):
+                break
+            if not decompressor.eof:
+                break  # 最后一个块没有写完整
+            length = len(data) - len(decompressor.unused_data)
+            rows = [row for row in csv.reader(io.StringIO(text)) if row]
+            if rows:
+                recovered.append(summarize_block(rows, offset, length))
+            offset += length
+            data = decompressor.unused_data
+
+        if offset < segment_size:
+            # 截掉无法解压的残缺块，保证之后追加的块能被正确定位
+            with open(segment_path, 'r+b') as f:
+                f.truncate(offset)
+            logger.warning("Truncated %s bytes of incomplete block from %s", segment_size - offset, segment_path)
+
+        with open(index_path, 'a', encoding='utf-8') as f:
+            for entry in recovered:
+                f.write(json.dumps(entry) + '\n')
+
+    def write_block(self, rows: list):
+        """写入一批弹幕，rows 的每行格式见 ARCHIVE_COLUMNS；跨天的批次会拆到各自的分段中"""
+        if not rows:
+            return
+
+        with self._lock:
+            start = 0
+            while start < len(rows):
+                day = _day_key(rows[start][0])
+                end = start + 1
+                while end < len(rows) and _day_key(rows[end][0]) == day:
+                    end += 1
+                self._write_day_block(day, rows[start:end])
+                start = end
+
+    def _write_day_block(self, day: str, rows: list):
+        if (self.segment_handle is None or day != self.current_day
+                or self.segment_handle.tell() >= self.max_segment_bytes):
+            self._open_segment(day)
+
+        text_buffer = io.StringIO()
+        csv.writer(text_buffer).writerows(rows)
+        text = text_buffer.getvalue()
+        block = _compress_block(text, self.compress_level)
+
+        offset = self.segment_handle.tell()
+        self.segment_handle.write(block)
+        self.segment_handle.flush()
+
+        entry = summarize_block(rows, offset, len(block))
+        self.index_handle.write(json.dumps(entry) + '\n')
+        self.index_handle.flush()
+
+        self.blocks_written += 1
+        self.rows_written += len(rows)
+        self.raw_bytes += len(text.encode('utf-8'))
+        self.compressed_bytes += len(block)
+
+    def get_stats(self) -> dict:
+        return {
+            'current_segment': self.current_segment,
+            'blocks_written': self.blocks_written,
+            'rows_written': self.rows_written,
+            'raw_bytes': self.raw_bytes,
+            'compressed_bytes': self.compressed_bytes,
+            'compression_ratio': round(self.raw_bytes / self.compressed_bytes, 2) if self.compressed_bytes else 0.0
+        }
+
+    def close(self):
+        with self._lock:
+            self._close_segment()
+
+
+class ArchiveReader:
+    """归档读取器：通过索引定位时间范围内的块，逐块解压并流式返回弹幕"""
+
+    def __init__(self, base_dir: str):
+        self.base_dir = base_dir
+        # 索引缓存 {分段路径: [已读取的索引字节数, 索引列表, 各块last列表]}，只增量读取新追加的索引行
+        self._index_cache = {}
+        self._lock = threading.Lock()
+
+    def list_segments(self, start: Optional[float] = None, end: Optional[float] = None) -> list:
+        """按时间顺序列出与时间范围有重叠的分段文件"""
+        if not os.path.isdir(self.base_dir):
+            return []
+
+        start_day = _day_key(start) if start is not None else None
+        end_day = _day_key(end) if end is not None else None
+        segments = []
+        for name in os.listdir(self.base_dir):
+            match = SEGMENT_NAME_PATTERN.match(name)
+            if not match:
+                continue
+            day = match.group(1)
+            if start_day and day < start_day:
+                continue
+            if end_day and day > end_day:
+                continue
+            segments.append((day, int(match.group(2) or 0), os.path.join(self.base_dir, name)))
+        segments.sort()
+        return [path for _, _, path in segments]
+
+    def load_index(self, segment_path: str) -> tuple:
+        """读取分段的索引，返回 (索引列表, 各块last列表)"""
+        index_path = segment_path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+        with self._lock:
+            cached = self._index_cache.setdefault(segment_path, [0, [], []])
+            try:
+                size = os.path.getsize(index_path)
+            except OSError:
+                return [], []
+
+            if size > cached[0]:
+                with open(index_path, 'rb') as f:
+                    f.seek(cached[0])
+                    data = f.read()
+                # 只处理完整的行，写到一半的行留到下次读取
+                complete = data[:data.rfind(b'\n') + 1]
+                for line in complete.decode('utf-8').splitlines():
+                    if line.strip():
+                        entry = json.loads(line)
+                        cached[1].append(entry)
+                        # 索引按写入顺序排列，last 取前缀最大值保证可以二分查找
+                        cached[2].append(max(entry['last'], cached[2][-1]) if cached[2] else entry['last'])
+                cached[0] += len(complete)
+            return cached[1], cached[2]
+
+    def iter_blocks(self, start: Optional[float] = None, end: Optional[float] = None) -> Iterator[tuple]:
+        """返回与时间范围有重叠的块 (分段路径, 索引项)"""
+        for segment_path in self.list_segments(start, end):
+            entries, lasts = self.load_index(segment_path)
+            first_block = bisect.bisect_left(lasts, start) if start is not None else 0
+            for entry in entries[first_block:]:
+                if end is not None and entry['first'] > end:
+                    continue  # 少量乱序的块仍需检查，直到分段结束
+                if start is not None and entry['last'] < start:
+                    continue
+                yield segment_path, entry
+
+    def read_block(self, segment_path: str, entry: dict) -> list:
+        """解压单个块，返回行列表，第一列已转换为 float"""
+        with open(segment_path, 'rb') as f:
+            f.seek(entry['offset'])
+            data = f.read(entry['length'])
+        rows = []
+        for row in csv.reader(io.StringIO(_decompress_block(data))):
+            if row:
+                row[0] = float(row[0])
+                rows.append(row)
+        return rows
+
+    def iter_rows(self, start: Optional[float] = None, end: Optional[float] = None) -> Iterator[list]:
+        """流式返回时间范围 [start, end] 内的弹幕，每次只解压一个块"""
+        for segment_path, entry in self.iter_blocks(start, end):
+            fully_inside = ((start is None or entry['first'] >= start)
+                            and (end is None or entry['last'] <= end))
+            for row in self.read_block(segment_path, entry):
+                if fully_inside or ((start is None or row[0] >= start) and (end is None or row[0] <= end)):
+                    yield row
+
+
+class DanmakuQuery:
+    """弹幕历史查询：按时间范围、用户、平台和指令筛选或统计归档中的弹幕
+
+    查询总是限定在时间范围内，只访问索引中与该范围重叠的块，因此耗时只与范围内的弹幕量有关，
+    不会随归档总量增长。
+    """
+
+    GROUP_FIELDS = {'command': 3, 'user': 2, 'platform': 5}
+
+    def __init__(self, reader: ArchiveReader):
+        self.reader = reader
+
+    @staticmethod
+    def _row_matches(row: list, username: Optional[str], platform: Optional[str], command: Optional[str]) -> bool:
+        if username is not None and row[2] != username:
+            return False
+        if platform is not None and row[5] != platform:
+            return False
+        if command is not None and normalize_command(row[3]) != command:
+            return False
+        return True
+
+    def iter_messages(self, start: Optional[float] = None, end: Optional[float] = None,
+                      username: Optional[str] = None, platform: Optional[str] = None,
+                      command: Optional[str] = None, limit: Optional[int] = None) -> Iterator[dict]:
+        """流式返回符合条件的弹幕"""
+        if command is not None:
+            command = normalize_command(command)
+
+        count = 0
+        for segment_path, entry in self.reader.iter_blocks(start, end):
+            # 利用块汇总跳过肯定不包含目标的块
+            if username is not None and not block_may_contain_user(entry, username):
+                continue
+            if platform is not None and 'platforms' in entry and platform not in entry['platforms']:
+                continue
+            if (command is not None and entry.get('commands_complete')
+                    and command not in entry.get('commands', {})):
+                continue
+
+            for row in self.reader.read_block(segment_path, entry):
+                if start is not None and row[0] < start:
+                    continue
+                if end is not None and row[0] > end:
+                    continue
+                if not self._row_matches(row, username, platform, command):
+                    continue
+                yield {
+                    'time': row[0],
+                    'timestamp': row[1],
+                    'username': row[2],
+                    'command': row[3],
+                    'executed': row[4] == '1',
+                    'platform': row[5]
+                }
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+
+    def aggregate(self, group_by: str = 'command', start: Optional[float] = None, end: Optional[float] = None,
+                  username: Optional[str] = None, platform: Optional[str] = None, top: int = 10) -> dict:
+        """按指令/用户/平台统计弹幕数量，返回总数、执行数和前 top 项"""
+        if group_by not in self.GROUP_FIELDS:
+            raise ValueError(f"Unsupported group_by: {group_by}")
+        field = self.GROUP_FIELDS[group_by]
+
+        counts = Counter()
+        total = 0
+        executed = 0
+        blocks_scanned = 0
+        blocks_summarized = 0
+        for segment_path, entry in self.reader.iter_blocks(start, end):
+            fully_inside = ((start is None or entry['first'] >= start)
+                            and (end is None or entry['last'] <= end))
+
+            # 快速路径：块完全落在范围内、没有额外筛选且汇总完整时直接使用索引中的计数
+            if fully_inside and username is None and platform is None and 'platforms' in entry:
+                summary = None
+                if group_by == 'platform':
+                    summary = entry['platforms']
+                elif group_by == 'command' and entry.get('commands_complete'):
+                    summary = entry['commands']
+                if summary is not None:
+                    counts.update(summary)
+                    total += entry['rows']
+                    executed += entry['executed']
+                    blocks_summarized += 1
+                    continue
+
+            if username is not None and not block_may_contain_user(entry, username):
+                continue
+            if platform is not None and 'platforms' in entry and platform not in entry['platforms']:
+                continue
+
+            blocks_scanned += 1
+            for row in self.reader.read_block(segment_path, entry):
+                if start is not None and row[0] < start:
+                    continue
+                if end is not None and row[0] > end:
+                    continue
+                if not self._row_matches(row, username, platform, None):
+                    continue
+                key = normalize_command(row[3]) if group_by == 'command' else row[field]
+                counts[key] += 1
+                total += 1
+                if row[4] == '1':
+                    executed += 1
+
+        return {
+            'group_by': group_by,
+            'start': start,
+            'end': end,
+            'total': total,
+            'executed': executed,
+            'distinct': len(counts),
+            'top': counts.most_common(top),
+            'blocks_summarized': blocks_summarized,
+            'blocks_scanned': blocks_scanned
+        }
+
+
+_timestamp_cache = {}  # 最近转换过的时间戳 {时间戳字符串: 秒}
+
+
+def parse_timestamp(timestamp: str) -> float:
+    """把 '%Y-%m-%d %H:%M:%S' 格式的时间戳转换为秒；同一秒内的弹幕共用一次转换结果"""
+    epoch = _timestamp_cache.get(timestamp)
+    if epoch is None:
+        try:
+            epoch = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S').timestamp()
+        except (TypeError, ValueError):
+            epoch = time.time()
+        if len(_timestamp_cache) > 64:
+            _timestamp_cache.clear()
+        _timestamp_cache[timestamp] = epoch
+    return epoch
@@ -0,0 +1,598 @@
+# -*- coding: utf-8 -*-
+"""
+按键注入后端：把"按下/松开某个键"与具体的注入方式解耦
+
+控制器里的按键名沿用 pyautogui 的键名（up/down/left/right/x/z/enter/backspace/shift/f1~f9），
+每个后端负责把它们送到模拟器：
+    pyautogui   通过 pyautogui 模拟键盘，每次调用后有 pause 秒的固定停顿（原来的行为）
+    win32       直接调用 keybd_event，没有 pyautogui 的额外停顿，延迟最低
+    socket      通过 mGBA 脚本（mgba_input_server.lua）的本地端口直接写入按键，按帧计时，不依赖窗口焦点
+    recording   只在内存中记录按键事件，不依赖桌面环境，用于测试和在 Linux 上测量执行器吞吐量
+
+桌面后端在按键前需要激活 mGBA 窗口，激活函数由控制器传入。
+组合指令先按 TimingProfile 编译成 KeySchedule（每次按下/松开相对开始的时间），
+再由 run_schedule 在单个高精度计时循环里执行，不再逐键 sleep。
+MockEmulatorServer 实现了与 mGBA 脚本相同的协议，可以在没有模拟器时测试 socket 后端：
+    python input_backends.py [端口]
+"""
+
+import logging
+import socket
+import socketserver
+import sys
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+try:
+    import pyautogui
+except ImportError:  # 无桌面环境（如 Linux 服务器）时只能使用 recording 后端
+    pyautogui = None
+
+try:
+    import win32api
+    import win32con
+except ImportError:
+    win32api = None
+    win32con = None
+
+RECORDING_MAX_EVENTS = 10000  # recording 后端最多保留的按键事件数
+SOCKET_DEFAULT_PORT = 8888  # mgba_input_server.lua 监听的端口
+GBA_FPS = 59.7275  # GBA 帧率，用于把按键时长换算成帧数
+SPIN_THRESHOLD = 0.002  # 距离截止时间不足该秒数时改为忙等，避免 sleep 的调度误差
+
+
+class TimingProfile:
+    """按键时序：按住时长 hold 和松开到下一次按下的间隔 gap（秒），可以按键名单独覆盖"""
+
+    def __init__(self, hold: float = 0.1, gap: float = 0.1, keys: dict = None):
+        self.hold = hold
+        self.gap = gap
+        self.keys = keys or {}  # {键名: {'hold': 秒, 'gap': 秒}}
+
+    @classmethod
+    def from_config(cls, config: dict, base: 'TimingProfile' = None) -> 'TimingProfile':
+        """从配置字典创建，未配置的项沿用 base"""
+        base = base or cls()
+        keys = {key: dict(timing) for key, timing in base.keys.items()}
+        for key, timing in config.get('keys', {}).items():
+            keys.setdefault(key, {}).update(timing)
+        return cls(config.get('hold', base.hold), config.get('gap', base.gap), keys)
+
+    def hold_for(self, key: str) -> float:
+        return self.keys.get(key, {}).get('hold', self.hold)
+
+    def gap_for(self, key: str) -> float:
+        return self.keys.get(key, {}).get('gap', self.gap)
+
+    def to_dict(self):
+        return {'hold': self.hold, 'gap': self.gap, 'keys': self.keys}
+
+
+class KeySchedule:
+    """编译后的按键时间表"""
+    __slots__ = ('events', 'duration', 'presses', 'taps', 'hold_key', 'lead')
+
+    def __init__(self, events: tuple, duration: float, presses: int, taps: tuple = (), hold_key: str = None,
+                 lead: float = 0.0):
+        self.events = events  # ((相对开始的秒数, 'down' 或 'up', 键名), ...)，按时间排序
+        self.duration = duration  # 整个时间表的时长（含最后一次松开后的间隔）
+        self.presses = presses
+        self.taps = taps  # ((键名, 按住秒数, 间隔秒数), ...)，按帧计时的后端使用
+        self.hold_key = hold_key
+        self.lead = lead  # 按住 hold_key 到第一次按键之间的间隔
+
+
+def compile_schedule(steps, profile: TimingProfile, hold_key: str = None) -> KeySchedule:
+    """把按键序列 ((键名, 重复次数), ...) 编译成按键时间表
+
+    hold_key 不为空时在整个序列期间按住该键（如奔跑模式的 B 键），按下后间隔 gap 再开始第一次按键。
+    """
+    events = []
+    taps = []
+    offset = 0.0
+    presses = 0
+    if hold_key:
+        events.append((0.0, 'down', hold_key))
+        offset = profile.gap_for(hold_key)
+    lead = offset
+    for key, repeat_count in steps:
+        hold = profile.hold_for(key)
+        gap = profile.gap_for(key)
+        for _ in range(repeat_count):
+            events.append((offset, 'down', key))
+            events.append((offset + hold, 'up', key))
+            taps.append((key, hold, gap))
+            offset += hold + gap
+            presses += 1
+    if hold_key:
+        events.append((offset, 'up', hold_key))
+    return KeySchedule(tuple(events), offset, presses, tuple(taps), hold_key, lead)
+
+
+class InputBackend:
+    """按键注入后端接口，子类实现 key_down / key_up"""
+    name = 'base'
+
+    def __init__(self, activate_window=None):
+        self._activate_window = activate_window
+        self._stats_lock = threading.Lock()
+        self.press_count = 0
+        self.total_press_time = 0.0  # 累计按键耗时（秒），包括按住的时间
+        self.schedule_count = 0
+        self.max_lateness = 0.0  # 时间表事件相对计划时间的最大延迟（秒）
+
+    def activate(self) -> bool:
+        """准备接收输入（桌面后端为激活 mGBA 窗口），失败时返回 False"""
+        if self._activate_window is None:
+            return True
+        return self._activate_window()
+
+    def key_down(self, key: str):
+        raise NotImplementedError
+
+    def key_up(self, key: str):
+        raise NotImplementedError
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds)
+
+    def press(self, key: str, duration: float = 0.1):
+        """按下并在 duration 秒后松开"""
+        start = time.perf_counter()
+        self._tap(key, duration)
+        elapsed = time.perf_counter() - start
+        with self._stats_lock:
+            self.press_count += 1
+            self.total_press_time += elapsed
+
+    def _tap(self, key: str, duration: float):
+        self.key_down(key)
+        self.sleep(duration)
+        self.key_up(key)
+
+    def wait_until(self, deadline: float):
+        """等待到 time.perf_counter() 达到 deadline：先 sleep，最后 SPIN_THRESHOLD 秒忙等"""
+        remaining = deadline - time.perf_counter()
+        if remaining > SPIN_THRESHOLD:
+            time.sleep(remaining - SPIN_THRESHOLD)
+        while time.perf_counter() < deadline:
+            pass
+
+    def _send_event(self, action: str, key: str):
+        if action == 'down':
+            self.key_down(key)
+        else:
+            self.key_up(key)
+
+    def run_schedule(self, schedule: KeySchedule) -> int:
+        """在单个计时循环中按时间表发送按下/松开事件，出错时松开所有已按下的键
+
+        返回最后一个事件发出时的 time.perf_counter_ns()。
+        """
+        start = time.perf_counter()
+        held = []
+        lateness = 0.0
+        last_event_ns = time.perf_counter_ns()
+        try:
+            for offset, action, key in schedule.events:
+                deadline = start + offset
+                self.wait_until(deadline)
+                lateness = max(lateness, time.perf_counter() - deadline)
+                self._send_event(action, key)
+                last_event_ns = time.perf_counter_ns()
+                if action == 'down':
+                    held.append(key)
+                else:
+                    held.remove(key)
+            self.wait_until(start + schedule.duration)
+        finally:
+            for key in reversed(held):
+                try:
+                    self.key_up(key)
+                except Exception as e:
+                    logger.error("Failed to release key %s: %s", key, e)
+        elapsed = time.perf_counter() - start
+        with self._stats_lock:
+            self.schedule_count += 1
+            self.press_count += schedule.presses
+            self.total_press_time += elapsed
+            self.max_lateness = max(self.max_lateness, lateness)
+        return last_event_ns
+
+    def save_state(self, slot: int):
+        """发送 Shift+F{slot} 存档"""
+        self.key_down('shift')
+        self.sleep(0.05)
+        self.press(f'f{slot}', 0)
+        self.sleep(0.05)
+        self.key_up('shift')
+
+    def close(self):
+        pass
+
+    def get_stats(self):
+        """获取按键统计信息"""
+        with self._stats_lock:
+            return {
+                'backend': self.name,
+                'presses': self.press_count,
+                'schedules': self.schedule_count,
+                'avg_press_ms': round(self.total_press_time / self.press_count * 1000, 3) if self.press_count else 0.0,
+                'max_lateness_ms': round(self.max_lateness * 1000, 3)
+            }
+
+
+class PyAutoGUIBackend(InputBackend):
+    """通过 pyautogui 模拟键盘"""
+    name = 'pyautogui'
+
+    def __init__(self, activate_window=None, pause: float = 0.1):
+        if pyautogui is None:
+            raise RuntimeError("pyautogui is not available")
+        super().__init__(activate_window)
+        pyautogui.PAUSE = pause
+
+    def key_down(self, key: str):
+        pyautogui.keyDown(key)
+
+    def key_up(self, key: str):
+        pyautogui.keyUp(key)
+
+    def _send_event(self, action: str, key: str):
+        # 时间表自己控制间隔，不使用 pyautogui.PAUSE 的固定停顿
+        if action == 'down':
+            pyautogui.keyDown(key, _pause=False)
+        else:
+            pyautogui.keyUp(key, _pause=False)
+
+    def save_state(self, slot: int):
+        # 与原来的实现一致：F键用 pyautogui.press 发送
+        pyautogui.keyDown('shift')
+        time.sleep(0.05)
+        pyautogui.press(f'f{slot}')
+        time.sleep(0.05)
+        pyautogui.keyUp('shift')
+
+
+class Win32Backend(InputBackend):
+    """直接调用 Windows keybd_event，没有 pyautogui 的固定停顿"""
+    name = 'win32'
+
+    # 方向键需要带扩展键标志，否则会被当作小键盘按键
+    EXTENDED_KEYS = ('up', 'down', 'left', 'right')
+
+    def __init__(self, activate_window=None):
+        if win32api is None:
+            raise RuntimeError("pywin32 is not available")
+        super().__init__(activate_window)
+        self._virtual_keys = {
+            'up': win32con.VK_UP,
+            'down': win32con.VK_DOWN,
+            'left': win32con.VK_LEFT,
+            'right': win32con.VK_RIGHT,
+            'enter': win32con.VK_RETURN,
+            'backspace': win32con.VK_BACK,
+            'shift': win32con.VK_SHIFT,
+            'alt': win32con.VK_MENU
+        }
+        for number in range(1, 13):
+            self._virtual_keys[f'f{number}'] = win32con.VK_F1 + number - 1
+
+    def _virtual_key(self, key: str) -> int:
+        virtual_key = self._virtual_keys.get(key)
+        if virtual_key is None:
+            if len(key) != 1:
+                raise ValueError(f"Unsupported key for win32 backend: {key}")
+            virtual_key = ord(key.upper())  # 字母和数字键的虚拟键码即大写字符
+        return virtual_key
+
+    def _send(self, key: str, key_up: bool):
+        virtual_key = self._virtual_key(key)
+        flags = win32con.KEYEVENTF_KEYUP if key_up else 0
+        if key in self.EXTENDED_KEYS:
+            flags |= win32con.KEYEVENTF_EXTENDEDKEY
+        win32api.keybd_event(virtual_key, win32api.MapVirtualKey(virtual_key, 0), flags, 0)
+
+    def key_down(self, key: str):
+        self._send(key, key_up=False)
+
+    def key_up(self, key: str):
+        self._send(key, key_up=True)
+
+
+class RecordingBackend(InputBackend):
+    """只在内存中记录按键事件，不注入任何输入
+
+    simulate_timing 为 False 时不等待按住时间，可以测量执行器本身的开销。
+    """
+    name = 'recording'
+
+    def __init__(self, activate_window=None, simulate_timing: bool = True):
+        super().__init__(None)  # 不需要激活窗口
+        self.simulate_timing = simulate_timing
+        self.events = deque(maxlen=RECORDING_MAX_EVENTS)  # 元素：(time.perf_counter(), 'down' 或 'up', 键名)
+        self.pressed = set()  # 当前处于按下状态的键
+
+    def key_down(self, key: str):
+        self.events.append((time.perf_counter(), 'down', key))
+        self.pressed.add(key)
+
+    def key_up(self, key: str):
+        self.events.append((time.perf_counter(), 'up', key))
+        self.pressed.discard(key)
+
+    def sleep(self, seconds: float):
+        if self.simulate_timing:
+            time.sleep(seconds)
+
+    def wait_until(self, deadline: float):
+        if self.simulate_timing:
+            super().wait_until(deadline)
+
+    def clear(self):
+        self.events.clear()
+        self.pressed.clear()
+
+    def get_stats(self):
+        stats = super().get_stats()
+        stats['recorded_events'] = len(self.events)
+        stats['pressed'] = sorted(self.pressed)
+        return stats
+
+
+class ScriptingSocketBackend(InputBackend):
+    """通过 mGBA 脚本的本地端口发送按键指令
+
+    每条指令一行（PRESS/DOWN/UP/WAIT/SAVE/PING），服务端回复 "OK <帧号>" 或 "ERR <原因>"。
+    按键时长换算成帧数由模拟器在帧回调中执行，因此不需要激活窗口，也不受焦点影响；
+    客户端按"按住帧数 + 松开间隔帧数"等待，使执行器节奏与模拟器一致。
+    """
+    name = 'socket'
+
+    # 控制器键名 -> GBA 按键名
+    BUTTONS = {
+        'up': 'UP', 'down': 'DOWN', 'left': 'LEFT', 'right': 'RIGHT',
+        'x': 'A', 'z': 'B', 'enter': 'START', 'backspace': 'SELECT',
+        'a': 'L', 's': 'R'
+    }
+    RECONNECT_INTERVAL = 1.0  # 连接失败后至少间隔多少秒再重试
+
+    def __init__(self, activate_window=None, host: str = '127.0.0.1', port: int = SOCKET_DEFAULT_PORT,
+                 timeout: float = 2.0, release_gap_frames: int = 2):
+        super().__init__(None)  # 按键直接写入模拟器，不需要激活窗口
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.release_gap_frames = release_gap_frames
+        self._lock = threading.Lock()
+        self._sock = None
+        self._reader = None
+        self._last_connect_attempt = 0.0
+        self.last_frame = None  # 最近一次回复中的模拟器帧号
+        self.error_count = 0
+        self.reconnect_count = 0
+
+    def _connect(self) -> bool:
+        """连接模拟器脚本端口，失败时在 RECONNECT_INTERVAL 内不再重试"""
+        if self._sock is not None:
+            return True
+        now = time.monotonic()
+        if now - self._last_connect_attempt < self.RECONNECT_INTERVAL:
+            return False
+        self._last_connect_attempt = now
+        try:
+            self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._reader = self._sock.makefile('rb')
+            self.reconnect_count += 1
+            logger.info("Connected to emulator input server at %s:%s", self.host, self.port)
+            return True
+        except OSError as e:
+            logger.warning("Failed to connect to emulator input server at %s:%s: %s", self.host, self.port, e)
+            self._sock = None
+            return False
+
+    def _disconnect(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _send(self, line: str):
+        """发送一条指令并等待回复"""
+        with self._lock:
+            if not self._connect():
+                raise ConnectionError(f"Emulator input server {self.host}:{self.port} is not available")
+            try:
+                self._sock.sendall(line.encode('ascii') + b'\n')
+                reply = self._reader.readline().decode('ascii').strip()
+            except OSError:
+                self._disconnect()
+                raise
+            if not reply:
+                self._disconnect()
+                raise ConnectionError("Emulator input server closed the connection")
+            status, _, detail = reply.partition(' ')
+            if status != 'OK':
+                self.error_count += 1
+                raise RuntimeError(f"Emulator rejected '{line}': {detail}")
+            if detail.isdigit():
+                self.last_frame = int(detail)
+
+    def _button(self, key: str) -> str:
+        button = self.BUTTONS.get(key)
+        if button is None:
+            raise ValueError(f"Unsupported key for socket backend: {key}")
+        return button
+
+    def activate(self) -> bool:
+        with self._lock:
+            return self._connect()
+
+    def key_down(self, key: str):
+        self._send(f"DOWN {self._button(key)}")
+
+    def key_up(self, key: str):
+        self._send(f"UP {self._button(key)}")
+
+    def _tap(self, key: str, duration: float):
+        frames = max(1, round(duration * GBA_FPS))
+        self._send(f"PRESS {self._button(key)} {frames}")
+        self.sleep((frames + self.release_gap_frames) / GBA_FPS)
+
+    def run_schedule(self, schedule: KeySchedule) -> int:
+        """把时间表换算成帧：每次按键发送 PRESS <帧数>，间隔发送 WAIT <帧数>，由模拟器脚本按帧执行
+
+        DOWN 和 UP 分开发送时可能在同一帧内被执行，游戏看不到这次按键，所以这里不使用墙钟计时循环。
+        指令全部入队后按预计帧数等待，返回预计最后一个键松开时的 time.perf_counter_ns()。
+        """
+        start = time.perf_counter()
+        lines = []
+        frames = 0
+        release_frame = 0
+        if schedule.hold_key:
+            lines.append(f"DOWN {self._button(schedule.hold_key)}")
+            frames = round(schedule.lead * GBA_FPS)
+            if frames:
+                lines.append(f"WAIT {frames}")
+        for key, hold, gap in schedule.taps:
+            hold_frames = max(1, round(hold * GBA_FPS))
+            gap_frames = max(self.release_gap_frames, round(gap * GBA_FPS))
+            lines.append(f"PRESS {self._button(key)} {hold_frames}")
+            if gap_frames > self.release_gap_frames:
+                lines.append(f"WAIT {gap_frames - self.release_gap_frames}")
+            release_frame = frames + hold_frames
+            frames += hold_frames + gap_frames
+        if schedule.hold_key:
+            lines.append(f"UP {self._button(schedule.hold_key)}")
+        sent_hold_key = False
+        try:
+            for line in lines:
+                self._send(line)
+                sent_hold_key = sent_hold_key or line.startswith('DOWN')
+        except Exception:
+            if sent_hold_key:
+                try:
+                    self.key_up(schedule.hold_key)
+                except Exception as e:
+                    logger.error("Failed to release key %s: %s", schedule.hold_key, e)
+            raise
+        self.wait_until(start + release_frame / GBA_FPS)
+        last_event_ns = time.perf_counter_ns()
+        self.wait_until(start + frames / GBA_FPS)
+        with self._stats_lock:
+            self.schedule_count += 1
+            self.press_count += schedule.presses
+            self.total_press_time += time.perf_counter() - start
+        return last_event_ns
+
+    def save_state(self, slot: int):
+        self._send(f"SAVE {slot}")
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+    def get_stats(self):
+        stats = super().get_stats()
+        stats['connected'] = self._sock is not None
+        stats['last_frame'] = self.last_frame
+        stats['errors'] = self.error_count
+        stats['connects'] = self.reconnect_count
+        return stats
+
+
+class _MockEmulatorHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for raw_line in self.rfile:
+            reply = self.server.emulator.handle_line(raw_line.decode('ascii', 'replace'))
+            if reply is not None:
+                self.wfile.write(reply.encode('ascii') + b'\n')
+
+
+class MockEmulatorServer:
+    """模拟 mgba_input_server.lua 的本地服务端，按墙钟时间推算帧号并记录收到的指令"""
+
+    BUTTONS = ('A', 'B', 'L', 'R', 'START', 'SELECT', 'UP', 'DOWN', 'LEFT', 'RIGHT')
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self._server = socketserver.ThreadingTCPServer((host, port), _MockEmulatorHandler)
+        self._server.daemon_threads = True
+        self._server.emulator = self
+        self._thread = None
+        self._started = time.perf_counter()
+        self.commands = deque(maxlen=RECORDING_MAX_EVENTS)  # 元素：(帧号, 指令, 参数列表)
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def current_frame(self) -> int:
+        return int((time.perf_counter() - self._started) * GBA_FPS)
+
+    def handle_line(self, line: str):
+        words = line.split()
+        if not words:
+            return None
+        command = words[0].upper()
+        frame = self.current_frame()
+        if command == 'PING':
+            return f"OK {frame}"
+        if command == 'SAVE':
+            if len(words) < 2 or not words[1].isdigit():
+                return "ERR bad slot"
+        elif command == 'WAIT':
+            if len(words) < 2 or not words[1].isdigit():
+                return "ERR bad frame count"
+        elif command in ('PRESS', 'DOWN', 'UP'):
+            if len(words) < 2 or words[1].upper() not in self.BUTTONS:
+                return "ERR unknown button"
+        else:
+            return "ERR unknown command"
+        self.commands.append((frame, command, words[1:]))
+        return f"OK {frame}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+INPUT_BACKENDS = {
+    'pyautogui': PyAutoGUIBackend,
+    'win32': Win32Backend,
+    'socket': ScriptingSocketBackend,
+    'recording': RecordingBackend
+}
+
+
+def create_input_backend(name: str, activate_window=None, **options) -> InputBackend:
+    """按名称创建按键注入后端
+
+    未知名称抛出 ValueError，后端依赖不可用时抛出 RuntimeError，不会回退到其他后端：
+    recording 后端会丢弃所有按键，只有配置中显式选择时才使用。
+    """
+    backend_class = INPUT_BACKENDS.get(name)
+    if backend_class is None:
+        raise ValueError(f"Unknown input backend '{name}', expected one of: {', '.join(INPUT_BACKENDS)}")
+    return backend_class(activate_window, **options)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+    mock_server = MockEmulatorServer(port=int(sys.argv[1]) if len(sys.argv) > 1 else SOCKET_DEFAULT_PORT).start()
+    logger.info("Mock emulator input server listening on %s:%s", mock_server.address[0], mock_server.address[1])
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        mock_server.stop()
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+控制器指标：Prometheus 文本格式的计数器/仪表，以及弹幕到按键的延迟追踪
+
+MetricsRegistry 管理两类指标：
+    热路径上的计数器（Counter）：按标签保存在字典里，递增只是一次字典读写，不加锁。
+        多个线程同时递增同一标签时理论上可能丢失极少数计数，对监控来说可以接受。
+    抓取时计算的指标（register_callback）：直接读取各组件已有的统计，热路径上没有任何开销。
+render() 输出 Prometheus 文本格式（0.0.4），由 /metrics 路由返回。
+
+延迟追踪：记录每条弹幕从收到网络帧到按键松开的各阶段时间，汇总成 HDR 风格的直方图
+
+一条弹幕的追踪（LatencyTrace）依次打点：
+    receive          收到 WebSocket 帧（追踪起点）
+    decompress       zlib 解压完成（只有压缩包才有）
+    json_parse       JSON 解析完成
+    ingest_wait      从弹幕接收队列中取出
+    command_parse    指令解析完成
+    dispatch         交给自由模式执行器（成为最新指令）
+    processed        process_danmaku_command 处理完毕（没有交给执行器的弹幕在此结束）
+    executor_wait    执行器取出指令
+    window_activate  激活 mGBA 窗口 / 准备输入完成
+    key_down         开始按下第一个键
+    key_up           最后一个键松开
+每个阶段的值是相对上一个打点的耗时；执行完成的弹幕另外记录 end_to_end（receive 到 key_up）。
+
+直方图按 2 的幂分段、每段 16 个线性子桶（相对误差约 6%），记录 O(1)，内存固定。
+"""
+
+import threading
+import time
+
+LATENCY_STAGES = (
+    'decompress', 'json_parse', 'ingest_wait', 'command_parse', 'dispatch', 'processed',
+    'executor_wait', 'window_activate', 'key_down', 'key_up', 'end_to_end'
+)
+
+_SUB_BUCKET_BITS = 4
+_SUB_BUCKETS = 1 << _SUB_BUCKET_BITS
+_BUCKET_COUNT = 40 * _SUB_BUCKETS  # 覆盖到约 2^39 微秒，远超实际延迟
+
+
+def _bucket_index(value: int) -> int:
+    """值（微秒）所在的桶：小于 32 的值各占一个桶，之后每个 2 的幂区间分 16 个子桶"""
+    if value < 2 * _SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - _SUB_BUCKET_BITS - 1
+    return min(shift * _SUB_BUCKETS + (value >> shift), _BUCKET_COUNT - 1)
+
+
+def _bucket_upper_bound(index: int) -> int:
+    """桶内的最大值（微秒）"""
+    if index < 2 * _SUB_BUCKETS:
+        return index
+    shift = index // _SUB_BUCKETS - 1
+    mantissa = index - shift * _SUB_BUCKETS
+    return ((mantissa + 1) << shift) - 1
+
+
+class LatencyHistogram:
+    """固定内存的对数-线性延迟直方图，值以微秒为单位"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = [0] * _BUCKET_COUNT
+        self.count = 0
+        self.total = 0  # 微秒
+        self.max = 0
+
+    def record(self, value_us: int):
+        if value_us < 0:
+            value_us = 0
+        index = _bucket_index(value_us)
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.total += value_us
+            if value_us > self.max:
+                self.max = value_us
+
+    def percentile(self, fraction: float) -> int:
+        """第 fraction 分位数（0~1）所在桶的上界，没有数据时返回 0"""
+        with self._lock:
+            if self.count == 0:
+                return 0
+            threshold = max(1, int(self.count * fraction + 0.5))
+            seen = 0
+            for index, bucket_count in enumerate(self._counts):
+                seen += bucket_count
+                if seen >= threshold:
+                    return min(_bucket_upper_bound(index), self.max)
+            return self.max
+
+    def buckets(self):
+        """非空的桶，返回 [(桶上界微秒, 数量), ...]"""
+        with self._lock:
+            return [(_bucket_upper_bound(index), bucket_count)
+                    for index, bucket_count in enumerate(self._counts) if bucket_count]
+
+    def get_stats(self):
+        """获取分位数统计（毫秒）"""
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total / self.count / 1000, 3) if self.count else 0.0,
+            'p50_ms': self.percentile(0.5) / 1000,
+            'p90_ms': self.percentile(0.9) / 1000,
+            'p99_ms': self.percentile(0.99) / 1000,
+            'p999_ms': self.percentile(0.999) / 1000,
+            'max_ms': self.max / 1000
+        }
+
+
+class LatencyTrace:
+    """一条弹幕的打点记录"""
+    __slots__ = ('platform', 'marks', 'handed_off')
+
+    def __init__(self, platform: str, received_ns: int = None):
+        self.platform = platform
+        self.marks = [('receive', received_ns or time.perf_counter_ns())]  # [(阶段, perf_counter_ns), ...]
+        self.handed_off = False  # 已交给执行器，由执行器在按键完成后记录
+
+    def mark(self, stage: str, at_ns: int = None):
+        self.marks.append((stage, at_ns or time.perf_counter_ns()))
+
+    def hand_off(self):
+        """交给自由模式执行器"""
+        self.mark('dispatch')
+        self.handed_off = True
+
+
+class LatencyTracer:
+    """按阶段汇总延迟追踪"""
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.histograms = {stage: LatencyHistogram() for stage in LATENCY_STAGES}
+        self.completed_count = 0  # 执行完成（记录了 end_to_end）的追踪数
+
+    def start(self, platform: str, received_ns: int = None):
+        """开始追踪一条弹幕，未启用时返回 None"""
+        if not self.enabled:
+            return None
+        return LatencyTrace(platform, received_ns)
+
+    def record(self, trace: LatencyTrace):
+        """把追踪的各阶段耗时计入直方图，每条追踪只应记录一次"""
+        if trace is None:
+            return
+        marks = trace.marks
+        previous_ns = marks[0][1]
+        for stage, at_ns in marks[1:]:
+            histogram = self.histograms.get(stage)
+            if histogram is not None:
+                histogram.record((at_ns - previous_ns) // 1000)
+            previous_ns = at_ns
+        if marks[-1][0] == 'key_up':
+            self.histograms['end_to_end'].record((marks[-1][1] - marks[0][1]) // 1000)
+            self.completed_count += 1
+
+    def get_stats(self):
+        """获取各阶段的延迟分位数"""
+        return {
+            'enabled': self.enabled,
+            'completed': self.completed_count,
+            'stages': {stage: histogram.get_stats() for stage, histogram in self.histograms.items()}
+        }
+
+
+def _escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_sample(name: str, labels: dict, value) -> str:
+    if labels:
+        label_text = ','.join(f'{key}="{_escape_label_value(label_value)}"' for key, label_value in labels.items())
+        return f"{name}{{{label_text}}} {value}"
+    return f"{name} {value}"
+
+
+class Counter:
+    """热路径计数器，按标签值分别计数（不加锁）"""
+    __slots__ = ('labelnames', '_values')
+
+    def __init__(self, labelnames=()):
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # {标签值元组: 计数}
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        """返回 [(标签字典, 值), ...]"""
+        return [(dict(zip(self.labelnames, label_values)), value) for label_values, value in list(self._values.items())]
+
+
+class MetricsRegistry:
+    """指标注册表，按注册顺序输出"""
+
+    def __init__(self, prefix: str = ''):
+        self.prefix = prefix
+        self._metrics = []  # [(名称, 类型, 说明, 取样函数)]
+        self.scrape_errors = 0
+
+    def counter(self, name: str, help_text: str, labelnames=()) -> Counter:
+        """注册一个热路径计数器"""
+        counter = Counter(labelnames)
+        self._metrics.append((self.prefix + name, 'counter', help_text, counter.samples))
+        return counter
+
+    def register_callback(self, name: str, metric_type: str, help_text: str, callback):
+        """注册抓取时计算的指标：callback 返回数值，或 [(标签字典, 数值), ...]"""
+        self._metrics.append((self.prefix + name, metric_type, help_text, callback))
+
+    def register_latency(self, name: str, help_text: str, tracer: 'LatencyTracer',
+                         quantiles=(0.5, 0.9, 0.99, 0.999)):
+        """把延迟追踪的各阶段直方图导出为 summary（单位：秒）"""
+        def samples():
+            result = []
+            for stage, histogram in tracer.histograms.items():
+                if histogram.count == 0:
+                    continue
+                for quantile in quantiles:
+                    result.append(({'stage': stage, 'quantile': quantile}, histogram.percentile(quantile) / 1e6))
+                result.append(({'stage': stage, '__suffix': '_sum'}, histogram.total / 1e6))
+                result.append(({'stage': stage, '__suffix': '_count'}, histogram.count))
+            return result
+        self._metrics.append((self.prefix + name, 'summary', help_text, samples))
+
+    def render(self) -> str:
+        """输出 Prometheus 文本格式"""
+        lines = []
+        for name, metric_type, help_text, callback in self._metrics:
+            try:
+                samples = callback()
+            except Exception:
+                self.scrape_errors += 1
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            if not isinstance(samples, list):
+                lines.append(_format_sample(name, {}, samples))
+                continue
+            for labels, value in samples:
+                suffix = labels.pop('__suffix', '')
+                lines.append(_format_sample(name + suffix, labels, value))
+        lines.append(f"# HELP {self.prefix}metrics_scrape_errors_total Metric callbacks that raised during scrapes")
+        lines.append(f"# TYPE {self.prefix}metrics_scrape_errors_total counter")
+        lines.append(f"{self.prefix}metrics_scrape_errors_total {self.scrape_errors}")
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,166 @@
+-- mGBA 脚本：在本地端口接收按键指令（需要 mGBA 0.10 及以上，工具 -> 脚本 -> 加载此文件）
+-- 配合 input 配置 "backend": "socket" 使用，按键直接写入模拟器，不依赖窗口焦点
+--
+-- 协议：每行一条指令，每条指令回复一行 "OK <帧号>" 或 "ERR <原因>"
+--   PRESS <按键> <帧数>   按住若干帧后松开
+--   DOWN <按键> / UP <按键>
+--   WAIT <帧数>           等待若干帧再执行下一条（组合指令的按键间隔）
+--   SAVE <槽位>           即时存档
+--   PING
+-- 指令按收到的顺序排队，在帧回调中执行，两次按键之间至少间隔 RELEASE_GAP 帧
+
+local PORT = 8888
+local RELEASE_GAP = 2
+
+local BUTTONS = {
+	A = C.GBA_KEY.A, B = C.GBA_KEY.B, L = C.GBA_KEY.L, R = C.GBA_KEY.R,
+	START = C.GBA_KEY.START, SELECT = C.GBA_KEY.SELECT,
+	UP = C.GBA_KEY.UP, DOWN = C.GBA_KEY.DOWN, LEFT = C.GBA_KEY.LEFT, RIGHT = C.GBA_KEY.RIGHT,
+}
+
+local server = nil
+local clients = {}
+local nextClientId = 1
+local pending = {}   -- 待执行的指令队列
+local active = nil   -- 正在按住的按键 {key, releaseFrame}
+local idleUntil = 0  -- 松开后等待到该帧再执行下一条
+
+local function reply(sock, text)
+	sock:send(text .. "\n")
+end
+
+local function handleLine(sock, line)
+	local words = {}
+	for word in line:gmatch("%S+") do
+		table.insert(words, word)
+	end
+	local command = words[1]
+	if command == nil then
+		return
+	end
+	command = command:upper()
+	if command == "PING" then
+		reply(sock, "OK " .. emu:currentFrame())
+		return
+	end
+	if command == "WAIT" then
+		local frames = tonumber(words[2])
+		if frames == nil then
+			reply(sock, "ERR bad frame count")
+			return
+		end
+		table.insert(pending, {command = command, frames = math.max(0, frames)})
+		reply(sock, "OK " .. emu:currentFrame())
+		return
+	end
+	if command == "SAVE" then
+		local slot = tonumber(words[2])
+		if slot == nil then
+			reply(sock, "ERR bad slot")
+			return
+		end
+		table.insert(pending, {command = command, slot = slot})
+		reply(sock, "OK " .. emu:currentFrame())
+		return
+	end
+	local key = BUTTONS[(words[2] or ""):upper()]
+	if key == nil then
+		reply(sock, "ERR unknown button")
+		return
+	end
+	if command == "PRESS" then
+		table.insert(pending, {command = command, key = key, frames = math.max(1, tonumber(words[3]) or 6)})
+	elseif command == "DOWN" or command == "UP" then
+		table.insert(pending, {command = command, key = key})
+	else
+		reply(sock, "ERR unknown command")
+		return
+	end
+	reply(sock, "OK " .. emu:currentFrame())
+end
+
+local function onFrame()
+	local frame = emu:currentFrame()
+	if active then
+		if frame < active.releaseFrame then
+			return
+		end
+		emu:clearKey(active.key)
+		active = nil
+		idleUntil = frame + RELEASE_GAP
+	end
+	while #pending > 0 and frame >= idleUntil do
+		local item = table.remove(pending, 1)
+		if item.command == "PRESS" then
+			emu:addKey(item.key)
+			active = {key = item.key, releaseFrame = frame + item.frames}
+			return
+		elseif item.command == "WAIT" then
+			idleUntil = frame + item.frames
+		elseif item.command == "DOWN" then
+			emu:addKey(item.key)
+		elseif item.command == "UP" then
+			emu:clearKey(item.key)
+		elseif item.command == "SAVE" then
+			emu:saveStateSlot(item.slot)
+		end
+	end
+end
+
+local function closeClient(id)
+	local client = clients[id]
+	if client then
+		client.sock:close()
+		clients[id] = nil
+	end
+end
+
+local function onReceived(id)
+	local client = clients[id]
+	if not client then
+		return
+	end
+	while true do
+		local data, err = client.sock:receive(1024)
+		if data then
+			client.buffer = client.buffer .. data
+			while true do
+				local newline = client.buffer:find("\n", 1, true)
+				if not newline then
+					break
+				end
+				handleLine(client.sock, client.buffer:sub(1, newline - 1))
+				client.buffer = client.buffer:sub(newline + 1)
+			end
+		else
+			if err ~= socket.ERRORS.AGAIN then
+				closeClient(id)
+			end
+			return
+		end
+	end
+end
+
+local function onAccept()
+	local sock, err = server:accept()
+	if err then
+		console:error("Input server accept failed: " .. tostring(err))
+		return
+	end
+	local id = nextClientId
+	nextClientId = nextClientId + 1
+	clients[id] = {sock = sock, buffer = ""}
+	sock:add("received", function() onReceived(id) end)
+	sock:add("error", function() closeClient(id) end)
+	console:log("Input client connected: " .. id)
+end
+
+server = socket.bind(nil, PORT)
+if server then
+	server:listen()
+	server:add("received", onAccept)
+	callbacks:add("frame", onFrame)
+	console:log("Input server listening on port " .. PORT)
+else
+	console:error("Input server failed to bind port " .. PORT)
+end
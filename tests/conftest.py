@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+
+
+@pytest.fixture(scope='session')
+def controller(tmp_path_factory):
+    """导入控制器模块（导入时会在当前目录创建 danmaku 目录，所以切到临时目录导入）
+
+    控制器依赖 Windows 桌面环境的模块（pyautogui、win32）在其他平台导入失败时跳过相关测试。
+    """
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('controller'))
+    try:
+        return pytest.importorskip('bilibili_mgba_controller')
+    finally:
+        os.chdir(cwd)
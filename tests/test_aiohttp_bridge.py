@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('aiohttp')
+from aiohttp.test_utils import TestClient, TestServer
+
+
+class SlowQuery:
+    """按需逐条生成历史弹幕，记录生成器是否被关闭"""
+
+    def __init__(self, count=None, delay=0.0):
+        self.count = count
+        self.delay = delay
+        self.produced = 0
+        self.closed = threading.Event()
+
+    def iter_messages(self, start, end, username, platform_name, command, limit):
+        try:
+            while self.count is None or self.produced < self.count:
+                time.sleep(self.delay)
+                self.produced += 1
+                yield {'id': self.produced, 'username': username}
+        finally:
+            self.closed.set()
+
+
+@pytest.fixture
+def history_query(controller, monkeypatch):
+    monkeypatch.setattr(controller, 'DANMAKU_LOG_BACKEND', 'archive')
+
+    def install(query):
+        monkeypatch.setattr(controller, 'danmaku_query', query)
+        return query
+    return install
+
+
+async def open_client(controller):
+    client = TestClient(TestServer(controller.create_aiohttp_app(), handler_cancellation=True))
+    await client.start_server()
+    return client
+
+
+def test_bridge_streams_ndjson(controller, history_query):
+    query = history_query(SlowQuery(count=3))
+
+    async def scenario():
+        client = await open_client(controller)
+        try:
+            response = await client.get('/api/danmaku/history', params={'user': 'alice'})
+            assert response.status == 200
+            assert response.headers['Content-Type'].startswith('application/x-ndjson')
+            assert 'Content-Length' not in response.headers
+            return [json.loads(line) for line in (await response.text()).splitlines()]
+        finally:
+            await client.close()
+
+    messages = asyncio.run(scenario())
+    assert messages == [{'id': i, 'username': 'alice'} for i in (1, 2, 3)]
+    assert query.closed.is_set()
+
+
+def test_bridge_closes_generator_when_client_disconnects(controller, history_query):
+    query = history_query(SlowQuery(delay=0.01))
+
+    async def scenario():
+        client = await open_client(controller)
+        try:
+            response = await client.get('/api/danmaku/history')
+            first_line = await response.content.readline()
+            response.close()  # 读到第一行后断开连接
+            for _ in range(200):
+                if query.closed.is_set():
+                    break
+                await asyncio.sleep(0.01)
+            return json.loads(first_line)
+        finally:
+            await client.close()
+
+    assert asyncio.run(scenario())['id'] == 1
+    assert query.closed.is_set()
+    produced = query.produced
+    time.sleep(0.1)
+    assert query.produced == produced  # 断开后不再继续生成
+
+
+@pytest.fixture
+def broadcaster(controller, monkeypatch):
+    """测试结束后恢复广播器的事件循环，避免之后的发布唤醒已关闭的循环"""
+    sse_broadcaster = controller.sse_broadcaster
+    monkeypatch.setattr(sse_broadcaster, '_async_loop', None)
+    monkeypatch.setattr(sse_broadcaster, '_async_event', None, raising=False)
+    return sse_broadcaster
+
+
+async def wait_for_clients(sse_broadcaster, count):
+    for _ in range(200):
+        if sse_broadcaster.clients == count:
+            return True
+        await asyncio.sleep(0.01)
+    return False
+
+
+async def read_sse_event(response):
+    lines = []
+    while True:
+        line = (await response.content.readline()).decode('utf-8').rstrip('\n')
+        if not line:
+            return lines
+        lines.append(line)
+
+
+def test_sse_stream_delivers_published_events(controller, broadcaster):
+    async def scenario():
+        broadcaster.attach_loop(asyncio.get_running_loop())
+        client = await open_client(controller)
+        try:
+            response = await client.get('/api/danmaku/stream')
+            assert response.headers['Content-Type'].startswith('text/event-stream')
+            await read_sse_event(response)  # 初始快照
+            event_id = broadcaster.publish({'username': 'alice', 'command': 'a', 'timestamp': 1.0})
+            event = await asyncio.wait_for(read_sse_event(response), 5)
+            response.close()
+            return event_id, event, await wait_for_clients(broadcaster, 0)
+        finally:
+            await client.close()
+
+    event_id, event, disconnected = asyncio.run(scenario())
+    assert event[0] == f'id: {event_id}'
+    assert json.loads(event[1][len('data: '):])['username'] == 'alice'
+    assert disconnected
+
+
+def test_websocket_pushes_subscribed_channels(controller, broadcaster):
+    async def scenario():
+        broadcaster.attach_loop(asyncio.get_running_loop())
+        client = await open_client(controller)
+        try:
+            ws = await client.ws_connect('/api/danmaku/ws?channels=danmaku')
+            await wait_for_clients(broadcaster, 1)
+            broadcaster.publish({'type': 'vote_update', 'mode_info': {}})
+            broadcaster.publish({'username': 'bob', 'command': 'b', 'timestamp': 2.0})
+            batch = json.loads(await asyncio.wait_for(ws.receive_str(), 5))
+            await ws.close()
+            return batch, await wait_for_clients(broadcaster, 0)
+        finally:
+            await client.close()
+
+    batch, disconnected = asyncio.run(scenario())
+    assert batch == [{'t': 'm', 'u': 'bob', 'c': 'b', 'ts': 2.0}]
+    assert disconnected
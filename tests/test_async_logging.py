@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+
+import pytest
+
+from async_logging import SamplingFilter, get_sampling_stats, start_async_logging, stop_async_logging
+
+
+def make_record(msg, *args, level=logging.INFO, lineno=10):
+    return logging.LogRecord('test', level, __file__, lineno, msg, args, None)
+
+
+def test_sampling_filter_limits_each_call_site():
+    sampler = SamplingFilter(interval=60, burst=2)
+    assert [sampler.filter(make_record("a %d", i)) for i in range(4)] == [True, True, False, False]
+    # 其他调用位置和 WARNING 及以上级别不受影响
+    assert sampler.filter(make_record("b", lineno=11))
+    assert sampler.filter(make_record("w", level=logging.WARNING))
+    assert sampler.suppressed_total == 2
+
+
+def test_sampling_filter_summarizes_on_flush():
+    sampler = SamplingFilter(interval=60, burst=1)
+    for i in range(3):
+        sampler.filter(make_record("a %d", i))
+    sampler.flush()
+    assert sampler.take_summaries() == []  # 周期还没结束
+    sampler.flush(force=True)
+    summaries = sampler.take_summaries()
+    assert len(summaries) == 1
+    assert summaries[0].getMessage().startswith("Suppressed 2 similar log lines")
+    assert summaries[0].getMessage().endswith("a 2")
+    assert sampler.filter(make_record("a %d", 3))  # 新周期重新计数
+
+
+def test_zero_burst_disables_sampling():
+    sampler = SamplingFilter(interval=60, burst=0)
+    assert all(sampler.filter(make_record("a")) for _ in range(100))
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+@pytest.fixture
+def root_handler():
+    root = logging.getLogger()
+    saved_handlers, saved_level = list(root.handlers), root.level
+    for handler in saved_handlers:
+        root.removeHandler(handler)
+    handler = ListHandler()
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+    yield handler
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    for existing in saved_handlers:
+        root.addHandler(existing)
+    root.setLevel(saved_level)
+
+
+def test_listener_flushes_summary_when_idle(root_handler):
+    listener = start_async_logging(sample_interval=0.1, sample_burst=1)
+    try:
+        log = logging.getLogger('test.idle')
+        for i in range(5):
+            log.info("msg %d", i)
+        deadline = time.monotonic() + 2
+        while time.monotonic() < deadline and not any(m.startswith('Suppressed') for m in root_handler.messages):
+            time.sleep(0.02)
+        assert get_sampling_stats()['suppressed'] == 4
+    finally:
+        stop_async_logging(listener)
+    assert root_handler.messages[0] == 'msg 0'
+    assert root_handler.messages[1].startswith('Suppressed 4 similar log lines')
+
+
+def test_stop_flushes_pending_summary(root_handler):
+    listener = start_async_logging(sample_interval=60, sample_burst=1)
+    log = logging.getLogger('test.stop')
+    for i in range(3):
+        log.info("msg %d", i)
+    stop_async_logging(listener)
+    assert root_handler.messages == ['msg 0', 'Suppressed 2 similar log lines in the last 60.0s, last one: msg 2']
+    assert get_sampling_stats() == {'enabled': False}
+    log.info("after")
+    assert root_handler.messages[-1] == 'after'
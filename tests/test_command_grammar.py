@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+
+@pytest.fixture
+def grammar(controller):
+    return controller.CommandGrammar()
+
+
+@pytest.mark.parametrize('text', ['r i3 j2', 'r+i3', 'ri3', 'run i3', '跑 i3', 'R I3'])
+def test_run_prefixes(grammar, text):
+    parsed = grammar.parse(text)
+    assert parsed.kind == 'run'
+    assert parsed.steps[0] == ('up', 3)
+    assert parsed.display.startswith('R + ↑3')
+
+
+@pytest.mark.parametrize('text, steps', [
+    ('right', (('right', 1),)),
+    ('right2', (('right', 2),)),
+    ('right+left', (('right', 1), ('left', 1))),
+])
+def test_right_is_a_key_not_a_run(grammar, text, steps):
+    parsed = grammar.parse(text)
+    assert parsed.kind == 'key'
+    assert parsed.steps == steps
+
+
+def test_run_rejects_non_movement_keys(grammar):
+    assert grammar.parse('r a3').kind == 'rejected'
+
+
+def test_combination_separators(grammar):
+    assert grammar.parse('a3+b3+i2').steps == (('x', 3), ('z', 3), ('up', 2))
+    assert grammar.parse('a3 b3 i2').steps == (('x', 3), ('z', 3), ('up', 2))
+    assert grammar.parse('a3 + b3').display == 'A3 + B3'
+
+
+@pytest.mark.parametrize('text', ['a+b+c+d', 'a b c d'])
+def test_too_many_sub_commands_rejected(grammar, text):
+    assert grammar.parse(text).kind == 'rejected'
+
+
+def test_start_select_only_alone(grammar):
+    assert grammar.parse('start').steps == (('enter', 1),)
+    assert grammar.parse('start+a').kind == 'rejected'
+    assert grammar.parse('start2').kind == 'rejected'
+
+
+def test_votes_and_unknown(grammar, controller):
+    vote = grammar.parse('秩序')
+    assert vote.kind == 'vote'
+    assert vote.vote_type == '秩序'
+    assert grammar.parse('hello').kind == 'unknown'
+    assert grammar.parse('a99').kind == 'unknown'
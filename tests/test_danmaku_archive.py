@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import time
+
+from danmaku_archive import INDEX_SUFFIX, ArchiveReader, ArchiveWriter
+
+
+def make_rows(start, count):
+    return [[start + i, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start + i)), f'user{i}', 'a', '是', '哔哩哔哩']
+            for i in range(count)]
+
+
+def test_torn_index_line_is_recovered(tmp_path):
+    base = time.mktime(time.strptime('2025-08-26 12:00:00', '%Y-%m-%d %H:%M:%S'))
+    writer = ArchiveWriter(str(tmp_path))
+    for block in range(3):
+        writer.write_block(make_rows(base + block * 4, 3))
+    segment_path = writer.current_segment
+    writer.close()
+
+    # 模拟进程在写最后一行索引时退出
+    index_path = segment_path[:-4] + INDEX_SUFFIX
+    with open(index_path, 'rb') as f:
+        data = f.read()
+    with open(index_path, 'wb') as f:
+        f.write(data[:-20])
+
+    writer = ArchiveWriter(str(tmp_path))
+    writer.write_block(make_rows(base + 12, 3))
+    writer.close()
+
+    with open(index_path, encoding='utf-8') as f:
+        entries = [json.loads(line) for line in f]
+    assert [entry['rows'] for entry in entries] == [3, 3, 3, 3]
+    assert entries[-1]['offset'] + entries[-1]['length'] == os.path.getsize(segment_path)
+    rows = list(ArchiveReader(str(tmp_path)).iter_rows())
+    assert [row[0] for row in rows] == [base + block * 4 + i for block in range(4) for i in range(3)]
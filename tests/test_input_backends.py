@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import input_backends
+from input_backends import RecordingBackend, create_input_backend
+
+
+def test_recording_backend_records_presses():
+    backend = RecordingBackend(simulate_timing=False)
+    backend.press('up', 0.1)
+    backend.press('x', 0.1)
+    assert [(action, key) for _, action, key in backend.events] == [
+        ('down', 'up'), ('up', 'up'), ('down', 'x'), ('up', 'x')
+    ]
+    assert backend.pressed == set()
+    assert backend.get_stats()['presses'] == 2
+
+
+def test_recording_backend_save_state_releases_shift():
+    backend = RecordingBackend(simulate_timing=False)
+    backend.save_state(3)
+    assert [(action, key) for _, action, key in backend.events] == [
+        ('down', 'shift'), ('down', 'f3'), ('up', 'f3'), ('up', 'shift')
+    ]
+
+
+def test_create_recording_backend_only_when_configured():
+    backend = create_input_backend('recording', None, simulate_timing=False)
+    assert isinstance(backend, RecordingBackend)
+    assert backend.simulate_timing is False
+
+
+def test_create_unknown_backend_raises():
+    with pytest.raises(ValueError):
+        create_input_backend('pyautogiu')
+
+
+def test_create_backend_with_bad_option_raises():
+    with pytest.raises(TypeError):
+        create_input_backend('recording', None, simulate_timings=False)
+
+
+@pytest.mark.skipif(input_backends.pyautogui is not None, reason="pyautogui is installed")
+def test_missing_desktop_dependency_raises_instead_of_recording():
+    with pytest.raises(RuntimeError):
+        create_input_backend('pyautogui', None, pause=0.1)
+
+
+def test_default_schedule_matches_baseline_timing():
+    # 原实现：keyDown 后 PAUSE 0.1 秒 + 按住 0.1 秒，keyUp 后 PAUSE 0.1 秒
+    profile = input_backends.TimingProfile(hold=0.2, gap=0.1)
+    schedule = input_backends.compile_schedule((('up', 2),), profile)
+    assert [(round(offset, 3), action, key) for offset, action, key in schedule.events] == [
+        (0.0, 'down', 'up'), (0.2, 'up', 'up'), (0.3, 'down', 'up'), (0.5, 'up', 'up')
+    ]
+    assert schedule.duration == pytest.approx(0.6)
+
+
+def test_hold_key_schedule_waits_before_first_press():
+    profile = input_backends.TimingProfile(hold=0.2, gap=0.1, keys={'enter': {'hold': 0.05}})
+    schedule = input_backends.compile_schedule((('enter', 1),), profile, hold_key='z')
+    assert [(round(offset, 3), action, key) for offset, action, key in schedule.events] == [
+        (0.0, 'down', 'z'), (0.1, 'down', 'enter'), (0.15, 'up', 'enter'), (0.25, 'up', 'z')
+    ]
+    assert schedule.lead == pytest.approx(0.1)
+
+
+@pytest.fixture
+def mock_emulator():
+    server = input_backends.MockEmulatorServer().start()
+    yield server
+    server.stop()
+
+
+def test_socket_backend_sends_press_and_wait_frames(mock_emulator):
+    host, port = mock_emulator.address
+    backend = create_input_backend('socket', None, host=host, port=port, release_gap_frames=2)
+    profile = input_backends.TimingProfile(hold=0.2, gap=0.1)
+    try:
+        backend.run_schedule(input_backends.compile_schedule((('up', 2),), profile, hold_key='z'))
+    finally:
+        backend.close()
+    # 0.2 秒 = 12 帧，0.1 秒 = 6 帧，其中 2 帧由 PRESS 后的松开间隔覆盖
+    assert [(command, args) for _, command, args in mock_emulator.commands] == [
+        ('DOWN', ['B']), ('WAIT', ['6']),
+        ('PRESS', ['UP', '12']), ('WAIT', ['4']),
+        ('PRESS', ['UP', '12']), ('WAIT', ['4']),
+        ('UP', ['B'])
+    ]
+    assert backend.get_stats()['presses'] == 2
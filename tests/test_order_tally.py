@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import random
+
+import pytest
+
+
+@pytest.fixture
+def tally(controller):
+    return controller.OrderTally()
+
+
+def vote(controller, tally, *texts):
+    grammar = controller.CommandGrammar()
+    for text in texts:
+        parsed = grammar.parse(text)
+        tally.add(controller.command_stat_key(parsed), parsed)
+
+
+def test_top_orders_by_votes(controller, tally):
+    vote(controller, tally, 'i', 'j', 'j', 'k', 'k', 'k')
+    assert [(display, votes) for _, votes, _, display in tally.top(3)] == [('↓', 3), ('←', 2), ('↑', 1)]
+    assert tally.winner()[1] == 3
+    assert tally.total_votes == 6
+
+
+def test_ties_keep_first_to_reach_count(controller, tally):
+    # ↓ 先到 2 票，↑ 后到 2 票
+    vote(controller, tally, 'i', 'k', 'k', 'i', 'j')
+    assert [display for _, _, _, display in tally.top(3)] == ['↓', '↑', '←']
+
+
+def test_run_commands_counted_separately(controller, tally):
+    vote(controller, tally, 'i', 'r i', 'r i')
+    assert [stat_key for stat_key, _, _, _ in tally.top(2)] == ['[RUN] R + ↑', '↑']
+
+
+def test_top_matches_sorted_reference(controller, tally):
+    grammar = controller.CommandGrammar()
+    commands = [grammar.parse(text) for text in ('i', 'j', 'k', 'l', 'a', 'b', 'r i', 'i2')]
+    rng = random.Random(7)
+    counts = {}
+    reached = {}  # {stat_key: 到达当前票数的序号}
+    for step in range(500):
+        parsed = rng.choice(commands)
+        stat_key = controller.command_stat_key(parsed)
+        counts[stat_key] = tally.add(stat_key, parsed)
+        reached[stat_key] = step
+        expected = sorted(counts, key=lambda key: (-counts[key], reached[key]))[:5]
+        assert [stat_key for stat_key, _, _, _ in tally.top(5)] == expected
+    tally.clear()
+    assert not tally and tally.top(5) == [] and tally.winner() is None
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+
+@pytest.fixture
+def client(controller):
+    controller.app.config['TESTING'] = True
+    return controller.app.test_client()
+
+
+@pytest.mark.parametrize('path', ['/api/danmaku/history', '/api/danmaku/stats'])
+def test_history_requires_archive_backend(controller, client, monkeypatch, path):
+    monkeypatch.setattr(controller, 'DANMAKU_LOG_BACKEND', 'csv')
+    response = client.get(path)
+    assert response.status_code == 409
+    assert response.get_json()['success'] is False
+    assert 'archive' in response.get_json()['message']
+
+
+def test_index_renders_order_commands_by_display(controller, client, monkeypatch):
+    parsed = controller.CommandGrammar().parse('r i3')
+    tally = controller.OrderTally()
+    tally.add(controller.command_stat_key(parsed), parsed)
+    monkeypatch.setattr(controller, 'order_commands', tally)
+    monkeypatch.setattr(controller, 'current_mode', '秩序')
+    body = client.get('/').get_data(as_text=True)
+    assert parsed.display in body
+    assert '[RUN]' not in body